@@ -0,0 +1,304 @@
+"""Rerun latency benchmark for The Transparent Pipeline.
+
+Drives streamlit_app.py with Streamlit's AppTest through the idle page, all
+four pipeline steps and the results page, and times every script execution,
+including the ones chained by st.rerun(). Scenarios vary the file size, the
+number of console log entries and the number of custom stages.
+
+Script time is wall time minus time.sleep() on the script thread, so the
+simulated Kafka delays and job polling do not drown out the work a rerun does.
+
+    python benchmark_reruns.py                          # print the table
+    python benchmark_reruns.py --save-baseline base.json
+    python benchmark_reruns.py --baseline base.json     # exit 1 on a regression
+"""
+import argparse
+import functools
+import http.server
+import itertools
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from unittest import mock
+
+os.environ.setdefault("PIPELINE_SIMULATED_LATENCY", "0")
+os.environ.setdefault("PIPELINE_HISTORY_DB", os.path.join(tempfile.mkdtemp(prefix="rerun-bench-"), "history.sqlite3"))
+
+import streamlit as st
+from streamlit.runtime.scriptrunner import ScriptRunnerEvent
+from streamlit.testing.v1 import AppTest, app_test
+from streamlit.testing.v1.local_script_runner import LocalScriptRunner
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "streamlit_app.py")
+DEFAULT_ROWS = [1_000, 50_000]
+DEFAULT_LOGS = [0, 5_000]
+DEFAULT_STAGES = [0, 8]
+IDLE_RERUNS = 3
+REPEATS = 3
+RUN_TIMEOUT = 300
+FETCH_TIMEOUT = 60
+REGRESSION_TOLERANCE = 0.5
+REGRESSION_MIN_MS = 50.0
+PHASE_LABELS = {
+    "idle": "Idle (step 0)",
+    1: "Connecting (step 1)",
+    2: "Validating (step 2)",
+    3: "Producing (step 3)",
+    4: "Completed (step 4)",
+    "results": "Results idle",
+}
+SAMPLE_ROWS = [
+    ("YouTube", "How to Build a Data Pipeline", "https://www.youtube.com/watch?v=example{}"),
+    ("YouTube Music", "Lofi Hip Hop Mix", "https://music.youtube.com/watch?v=example{}"),
+    ("YouTube", '"Multi-line\ndescription, with a comma"', "https://www.youtube.com/watch?v=example{}"),
+    ("YouTube", "TypeScript Best Practices", "https://www.youtube.com/watch?v=example{}"),
+]
+
+_slept = defaultdict(float)
+_real_sleep = time.sleep
+
+
+def _counting_sleep(seconds):
+    _slept[threading.get_ident()] += seconds
+    _real_sleep(seconds)
+
+
+class TimedScriptRunner(LocalScriptRunner):
+    """LocalScriptRunner that records the time of every script execution"""
+
+    timings = None
+    phase = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._started = None
+        self.on_event.connect(self._time_event, weak=False)
+
+    def _time_event(self, sender, event, **kwargs):
+        ident = threading.get_ident()
+        if event == ScriptRunnerEvent.SCRIPT_STARTED:
+            state = self._session_state
+            step = state["current_step"] if "current_step" in state else 0
+            running = "pipeline_running" in state and state["pipeline_running"]
+            phase = step if running or step == 4 else TimedScriptRunner.phase
+            self._started = (phase, time.perf_counter(), _slept[ident])
+        elif event in (ScriptRunnerEvent.SCRIPT_STOPPED_WITH_SUCCESS, ScriptRunnerEvent.SCRIPT_STOPPED_FOR_RERUN):
+            if self._started is None or TimedScriptRunner.timings is None:
+                return
+            phase, started, slept = self._started
+            wall = time.perf_counter() - started
+            slept = _slept[ident] - slept
+            TimedScriptRunner.timings.append({"phase": phase, "wall": wall, "script": max(wall - slept, 0.0)})
+            self._started = None
+
+
+def write_csv(directory: str, rows: int) -> str:
+    """Write a YouTube history CSV shaped like the samples"""
+    path = os.path.join(directory, f"history_{rows}.csv")
+    if not os.path.exists(path):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("Activity,Description,Date,URL\n")
+            for i in range(rows):
+                activity, description, url = SAMPLE_ROWS[i % len(SAMPLE_ROWS)]
+                minute = i % (60 * 24 * 28)
+                date = f"Nov {1 + minute // (60 * 24)} 2025 {(minute // 60) % 12 + 1}:{minute % 60:02d} {'AM' if (minute // 720) % 2 == 0 else 'PM'}"
+                f.write(f"{activity},{description},{date},{url.format(i)}\n")
+    return path
+
+
+def serve(directory: str) -> http.server.ThreadingHTTPServer:
+    """Serve a directory on a local port, so the benchmark exercises the URL fetch"""
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(Handler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_stages(count: int) -> list:
+    """Custom stages as the Extend form builds them, chained after the quality step"""
+    stages = []
+    for i in range(count):
+        stages.append({
+            "name": f"bench_stage_{i + 1}",
+            "description": "Benchmark stage",
+            "position": "After Validation",
+            "position_label": "✓ Validation Layer",
+            "after": [stages[-1]["name"]] if stages else ["quality"],
+            "before": [],
+            "seconds": 0.0,
+            "id": i + 1,
+        })
+    return stages
+
+
+def seed_logs(at: AppTest, count: int):
+    logs = at.session_state.logs
+    for i in range(count):
+        logs.append(f"Benchmark log entry {i + 1}", ("INFO", "SUCCESS", "WARNING")[i % 3])
+
+
+def run_scenario(url: str, logs: int, stages: int, idle_reruns: int) -> list:
+    """Drive one full pipeline run and return the timed script executions"""
+    timings = TimedScriptRunner.timings = []
+    at = AppTest.from_file(APP_PATH, default_timeout=RUN_TIMEOUT)
+    TimedScriptRunner.phase = "idle"
+    at.run()
+    at.session_state.custom_stages = make_stages(stages)
+    seed_logs(at, logs)
+    for _ in range(idle_reruns):
+        at.run()
+
+    at.radio(key="source_radio").set_value("Public URL").run()
+    at.text_input[0].set_value(url).run()
+    deadline = time.monotonic() + FETCH_TIMEOUT
+    while at.session_state.fetch_manager.active_jobs():
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Fetching {url} timed out")
+        _real_sleep(0.05)
+    at.run()
+    _raise_for_errors(at)
+
+    [start] = [button for button in at.button if "Start Pipeline" in str(button.label)]
+    start.click().run()
+    deadline = time.monotonic() + RUN_TIMEOUT
+    while at.session_state.pipeline_running:
+        if time.monotonic() > deadline:
+            raise RuntimeError("Pipeline run timed out")
+        at.run()
+    _raise_for_errors(at)
+    if not at.session_state.stats or at.session_state.stats.get("status") != "success":
+        raise RuntimeError(f"Pipeline failed: {(at.session_state.stats or {}).get('message')}")
+
+    TimedScriptRunner.phase = "results"
+    seed_logs(at, logs)
+    for _ in range(idle_reruns):
+        at.run()
+    # The step-4 render and idle reruns after it both start at step 4; split them by order
+    done = [t for t in timings if t["phase"] == 4]
+    for timing in done[1:]:
+        timing["phase"] = "results"
+    TimedScriptRunner.timings = None
+    return timings
+
+
+def _raise_for_errors(at: AppTest):
+    if at.exception:
+        raise RuntimeError(f"App raised: {at.exception[0].value}")
+    errors = [error.value for error in at.error]
+    if errors:
+        raise RuntimeError(f"App showed an error: {errors[0]}")
+
+
+def summarize(timings: list) -> dict:
+    """Per phase: reruns, median and max script time in milliseconds"""
+    phases = defaultdict(list)
+    for timing in timings:
+        phases[timing["phase"]].append(timing["script"] * 1000)
+    return {
+        str(phase): {
+            "reruns": len(values),
+            "median_ms": round(statistics.median(values), 2),
+            "max_ms": round(max(values), 2),
+        }
+        for phase, values in phases.items()
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float, min_ms: float) -> list:
+    """Phases whose median script time grew past the tolerance and the absolute floor"""
+    regressions = []
+    for scenario, phases in results.items():
+        for phase, current in phases.items():
+            before = baseline.get(scenario, {}).get(phase)
+            if before is None:
+                continue
+            grown = current["median_ms"] - before["median_ms"]
+            if grown > min_ms and current["median_ms"] > before["median_ms"] * (1 + tolerance):
+                regressions.append({
+                    "scenario": scenario, "phase": phase,
+                    "baseline_ms": before["median_ms"], "median_ms": current["median_ms"],
+                })
+    return regressions
+
+
+def print_table(results: dict):
+    width = max(len(label) for label in PHASE_LABELS.values())
+    for scenario, phases in results.items():
+        print(f"\n{scenario}")
+        print(f"  {'phase':<{width}}  {'reruns':>6}  {'median ms':>10}  {'max ms':>10}")
+        for phase, label in PHASE_LABELS.items():
+            summary = phases.get(str(phase))
+            if summary:
+                print(f"  {label:<{width}}  {summary['reruns']:>6}  {summary['median_ms']:>10.1f}  {summary['max_ms']:>10.1f}")
+
+
+def _int_list(text: str) -> list:
+    return [int(value) for value in text.split(",") if value.strip()]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=_int_list, default=DEFAULT_ROWS, help="Comma-separated file sizes in rows")
+    parser.add_argument("--logs", type=_int_list, default=DEFAULT_LOGS, help="Comma-separated console log counts")
+    parser.add_argument("--stages", type=_int_list, default=DEFAULT_STAGES, help="Comma-separated custom stage counts")
+    parser.add_argument("--idle-reruns", type=int, default=IDLE_RERUNS, help="Idle reruns before and after each run")
+    parser.add_argument("--repeat", type=int, default=REPEATS, help="Full pipeline runs per scenario")
+    parser.add_argument("--baseline", help="Baseline JSON to compare against; exits 1 on a regression")
+    parser.add_argument("--save-baseline", help="Write the results as a baseline JSON")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE,
+                        help="Allowed relative growth of a phase's median script time")
+    parser.add_argument("--min-ms", type=float, default=REGRESSION_MIN_MS,
+                        help="Growth below this many milliseconds is never a regression")
+    args = parser.parse_args(argv)
+
+    # Deprecation notices are logged on every rerun and would bury the table
+    logging.disable(logging.WARNING)
+    data_dir = tempfile.mkdtemp(prefix="rerun-bench-data-")
+    server = serve(data_dir)
+    results = {}
+    with mock.patch.object(app_test, "LocalScriptRunner", TimedScriptRunner), \
+            mock.patch.object(time, "sleep", _counting_sleep):
+        # Import the app's dependencies once so the first scenario does not pay for them
+        AppTest.from_file(APP_PATH, default_timeout=RUN_TIMEOUT).run()
+        for rows, logs, stages in itertools.product(args.rows, args.logs, args.stages):
+            url = f"http://127.0.0.1:{server.server_port}/{os.path.basename(write_csv(data_dir, rows))}"
+            scenario = f"rows={rows} logs={logs} stages={stages}"
+            started = time.perf_counter()
+            timings = []
+            for _ in range(args.repeat):
+                timings.extend(run_scenario(url, logs, stages, args.idle_reruns))
+            results[scenario] = summarize(timings)
+            print(f"{scenario}: {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    server.shutdown()
+    print_table(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({"streamlit": st.__version__, "scenarios": results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline["scenarios"], args.tolerance, args.min_ms)
+        for regression in regressions:
+            label = PHASE_LABELS.get(int(regression["phase"]) if regression["phase"].isdigit() else regression["phase"])
+            print(
+                f"REGRESSION {regression['scenario']} / {label}: "
+                f"{regression['baseline_ms']:.1f} ms -> {regression['median_ms']:.1f} ms",
+                file=sys.stderr,
+            )
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
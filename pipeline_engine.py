@@ -0,0 +1,3371 @@
+"""Processing engine for The Transparent Pipeline.
+
+Everything here is free of Streamlit so it can run inside the shared worker
+pool as well as on the script thread.
+"""
+import bz2
+import codecs
+import hashlib
+import io
+import itertools
+import json
+import lzma
+import math
+import multiprocessing
+import os
+import pickle
+import re
+import struct
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+try:
+    import zstandard
+except ImportError:  # .zst input is optional
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:  # no checkpoint locking on Windows
+    fcntl = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:  # the data preview is optional
+    pa = None
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Error-tolerant parsing
+TOLERANT_MAX_FIELD_SIZE = 1024 * 1024
+TOLERANT_MAX_RECORD_SIZE = 4 * 1024 * 1024
+QUARANTINE_SAMPLE_SIZE = 50
+QUARANTINE_PREVIEW_CHARS = 200
+QUARANTINE_RAW_LIMIT = 64 * 1024
+
+# Shared worker pool
+JOB_MAX_WORKERS = int(os.environ.get("PIPELINE_MAX_WORKERS", min(4, os.cpu_count() or 1)))
+JOB_MEMORY_BUDGET = int(os.environ.get("PIPELINE_MEMORY_BUDGET_MB", 1024)) * 1024 * 1024
+JOB_BASE_MEMORY = 64 * 1024 * 1024
+JOB_MEMORY_PER_BYTE = 2.0
+JOB_INFLATE_RATIO = 8
+JOB_RESULT_TTL = 15 * 60  # finished jobs nobody collects are forgotten after this
+
+# Parallel parsing
+# A 4-range run pays about 1-2 s for forking the pool and returning and merging partial stats,
+# so smaller files parse faster serially even with a core per range
+PARALLEL_MIN_BYTES = 32 * 1024 * 1024
+PARALLEL_SCAN_BLOCK = 1024 * 1024
+PARALLEL_SPECULATION_WINDOW = 4096
+
+# Rows per DataFrame batch handed to the rules engine and chart aggregates
+FRAME_BATCH_ROWS = 50000
+
+# Pre-aggregated charts
+CHART_MAX_COLUMNS = 20
+CHART_LENGTH_BINS = 24
+CHART_NUMERIC_BINS = 40
+CHART_TOP_N = 10
+CHART_MAX_POINTS = 500
+CHART_DAILY_AFTER_HOURS = 14 * 24
+CHART_DATE_COLUMN = "Date"
+
+# Streaming sketches
+SKETCH_WIDTH = 8192  # Count-Min counters per row: error at most e / width of the rows counted
+SKETCH_DEPTH = 5  # ... except with probability e^-depth
+SKETCH_CANDIDATES = 1000  # heavy-hitter candidates kept per column
+SKETCH_HLL_PRECISION = 14  # 2^14 registers, about 0.8% standard error
+
+# Data preview
+PREVIEW_ORDER_CACHE = 4
+
+# Text search
+TEXT_INDEX_COLUMN = "Description"
+TEXT_CHUNK_ROWS = 1_000_000  # rows per inverted-index chunk file
+TEXT_MAX_TOKEN = 32  # longer tokens are truncated
+TEXT_TOKEN_PATTERN = r"\w+"
+
+# Event-time windows
+WINDOW_MAX_RESULTS = 5000
+WINDOW_MAX_PER_ROW = 1440
+WINDOW_KEY_COLUMN = "Activity"
+
+# Lookup enrichment
+LOOKUP_MEMORY_CACHE = 2  # built indexes kept per process
+LOOKUP_SAMPLE_SIZE = 10  # unmatched keys reported
+YOUTUBE_ID_PATTERN = r"(?:[?&]v=|youtu\.be/|/shorts/)([A-Za-z0-9_-]+)"
+
+# Stage scheduling
+STAGE_MAX_WORKERS = 4
+# Stages of StatsAccumulator.result(); windows and lookup only run when configured
+STAGE_BUILTIN = ("parse", "completeness", "classify", "rules", "quality", "insights", "charts", "windows", "lookup")
+
+# Checkpointing
+CHECKPOINT_INTERVAL = float(os.environ.get("PIPELINE_CHECKPOINT_SECONDS", 10))
+CHECKPOINT_VERSION = 4
+CHECKPOINT_MAX_AGE = 24 * 3600  # unclaimed checkpoints older than this are purged
+
+# Approximate preview
+APPROX_CLUSTER_BYTES = 64 * 1024
+APPROX_Z = 1.96  # 95% intervals
+APPROX_INFLATE_LIMIT = 16 * 1024 * 1024
+
+# Metrics
+METRICS_LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)  # seconds
+METRICS_THROUGHPUT_BUCKETS = (1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7)  # rows per second
+METRICS_SESSION_WINDOW = 300  # a session counts as active this long after its last rerun
+
+# Data-quality rules
+RULE_TYPES = ("not_null", "regex", "enum", "range", "unique", "cross")
+RULE_SAMPLE_SIZE = 10  # failing rows kept per rule
+RULE_UNIQUE_EXACT_LIMIT = 100_000  # distinct values a unique rule tracks exactly before switching to HyperLogLog
+RULE_SCORE_POINTS = 40
+YOUTUBE_DATE_FORMAT = "%b %d %Y %I:%M %p"
+DEFAULT_QUALITY_RULES = [
+    {"name": "Activity present", "type": "not_null", "column": "Activity", "weight": 2},
+    {"name": "Known activity", "type": "enum", "column": "Activity", "values": ["YouTube", "YouTube Music"]},
+    {"name": "Date parses", "type": "range", "column": "Date", "format": YOUTUBE_DATE_FORMAT},
+    {"name": "Valid URL", "type": "regex", "column": "URL", "pattern": r"^https?://[^\s/$.?#][^\s]*$"},
+    {"name": "Unique URL", "type": "unique", "column": "URL", "weight": 0.5},
+    {"name": "Music links on music.youtube.com", "type": "cross",
+     "when": {"column": "Activity", "regex": "Music"},
+     "then": {"column": "URL", "regex": r"music\.youtube\.com"}},
+]
+
+
+_CSV_SPECIAL = re.compile(r'[",\r\n]')
+
+class CsvStreamParser:
+    """Incremental RFC 4180 parser.
+
+    Text can be fed in arbitrary chunks; the rows produced are identical to
+    parsing the concatenated text in one go with parse_csv_proper.
+    """
+
+    def __init__(self):
+        self.current = []
+        self.field_parts = []
+        self.inside_quotes = False
+        self._pending = ''
+
+    def feed(self, text: str, final: bool = False) -> list:
+        """Parse a chunk of text and return the rows it completed"""
+        text = self._pending + text
+        self._pending = ''
+        rows = []
+        current = self.current
+        parts = self.field_parts
+        inside_quotes = self.inside_quotes
+        n = len(text)
+        i = 0
+        while i < n:
+            if inside_quotes:
+                j = text.find('"', i)
+                if j == -1:
+                    parts.append(text[i:])
+                    break
+                parts.append(text[i:j])
+                if j + 1 < n:
+                    if text[j + 1] == '"':
+                        parts.append('"')
+                        i = j + 2
+                    else:
+                        inside_quotes = False
+                        i = j + 1
+                elif final:
+                    inside_quotes = False
+                    i = n
+                else:
+                    # A trailing quote may be the first half of an escaped "" pair
+                    self._pending = '"'
+                    i = n
+                continue
+
+            match = _CSV_SPECIAL.search(text, i)
+            if match is None:
+                parts.append(text[i:])
+                break
+            j = match.start()
+            if j > i:
+                parts.append(text[i:j])
+            char = text[j]
+            if char == '"':
+                inside_quotes = True
+            elif char == ',':
+                current.append(''.join(parts).strip())
+                parts = []
+            else:
+                field = ''.join(parts)
+                if field or len(current) > 0:
+                    current.append(field.strip())
+                    if any(current):
+                        rows.append(current)
+                    current = []
+                parts = []
+                if char == '\r' and j + 1 < n and text[j + 1] == '\n':
+                    j += 1
+            i = j + 1
+
+        if final:
+            field = ''.join(parts)
+            if field or len(current) > 0:
+                current.append(field.strip())
+                if any(current):
+                    rows.append(current)
+            current = []
+            parts = []
+
+        self.current = current
+        self.field_parts = parts
+        self.inside_quotes = inside_quotes
+        return rows
+
+    def close(self) -> list:
+        """Flush the final record"""
+        return self.feed('', final=True)
+
+def parse_csv_proper(file_content: str) -> list:
+    """RFC 4180 CSV Parser"""
+    parser = CsvStreamParser()
+    return parser.feed(file_content) + parser.close()
+
+class Quarantine:
+    """Collects rejected records: counts per reason, a small sample and an optional JSONL file"""
+
+    def __init__(self, path: str = None, sample_size: int = QUARANTINE_SAMPLE_SIZE):
+        self.path = path
+        self.sample_size = sample_size
+        self.total = 0
+        self.by_reason = {}
+        self.sample = []
+        self._file = open(path, 'w', encoding='utf-8') if path else None
+
+    def add(self, reason: str, line: int, byte_offset: int, raw: str, detail: str = ""):
+        self.total += 1
+        self.by_reason[reason] = self.by_reason.get(reason, 0) + 1
+        entry = {
+            "reason": reason,
+            "line": line,
+            "byte_offset": byte_offset,
+            "detail": detail,
+            "raw": raw[:QUARANTINE_RAW_LIMIT],
+        }
+        if len(self.sample) < self.sample_size:
+            self.sample.append({**entry, "raw": raw[:QUARANTINE_PREVIEW_CHARS]})
+        if self._file is not None:
+            self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __getstate__(self):
+        # A checkpoint records how much of the JSONL file belongs to it
+        state = dict(self.__dict__)
+        state['_file'] = None
+        state['_written'] = None
+        if self._file is not None:
+            self._file.flush()
+            state['_written'] = self._file.tell()
+        return state
+
+    def __setstate__(self, state):
+        written = state.pop('_written', None)
+        self.__dict__.update(state)
+        if written is not None:
+            with open(self.path, 'r+b') as f:
+                f.truncate(written)
+            self._file = open(self.path, 'a', encoding='utf-8')
+
+    def summary(self) -> dict:
+        return {
+            "total": self.total,
+            "by_reason": dict(self.by_reason),
+            "sample": list(self.sample),
+            "path": self.path,
+        }
+
+class TolerantCsvParser:
+    """Error-tolerant variant of CsvStreamParser.
+
+    Records whose field count differs from the header, fields or records
+    over the size caps, and quotes left open at end of input are sent to a
+    Quarantine with their line number and byte offset instead of becoming
+    ragged rows. After an oversized or unterminated record the parser
+    resyncs at the next line (or the next line matching resync_pattern) and
+    replays the buffered text from there, so one stray quote cannot swallow
+    the rest of the file. Memory is bounded by max_record_size.
+    """
+
+    def __init__(self, quarantine: Quarantine, max_field_size: int = TOLERANT_MAX_FIELD_SIZE,
+                 max_record_size: int = TOLERANT_MAX_RECORD_SIZE, resync_pattern: str = None,
+                 expected_fields: int = None):
+        self.quarantine = quarantine
+        self.max_field_size = max_field_size
+        self.max_record_size = max_record_size
+        self.resync_pattern = re.compile(resync_pattern) if resync_pattern else None
+        self.expected_fields = expected_fields
+        self._buf = ''
+        self._pos = 0
+        self._rec_start = 0
+        self._current = []
+        self._parts = []
+        self._field_len = 0
+        self._inside = False
+        self._seeking = False
+        # Line/byte position of _cursor within _buf, advanced lazily
+        self._cursor = 0
+        self._line = 1
+        self._bytes = 0
+
+    def _advance(self, index: int):
+        if index > self._cursor:
+            chunk = self._buf[self._cursor:index]
+            self._line += chunk.count('\n')
+            self._bytes += len(chunk.encode('utf-8'))
+            self._cursor = index
+
+    def _reject(self, reason: str, end: int, detail: str = ""):
+        self._advance(self._rec_start)
+        self.quarantine.add(reason, self._line, self._bytes, self._buf[self._rec_start:end], detail)
+
+    def _reset_record(self, start: int):
+        self._current = []
+        self._parts = []
+        self._field_len = 0
+        self._inside = False
+        self._rec_start = start
+
+    def _emit(self, rows: list, end: int):
+        field = ''.join(self._parts)
+        current = self._current
+        if field or len(current) > 0:
+            current.append(field.strip())
+            if any(current):
+                if self.expected_fields is None:
+                    self.expected_fields = len(current)
+                    rows.append(current)
+                elif len(current) != self.expected_fields:
+                    self._reject("field_count", end, f"expected {self.expected_fields} fields, found {len(current)}")
+                else:
+                    rows.append(current)
+
+    def _seek(self, final: bool) -> bool:
+        """Move to the resync line after a bad record; False if more input is needed"""
+        buf = self._buf
+        while True:
+            nl = buf.find('\n', self._pos)
+            if nl == -1:
+                self._pos = len(buf)
+                return False
+            start = nl + 1
+            if self.resync_pattern is not None:
+                line_end = buf.find('\n', start)
+                if line_end == -1 and not final:
+                    self._pos = nl
+                    return False
+                if not self.resync_pattern.match(buf, start, line_end if line_end != -1 else len(buf)):
+                    self._pos = start
+                    continue
+            self._pos = start
+            self._reset_record(start)
+            self._seeking = False
+            return True
+
+    def _bad_record(self, reason: str, detail: str = ""):
+        self._reject(reason, self._pos, detail)
+        self._seeking = True
+        self._pos = self._rec_start
+
+    def feed(self, text: str, final: bool = False) -> list:
+        """Parse a chunk of text and return the valid rows it completed"""
+        self._buf += text
+        buf = self._buf
+        n = len(buf)
+        rows = []
+        while True:
+            if self._seeking and not self._seek(final):
+                break
+            pos = self._pos
+            if pos >= n:
+                if final and self._inside:
+                    self._bad_record("unterminated_quote", "quote still open at end of input")
+                    continue
+                break
+
+            if self._inside:
+                j = buf.find('"', pos)
+                if j == -1:
+                    self._parts.append(buf[pos:])
+                    self._field_len += n - pos
+                    self._pos = n
+                elif j + 1 < n:
+                    self._parts.append(buf[pos:j])
+                    self._field_len += j - pos
+                    if buf[j + 1] == '"':
+                        self._parts.append('"')
+                        self._field_len += 1
+                        self._pos = j + 2
+                    else:
+                        self._inside = False
+                        self._pos = j + 1
+                elif final:
+                    self._parts.append(buf[pos:j])
+                    self._field_len += j - pos
+                    self._inside = False
+                    self._pos = n
+                else:
+                    # Wait for the next chunk to tell a closing quote from an escaped ""
+                    self._parts.append(buf[pos:j])
+                    self._field_len += j - pos
+                    self._pos = j
+                    self._check_caps()
+                    break
+            else:
+                match = _CSV_SPECIAL.search(buf, pos)
+                j = match.start() if match else n
+                if j > pos:
+                    self._parts.append(buf[pos:j])
+                    self._field_len += j - pos
+                if match is None:
+                    self._pos = n
+                else:
+                    char = buf[j]
+                    self._pos = j + 1
+                    if char == '"':
+                        self._inside = True
+                    elif char == ',':
+                        self._current.append(''.join(self._parts).strip())
+                        self._parts = []
+                        self._field_len = 0
+                    else:
+                        self._emit(rows, j)
+                        if char == '\r' and j + 1 < n and buf[j + 1] == '\n':
+                            self._pos = j + 2
+                        self._reset_record(self._pos)
+                        continue
+            self._check_caps()
+
+        if final and not self._seeking:
+            self._emit(rows, n)
+            self._reset_record(n)
+        self._trim()
+        return rows
+
+    def _check_caps(self):
+        if self._seeking:
+            return
+        if self._field_len > self.max_field_size:
+            reason = "unterminated_quote" if self._inside else "field_too_large"
+            self._bad_record(reason, f"field exceeded {self.max_field_size:,} characters")
+        elif self._pos - self._rec_start > self.max_record_size:
+            self._bad_record("record_too_large", f"record exceeded {self.max_record_size:,} characters")
+
+    def _trim(self):
+        """Drop text before the current record (or resync point) from the buffer"""
+        cut = self._pos if self._seeking else self._rec_start
+        if cut <= 0:
+            return
+        self._advance(cut)
+        self._buf = self._buf[cut:]
+        self._pos -= cut
+        self._rec_start = max(0, self._rec_start - cut)
+        self._cursor = 0
+
+    def close(self) -> list:
+        """Flush the final record"""
+        return self.feed('', final=True)
+
+def classify_dataset(filename: str, headers: list, data: list) -> dict:
+    """Detect dataset type"""
+    first_col = [row[0] if len(row) > 0 else '' for row in data]
+    youtube_count = sum(1 for val in first_col if 'YouTube' in str(val))
+    return classify_from_counts(filename, headers, len(data), youtube_count)
+
+def classify_from_counts(filename: str, headers: list, rows_count: int, youtube_count: int) -> dict:
+    """Detect dataset type from the filename and a running count of YouTube rows"""
+    name = filename.lower()
+    dataset_type = "📊 Generic Dataset"
+    confidence = 0
+    
+    if 'youtube' in name or 'myactivity' in name:
+        dataset_type = '🎥 YouTube Activity History'
+        confidence = 95
+    elif 'netflix' in name:
+        dataset_type = '📺 Netflix Viewing History'
+        confidence = 90
+    elif 'amazon' in name or 'orders' in name:
+        dataset_type = '🛒 E-commerce Orders'
+        confidence = 85
+    elif 'spotify' in name or 'music' in name:
+        dataset_type = '🎵 Music Streaming Activity'
+        confidence = 90
+    elif 'fitness' in name or 'health' in name:
+        dataset_type = '🏃 Fitness Data'
+        confidence = 85
+    elif 'bank' in name or 'transaction' in name:
+        dataset_type = '💳 Financial Transactions'
+        confidence = 80
+    
+    if headers and rows_count > 0:
+        if youtube_count > rows_count * 0.5:
+            dataset_type = '🎥 YouTube Activity History'
+            confidence = 98
+    
+    return {"type": dataset_type, "confidence": confidence}
+
+def calculate_quality_score(rows_count: int, nulls_count: int, columns_count: int, rule_results: list = None) -> int:
+    """Calculate quality score (0-100).
+
+    With rule results, the fixed diversity and freshness points are replaced by
+    RULE_SCORE_POINTS scaled by the weighted pass rate of the evaluated rules.
+    """
+    score = 0
+    total_cells = rows_count * columns_count if columns_count > 0 else 1
+    null_percent = (nulls_count / total_cells) * 100 if total_cells > 0 else 0
+    completeness = max(0, 100 - null_percent)
+    score += (completeness / 100) * 35
+    size_score = min(25, (rows_count / 100) * 5)
+    score += size_score
+    rate = weighted_pass_rate(rule_results) if rule_results else None
+    if rate is None:
+        score += 20  # Diversity
+        score += 18  # Freshness
+    else:
+        score += rate * RULE_SCORE_POINTS
+    return round(score)
+
+# Data-quality rules
+def validate_rules(rules) -> list:
+    """Check a declarative rule list, raising ValueError on the first problem"""
+    if not isinstance(rules, list):
+        raise ValueError("Rules must be a list")
+    names = set()
+    for i, rule in enumerate(rules):
+        label = f"Rule {i + 1}"
+        if not isinstance(rule, dict):
+            raise ValueError(f"{label} must be an object")
+        kind = rule.get('type')
+        if kind not in RULE_TYPES:
+            raise ValueError(f"{label}: type must be one of {', '.join(RULE_TYPES)}")
+        name = rule.setdefault('name', f"{kind} {rule.get('column', '')}".strip())
+        if name in names:
+            raise ValueError(f"{label}: duplicate name '{name}'")
+        names.add(name)
+        if not isinstance(rule.get('weight', 1), (int, float)) or rule.get('weight', 1) < 0:
+            raise ValueError(f"{label}: weight must be a non-negative number")
+        conditions = [rule.get('when'), rule.get('then')] if kind == 'cross' else [rule]
+        for condition in conditions:
+            if not isinstance(condition, dict) or not condition.get('column'):
+                raise ValueError(f"{label}: every condition needs a column")
+        if kind == 'regex' and 'pattern' not in rule:
+            raise ValueError(f"{label}: regex rules need a pattern")
+        if kind == 'enum' and not isinstance(rule.get('values'), list):
+            raise ValueError(f"{label}: enum rules need a values list")
+        if kind == 'cross':
+            for condition in conditions:
+                if not any(k in condition for k in ('regex', 'values', 'not_null')):
+                    raise ValueError(f"{label}: cross conditions need regex, values or not_null")
+        for pattern in [c.get('pattern', c.get('regex')) for c in conditions]:
+            if pattern is not None:
+                try:
+                    re.compile(pattern)
+                except re.error as e:
+                    raise ValueError(f"{label}: bad pattern ({e})")
+    return rules
+
+def weighted_pass_rate(rule_results: list):
+    """Weight-averaged pass rate (0-1) of the rules that saw any rows, or None"""
+    scored = [r for r in rule_results if r['evaluated'] > 0 and r['weight'] > 0]
+    total = sum(r['weight'] for r in scored)
+    if not total:
+        return None
+    return sum(r['weight'] * r['passed'] / r['evaluated'] for r in scored) / total
+
+def _null_mask(values: pd.Series) -> np.ndarray:
+    return (values.isna() | values.isin(('', 'null'))).to_numpy()
+
+def _condition_mask(values: pd.Series, condition: dict) -> np.ndarray:
+    """Rows matching a cross-column condition"""
+    mask = ~_null_mask(values)
+    if 'regex' in condition:
+        mask &= values.str.contains(condition['regex'], regex=True, na=False).to_numpy()
+    if 'values' in condition:
+        mask &= values.isin(condition['values']).to_numpy()
+    return mask
+
+class RuleEngine:
+    """Evaluates declarative data-quality rules as vectorized masks.
+
+    Each rule becomes one boolean mask per batch of rows. Like
+    StatsAccumulator, engines fed separate runs of rows from the same file can
+    be merged in file order.
+
+    A unique rule passes one row per distinct value. It tracks value hashes
+    exactly up to exact_limit distinct values; past that only a HyperLogLog
+    is kept, the pass count becomes an estimate, and only repeats within a
+    batch show up in the failing-row sample.
+    """
+
+    def __init__(self, rules: list, sample_size: int = RULE_SAMPLE_SIZE, exact_limit: int = RULE_UNIQUE_EXACT_LIMIT):
+        self.rules = rules
+        self.headers = None
+        self.sample_size = sample_size
+        self.exact_limit = exact_limit
+        self.evaluated = [0] * len(rules)
+        self.passed = [0] * len(rules)
+        unique = [i for i, rule in enumerate(rules) if rule['type'] == 'unique']
+        self.seen = {i: set() for i in unique}  # None once past exact_limit
+        self.distinct = {i: HyperLogLog() for i in unique}
+        self.failures = [[] for _ in rules]
+        self.row_offset = 0
+
+    def update(self, rows: list, frame: pd.DataFrame, headers: list):
+        """Evaluate one batch; frame is None when the column names are unknown"""
+        if frame is not None:
+            self.headers = headers
+            self._evaluate(rows, frame)
+        self.row_offset += len(rows)
+
+    def _column(self, frame: pd.DataFrame, name: str):
+        if name not in self.headers:
+            return None
+        i = self.headers.index(name)
+        if i < frame.shape[1]:
+            return frame[i]
+        return pd.Series([None] * len(frame), dtype=object)
+
+    def _evaluate(self, rows: list, frame: pd.DataFrame):
+        for i, rule in enumerate(self.rules):
+            masks = self._masks(i, rule, frame)
+            if masks is None:
+                continue
+            evaluated, passed = masks
+            self.evaluated[i] += int(evaluated.sum())
+            self.passed[i] += int((evaluated & passed).sum())
+            room = self.sample_size - len(self.failures[i])
+            if room > 0:
+                for r in np.flatnonzero(evaluated & ~passed)[:room]:
+                    self.failures[i].append({
+                        "row": self.row_offset + int(r) + 1,
+                        "rule": rule['name'],
+                        "values": dict(zip(self.headers, rows[r])),
+                    })
+
+    def _masks(self, i: int, rule: dict, frame: pd.DataFrame):
+        """(evaluated, passed) boolean arrays for one rule, or None if a column is missing"""
+        kind = rule['type']
+        if kind == 'cross':
+            when = self._column(frame, rule['when']['column'])
+            then = self._column(frame, rule['then']['column'])
+            if when is None or then is None:
+                return None
+            return _condition_mask(when, rule['when']), _condition_mask(then, rule['then'])
+
+        values = self._column(frame, rule['column'])
+        if values is None:
+            return None
+        present = ~_null_mask(values)
+        if kind == 'not_null':
+            return np.ones(len(frame), dtype=bool), present
+        if kind == 'regex':
+            return present, values.str.contains(rule['pattern'], regex=True, na=False).to_numpy()
+        if kind == 'enum':
+            return present, values.isin(rule['values']).to_numpy()
+        if kind == 'range':
+            if rule.get('format'):
+                parsed = pd.to_datetime(values, format=rule['format'], errors='coerce')
+                bound = lambda v: pd.Timestamp(pd.to_datetime(v, format=rule['format']))
+            else:
+                parsed = pd.to_numeric(values, errors='coerce')
+                bound = float
+            passed = parsed.notna()
+            if rule.get('min') is not None:
+                passed &= parsed >= bound(rule['min'])
+            if rule.get('max') is not None:
+                passed &= parsed <= bound(rule['max'])
+            return present, passed.to_numpy()
+        # unique: the first occurrence of each value passes
+        hashes = pd.util.hash_pandas_object(values[present], index=False).to_numpy()
+        first = ~pd.Series(hashes).duplicated().to_numpy()
+        self.distinct[i].add(hashes)
+        seen = self.seen[i]
+        if seen is not None:
+            for j, h in enumerate(hashes.tolist()):
+                if first[j] and h in seen:
+                    first[j] = False
+            seen.update(hashes.tolist())
+            if len(seen) > self.exact_limit:
+                self.seen[i] = None
+        passed = np.zeros(len(frame), dtype=bool)
+        passed[present] = first
+        return present, passed
+
+    def merge(self, other: "RuleEngine"):
+        """Fold in the results of the rows that follow this engine's rows"""
+        for i in range(len(self.rules)):
+            self.evaluated[i] += other.evaluated[i]
+            self.passed[i] += other.passed[i]
+            if i in self.seen:
+                self.distinct[i].merge(other.distinct[i])
+                if self.seen[i] is None or other.seen[i] is None:
+                    self.seen[i] = None
+                else:
+                    self.seen[i] |= other.seen[i]
+                    if len(self.seen[i]) > self.exact_limit:
+                        self.seen[i] = None
+            room = self.sample_size - len(self.failures[i])
+            for failure in other.failures[i][:max(room, 0)]:
+                self.failures[i].append({**failure, "row": failure['row'] + self.row_offset})
+        self.row_offset += other.row_offset
+
+    def failure_sample(self) -> list:
+        """Up to sample_size failing rows per rule, in file order"""
+        return sorted((f for failures in self.failures for f in failures), key=lambda f: f['row'])
+
+    def _passed(self, i: int) -> tuple:
+        """(passed rows, relative standard error) of one rule"""
+        if i not in self.seen:
+            return self.passed[i], 0.0
+        if self.seen[i] is not None:
+            return len(self.seen[i]), 0.0
+        distinct = self.distinct[i]
+        return min(self.evaluated[i], round(distinct.count())), distinct.error()
+
+    def results(self) -> list:
+        results = []
+        for i, rule in enumerate(self.rules):
+            passed, error = self._passed(i)
+            results.append({
+                "name": rule['name'],
+                "type": rule['type'],
+                "column": rule.get('column') or f"{rule['when']['column']} → {rule['then']['column']}",
+                "weight": rule.get('weight', 1),
+                "evaluated": self.evaluated[i],
+                "passed": passed,
+                "pass_rate": round(passed / self.evaluated[i] * 100, 1) if self.evaluated[i] else None,
+                "approximate": error > 0,
+                "error": error,
+            })
+        return results
+
+# Data preview
+class SegmentWriter:
+    """Appends parsed batches to one Arrow IPC segment file of the preview store"""
+
+    def __init__(self, directory: str, width: int):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"segment-{uuid.uuid4().hex}.arrow")
+        self.width = width
+        self.schema = pa.schema([(f"c{i}", pa.string()) for i in range(width)])
+        self.writer = pa.ipc.new_file(self.path, self.schema)
+
+    def write(self, frame: pd.DataFrame):
+        missing = pa.nulls(len(frame), pa.string())
+        arrays = [
+            pa.array(frame[i], type=pa.string(), from_pandas=True) if i < frame.shape[1] else missing
+            for i in range(self.width)
+        ]
+        self.writer.write_batch(pa.record_batch(arrays, schema=self.schema))
+
+    def close(self) -> str:
+        self.writer.close()
+        return self.path
+
+# Text search
+def tokenize(values: pd.Series) -> pd.Series:
+    """Lower-cased word tokens of each value, as lists"""
+    return values.astype(object).fillna('').astype(str).str.lower().str.findall(TEXT_TOKEN_PATTERN)
+
+class TextIndexWriter:
+    """Builds the inverted index of one text column for one preview segment.
+
+    Postings are (row, token position) pairs grouped by term, with rows
+    counted from the start of the segment. Every TEXT_CHUNK_ROWS rows the
+    chunk is sorted by term and written as .npy files beside the segment, so
+    searches can memory-map them.
+    """
+
+    def __init__(self, directory: str, segment: str):
+        self.directory = directory
+        self.segment = segment
+        self.rows = 0
+        self.chunks = []
+        self._reset()
+
+    def _reset(self):
+        self._tokens, self._rows, self._positions = [], [], []
+        self._chunk_rows = 0
+
+    def add(self, values: pd.Series):
+        tokens = tokenize(values)
+        counts = tokens.str.len().to_numpy()
+        total = int(counts.sum())
+        if total:
+            starts = np.repeat(np.cumsum(counts) - counts, counts)
+            self._tokens.append(np.fromiter(itertools.chain.from_iterable(tokens), dtype=object, count=total))
+            self._rows.append(np.repeat(np.arange(self.rows, self.rows + len(values), dtype=np.uint32), counts))
+            self._positions.append((np.arange(total) - starts).astype(np.uint32))
+        self.rows += len(values)
+        self._chunk_rows += len(values)
+        if self._chunk_rows >= TEXT_CHUNK_ROWS:
+            self._write()
+
+    def _write(self):
+        if self._tokens:
+            codes, uniques = pd.factorize(np.concatenate(self._tokens))
+            # Truncating long tokens can make two terms equal, so factorize again
+            truncated, terms = pd.factorize(np.asarray(uniques, dtype=f"U{TEXT_MAX_TOKEN}"))
+            codes = truncated[codes]
+            terms = np.asarray(terms, dtype=f"U{TEXT_MAX_TOKEN}")
+            by_term = np.argsort(terms)
+            rank = np.empty_like(by_term)
+            rank[by_term] = np.arange(len(by_term))
+            codes = rank[codes]
+            # Stable, so postings stay in row and position order within a term
+            order = np.argsort(codes, kind='stable')
+            path = os.path.join(self.directory, f"text-{uuid.uuid4().hex}")
+            np.save(f"{path}.terms.npy", terms[by_term])
+            np.save(f"{path}.offsets.npy", np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(terms)))]))
+            np.save(f"{path}.rows.npy", np.concatenate(self._rows)[order])
+            np.save(f"{path}.pos.npy", np.concatenate(self._positions)[order])
+            self.chunks.append({"segment": self.segment, "path": path})
+        self._reset()
+
+    def close(self) -> list:
+        self._write()
+        return self.chunks
+
+def _dedupe_sorted(values: np.ndarray) -> np.ndarray:
+    values = np.asarray(values)
+    if len(values) < 2:
+        return values
+    return values[np.concatenate([[True], values[1:] != values[:-1]])]
+
+def _union_rows(rows: np.ndarray) -> np.ndarray:
+    """Sorted distinct row ids, marked in a bitmap instead of sorted"""
+    if not len(rows):
+        return np.asarray(rows)
+    low = int(rows.min())
+    seen = np.zeros(int(rows.max()) - low + 1, dtype=bool)
+    seen[rows - low] = True
+    return np.flatnonzero(seen) + low
+
+def _intersect_sorted(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Intersection of two ascending unique arrays.
+
+    A small side is binary-searched in the large one; dense arrays of
+    similar size go through a lookup table over the value range instead.
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    if not len(a):
+        return a
+    if len(a) * 16 >= len(b) and int(b[-1]) - int(b[0]) <= 8 * len(b):
+        return a[np.isin(a, b, kind='table')]
+    at = np.minimum(np.searchsorted(b, a), len(b) - 1)
+    return a[b[at] == a]
+
+_SEARCH_CLAUSE = re.compile(r'"([^"]*)"|(\S+)')
+
+def parse_search(query: str) -> list:
+    """Split a query into ("term" | "prefix" | "phrase", tokens) clauses.
+
+    Bare words are terms, words ending in * are prefixes and "quoted text"
+    is a phrase; words that tokenize into several tokens become phrases.
+    """
+    clauses = []
+    for match in _SEARCH_CLAUSE.finditer(query or ''):
+        text = match.group(1) if match.group(1) is not None else match.group(2)
+        prefix = match.group(1) is None and text.endswith('*')
+        tokens = [t[:TEXT_MAX_TOKEN] for t in re.findall(TEXT_TOKEN_PATTERN, text.lower())]
+        if not tokens:
+            continue
+        if len(tokens) > 1:
+            clauses.append(("phrase", tokens))
+        else:
+            clauses.append(("prefix" if prefix and len(tokens[0]) < TEXT_MAX_TOKEN else "term", tokens))
+    return clauses
+
+class TextIndex:
+    """Term, prefix and phrase search over the chunks of a run's inverted index"""
+
+    def __init__(self, text: dict, segment_starts: dict):
+        self.column = text['column']
+        self.chunks = []
+        for chunk in text['chunks']:
+            arrays = [np.load(f"{chunk['path']}.{part}.npy", mmap_mode='r') for part in ("terms", "offsets", "rows", "pos")]
+            self.chunks.append((segment_starts[chunk['segment']], *arrays))
+
+    @staticmethod
+    def _postings(chunk: tuple, first: str, last: str = None) -> tuple:
+        """(rows, positions) of the terms between first and last (or equal to first)"""
+        _, terms, offsets, rows, positions = chunk
+        lo = np.searchsorted(terms, first, side='left')
+        hi = np.searchsorted(terms, last if last is not None else first, side='right')
+        return rows[offsets[lo]:offsets[hi]], positions[offsets[lo]:offsets[hi]]
+
+    def _clause(self, kind: str, tokens: list) -> np.ndarray:
+        found = []
+        for chunk in self.chunks:
+            if kind == "phrase":
+                keys = None
+                for k, token in enumerate(tokens):
+                    rows, positions = self._postings(chunk, token)
+                    valid = positions >= k
+                    # Postings are in (row, position) order, so the shifted keys stay sorted
+                    shifted = (rows[valid].astype(np.uint64) << np.uint64(32)) | (positions[valid].astype(np.uint64) - np.uint64(k))
+                    keys = shifted if keys is None else _intersect_sorted(keys, shifted)
+                rows = _dedupe_sorted(keys >> np.uint64(32))
+            elif kind == "prefix":
+                rows = _union_rows(self._postings(chunk, tokens[0], tokens[0] + "\U0010ffff")[0])
+            else:
+                rows = _dedupe_sorted(self._postings(chunk, tokens[0])[0])
+            found.append(rows.astype(np.int64) + chunk[0])
+        # Chunks cover ascending, disjoint row ranges
+        return np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+
+    def search(self, query: str) -> np.ndarray:
+        """Ascending row ids matching every clause of the query"""
+        result = None
+        for kind, tokens in parse_search(query):
+            rows = self._clause(kind, tokens)
+            result = rows if result is None else _intersect_sorted(result, rows)
+            if not len(result):
+                break
+        return result if result is not None else np.empty(0, dtype=np.int64)
+
+class PreviewStore:
+    """Server-side pages over the segment files written by a parse job.
+
+    Segments are memory-mapped, so a page in file order is a zero-copy slice
+    and a sorted or filtered page gathers only its own rows. The row order for
+    a sort/filter combination is computed once and kept in a small LRU.
+    """
+
+    def __init__(self, preview: dict):
+        self.columns = preview['columns']
+        self.batches = []
+        segment_starts = {}
+        for path in preview['segments']:
+            segment_starts[path] = sum(batch.num_rows for batch in self.batches)
+            reader = pa.ipc.open_file(pa.memory_map(path))
+            self.batches.extend(reader.get_batch(k) for k in range(reader.num_record_batches))
+        self.offsets = np.cumsum([0] + [batch.num_rows for batch in self.batches])
+        self.rows = int(self.offsets[-1])
+        self.text = TextIndex(preview['text'], segment_starts) if preview.get('text') else None
+        self._orders = OrderedDict()
+
+    def column(self, j: int):
+        return pa.chunked_array([batch.column(j) for batch in self.batches], type=pa.string())
+
+    def _sort_indices(self, j: int, descending: bool) -> np.ndarray:
+        values = self.column(j)
+        blank = pc.fill_null(pc.equal(values, ''), True)
+        try:
+            # Sort numerically when every non-blank value is a number
+            values = pc.cast(pc.if_else(blank, pa.scalar(None, pa.string()), values), pa.float64())
+        except pa.ArrowInvalid:
+            pass
+        order = "descending" if descending else "ascending"
+        return pc.array_sort_indices(values, order=order, null_placement="at_end").to_numpy().astype(np.int64)
+
+    def order(self, sort_column: int = None, descending: bool = False,
+              filter_column: int = None, filter_text: str = "", search: str = "") -> np.ndarray:
+        """Row ids in display order, or None for file order without a filter"""
+        search = search if self.text is not None else ""
+        key = (sort_column, descending, filter_column, filter_text, search)
+        if key in self._orders:
+            self._orders.move_to_end(key)
+            return self._orders[key]
+        if sort_column is None and not filter_text and not search:
+            return None
+        order = self._sort_indices(sort_column, descending) if sort_column is not None else None
+        mask = None
+        if filter_text:
+            matches = pc.fill_null(pc.match_substring(self.column(filter_column), filter_text, ignore_case=True), False)
+            mask = np.asarray(matches.to_numpy(zero_copy_only=False), dtype=bool)
+        if search:
+            hits = np.zeros(self.rows, dtype=bool)
+            hits[self.text.search(search)] = True
+            mask = hits if mask is None else mask & hits
+        if mask is not None:
+            order = order[mask[order]] if order is not None else np.flatnonzero(mask)
+        self._orders[key] = order
+        if len(self._orders) > PREVIEW_ORDER_CACHE:
+            self._orders.popitem(last=False)
+        return order
+
+    def _take(self, ids: np.ndarray) -> pa.Table:
+        """Gather global row ids, touching only the batches that hold them"""
+        owner = np.searchsorted(self.offsets, ids, side='right') - 1
+        pieces, positions = [], []
+        for b in np.unique(owner):
+            picked = np.flatnonzero(owner == b)
+            local = (ids[picked] - self.offsets[b]).astype(np.int64)
+            pieces.append(pa.Table.from_batches([self.batches[b].take(pa.array(local))]))
+            positions.append(picked)
+        if not pieces:
+            return pa.Table.from_batches([], schema=self.batches[0].schema) if self.batches else pa.table({})
+        table = pa.concat_tables(pieces)
+        return table.take(pa.array(np.argsort(np.concatenate(positions))))
+
+    def chart_rows(self, ids: np.ndarray) -> dict:
+        """Chart aggregates over a subset of rows, such as search results"""
+        charts = ChartAccumulator()
+        for start in range(0, len(ids), FRAME_BATCH_ROWS):
+            frame = self._take(ids[start:start + FRAME_BATCH_ROWS]).to_pandas()
+            frame.columns = range(frame.shape[1])
+            charts.update(frame.astype(object), self.columns)
+        return charts.result(self.columns)
+
+    def page(self, number: int, size: int, **order) -> tuple:
+        """Return (page DataFrame with 1-based row numbers as index, matching row count)"""
+        ids = self.order(**order)
+        total = self.rows if ids is None else len(ids)
+        start = max(0, min(number, max(0, (total - 1) // size))) * size
+        if ids is None:
+            ids = np.arange(start, min(start + size, total))
+        else:
+            ids = ids[start:start + size]
+        frame = self._take(ids).to_pandas() if len(ids) else pd.DataFrame(columns=[f"c{i}" for i in range(len(self.columns))])
+        frame.columns = self.columns
+        frame.index = pd.Index(ids + 1, name="row")
+        return frame, total
+
+# Streaming sketches
+def hash_values(values) -> np.ndarray:
+    """64-bit hashes that are the same in every process, so sketches built by workers merge"""
+    return pd.util.hash_array(np.asarray(values, dtype=object), categorize=False)
+
+class CountMinSketch:
+    """Per-value counts in fixed memory.
+
+    Estimates never undercount, and with probability 1 - e^-depth each one
+    overcounts by at most error() rows. Sketches of the same shape merge by
+    adding their tables.
+    """
+
+    def __init__(self, width: int = SKETCH_WIDTH, depth: int = SKETCH_DEPTH):
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self.total = 0
+
+    def _cells(self, hashes: np.ndarray) -> np.ndarray:
+        # Derive one column per row from the two halves of the hash
+        depth, width = self.table.shape
+        low = hashes & np.uint64(0xFFFFFFFF)
+        high = (hashes >> np.uint64(32)) | np.uint64(1)
+        rows = np.arange(depth, dtype=np.uint64)[:, None]
+        return ((low + rows * high) % np.uint64(width)).astype(np.intp)
+
+    def add(self, hashes: np.ndarray, counts: np.ndarray):
+        width = self.table.shape[1]
+        for row, cells in enumerate(self._cells(hashes)):
+            self.table[row] += np.bincount(cells, weights=counts, minlength=width).astype(np.int64)
+        self.total += int(counts.sum())
+
+    def estimate(self, hashes: np.ndarray) -> np.ndarray:
+        cells = self._cells(hashes)
+        return self.table[np.arange(len(cells))[:, None], cells].min(axis=0)
+
+    def error(self) -> int:
+        return int(np.e / self.table.shape[1] * self.total)  # counts are whole, so the bound rounds down
+
+    def merge(self, other: "CountMinSketch"):
+        self.table += other.table
+        self.total += other.total
+
+class HyperLogLog:
+    """Distinct-value count in 2^precision bytes; merging takes the register-wise max"""
+
+    def __init__(self, precision: int = SKETCH_HLL_PRECISION):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add(self, hashes: np.ndarray):
+        p = self.precision
+        index = (hashes >> np.uint64(64 - p)).astype(np.intp)
+        rest = hashes & np.uint64((1 << (64 - p)) - 1)
+        # Rank is the position of the first 1 bit in the remaining 64 - p bits;
+        # they fit a float exactly, so frexp gives their bit length
+        _, length = np.frexp(rest.astype(np.float64))
+        np.maximum.at(self.registers, index, (64 - p + 1 - length).astype(np.uint8))
+
+    def count(self) -> float:
+        m = len(self.registers)
+        raw = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.exp2(-self.registers.astype(float)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            return float(m * np.log(m / zeros))  # linear counting while many registers are empty
+        return float(raw)
+
+    def error(self) -> float:
+        """Relative standard error of count()"""
+        return float(1.04 / np.sqrt(len(self.registers)))
+
+    def merge(self, other: "HyperLogLog"):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+class HeavyHitters:
+    """Top values of one column: Count-Min counts, a bounded candidate set and a distinct count.
+
+    After each batch the candidates are the values with the highest estimated
+    counts among the previous candidates and the batch's own values.
+    """
+
+    def __init__(self, capacity: int = SKETCH_CANDIDATES):
+        self.capacity = capacity
+        self.counts = CountMinSketch()
+        self.distinct = HyperLogLog()
+        self.values = np.empty(0, dtype=object)
+        self.hashes = np.empty(0, dtype=np.uint64)
+
+    def update(self, value_counts: pd.Series):
+        values = value_counts.index.to_numpy(dtype=object)
+        hashes = hash_values(values)
+        self.counts.add(hashes, value_counts.to_numpy(dtype=float))
+        self.distinct.add(hashes)
+        self._keep(np.concatenate([self.values, values]), np.concatenate([self.hashes, hashes]))
+
+    def _keep(self, values: np.ndarray, hashes: np.ndarray):
+        hashes, first = np.unique(hashes, return_index=True)
+        values = values[first]
+        if len(values) > self.capacity:
+            keep = np.argpartition(-self.counts.estimate(hashes), self.capacity)[:self.capacity]
+            values, hashes = values[keep], hashes[keep]
+        self.values, self.hashes = values, hashes
+
+    def merge(self, other: "HeavyHitters"):
+        self.counts.merge(other.counts)
+        self.distinct.merge(other.distinct)
+        self._keep(np.concatenate([self.values, other.values]), np.concatenate([self.hashes, other.hashes]))
+
+    def top(self, n: int) -> list:
+        """[{"value", "count", "low"}] for the n largest estimates; the true count lies in [low, count]"""
+        estimates = self.counts.estimate(self.hashes)
+        error = self.counts.error()
+        ranked = sorted(zip(self.values.tolist(), estimates.tolist()), key=lambda item: (-item[1], str(item[0])))
+        return [{"value": value, "count": count, "low": max(0, count - error)} for value, count in ranked[:n]]
+
+# Pre-aggregated charts
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """Indices of the points kept by Largest-Triangle-Three-Buckets downsampling"""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    every = (n - 2) / (threshold - 2)
+    keep = [0]
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(area.argmax())
+        keep.append(a)
+    keep.append(n - 1)
+    return np.array(keep)
+
+def _coarsen(bins: Counter, factor: int) -> Counter:
+    coarse = Counter()
+    for k, count in bins.items():
+        coarse[k // factor] += count
+    return coarse
+
+def _numeric_exp(lo: float, hi: float) -> int:
+    """Smallest power-of-two bin width exponent that covers [lo, hi] in CHART_NUMERIC_BINS bins"""
+    exp = int(np.ceil(np.log2((hi - lo) / CHART_NUMERIC_BINS))) if hi > lo else 0
+    while np.floor(hi / 2.0 ** exp) - np.floor(lo / 2.0 ** exp) >= CHART_NUMERIC_BINS:
+        exp += 1
+    return exp
+
+def _fit_numeric(hist: dict) -> dict:
+    """Coarsen the bins to the width the observed range needs.
+
+    Bins are aligned to multiples of their width, so the result depends only
+    on the values seen, not on how they were split into batches.
+    """
+    exp = max(hist['exp'], _numeric_exp(hist['lo'], hist['hi']))
+    if exp > hist['exp']:
+        hist['bins'] = _coarsen(hist['bins'], 2 ** (exp - hist['exp']))
+        hist['exp'] = exp
+    return hist
+
+class ChartAccumulator:
+    """Fixed-size, mergeable aggregates behind the Data Analysis charts.
+
+    Per column: value lengths in power-of-two bins, a numeric histogram on
+    power-of-two-wide bins (dropped once a non-numeric value shows up) and
+    heavy-hitter and distinct-count sketches for the top-values chart. The
+    Date column is counted per hour. Nothing here grows with the row count.
+    """
+
+    def __init__(self, date_column: str = CHART_DATE_COLUMN, date_format: str = YOUTUBE_DATE_FORMAT):
+        self.date_column = date_column
+        self.date_format = date_format
+        self.lengths = {}
+        self.numeric = {}
+        self.top = {}
+        self.hours = Counter()
+        self.dates_unparsed = 0
+
+    def update(self, frame: pd.DataFrame, headers: list):
+        value_counts = {}
+        for i in range(min(frame.shape[1], len(headers), CHART_MAX_COLUMNS)):
+            values = frame[i]
+            present = values[~_null_mask(values)]
+            if present.empty:
+                continue
+            lengths = present.str.len().to_numpy()
+            bins = np.minimum(np.floor(np.log2(lengths)).astype(int), CHART_LENGTH_BINS - 1)
+            self.lengths[i] = self.lengths.get(i, 0) + np.bincount(bins, minlength=CHART_LENGTH_BINS)
+
+            value_counts[i] = present.value_counts()
+            self.top.setdefault(i, HeavyHitters()).update(value_counts[i])
+
+            if self.numeric.get(i, {}) is not None:
+                numbers = pd.to_numeric(present, errors='coerce').to_numpy(dtype=float)
+                if np.isnan(numbers).any():
+                    self.numeric[i] = None
+                else:
+                    self._add_numeric(i, numbers[np.isfinite(numbers)])
+
+        if self.date_column in headers and headers.index(self.date_column) < frame.shape[1]:
+            i = headers.index(self.date_column)
+            if i not in value_counts:
+                dates = frame[i]
+                value_counts[i] = dates[~_null_mask(dates)].value_counts()
+            # Exports repeat timestamps, so parse each distinct value once
+            counts = value_counts[i]
+            parsed = pd.to_datetime(counts.index.to_series(), format=self.date_format, errors='coerce')
+            valid = parsed.notna().to_numpy()
+            self.dates_unparsed += int(counts[~valid].sum())
+            hours = (parsed[valid] - pd.Timestamp(0)) // pd.Timedelta(hours=1)
+            self.hours.update(pd.Series(counts.to_numpy()[valid]).groupby(hours.to_numpy()).sum().to_dict())
+
+    def _add_numeric(self, i: int, numbers: np.ndarray):
+        if not len(numbers):
+            return
+        lo, hi = float(numbers.min()), float(numbers.max())
+        hist = self.numeric.setdefault(i, {"exp": _numeric_exp(lo, hi), "bins": Counter(), "lo": lo, "hi": hi})
+        hist['lo'], hist['hi'] = min(hist['lo'], lo), max(hist['hi'], hi)
+        _fit_numeric(hist)
+        index, counts = np.unique(np.floor(numbers / 2.0 ** hist['exp']).astype(np.int64), return_counts=True)
+        hist['bins'].update(dict(zip(index.tolist(), counts.tolist())))
+
+    def merge(self, other: "ChartAccumulator"):
+        for i, counts in other.lengths.items():
+            self.lengths[i] = self.lengths.get(i, 0) + counts
+        for i, top in other.top.items():
+            if i in self.top:
+                self.top[i].merge(top)
+            else:
+                self.top[i] = top
+        for i in set(self.numeric) | set(other.numeric):
+            mine, theirs = self.numeric.get(i, {}), other.numeric.get(i, {})
+            if mine is None or theirs is None:
+                self.numeric[i] = None
+            elif not theirs:
+                continue
+            elif not mine:
+                self.numeric[i] = {**theirs, "bins": Counter(theirs['bins'])}
+            else:
+                exp = max(mine['exp'], theirs['exp'])
+                bins = _coarsen(mine['bins'], 2 ** (exp - mine['exp']))
+                bins.update(_coarsen(theirs['bins'], 2 ** (exp - theirs['exp'])))
+                self.numeric[i] = _fit_numeric({
+                    "exp": exp, "bins": bins, "lo": min(mine['lo'], theirs['lo']), "hi": max(mine['hi'], theirs['hi'])
+                })
+        self.hours.update(other.hours)
+        self.dates_unparsed += other.dates_unparsed
+
+    def _timeline(self):
+        if not self.hours:
+            return None
+        keys = np.array(sorted(self.hours))
+        resolution, step = "hour", 1
+        if keys[-1] - keys[0] > CHART_DAILY_AFTER_HOURS:
+            resolution, step = "day", 24
+        first = keys[0] // step
+        counts = np.zeros(keys[-1] // step - first + 1)
+        for hour, count in self.hours.items():
+            counts[hour // step - first] += count
+        x = np.arange(len(counts), dtype=float)
+        keep = lttb(x, counts, CHART_MAX_POINTS)
+        start = pd.Timestamp(0) + pd.Timedelta(hours=int(first * step))
+        return {
+            "column": self.date_column,
+            "resolution": resolution,
+            "points": [
+                {"time": (start + pd.Timedelta(hours=int(k * step))).isoformat(), "count": int(counts[k])}
+                for k in keep
+            ],
+            "buckets": len(counts),
+            "downsampled": len(keep) < len(counts),
+            "unparsed": self.dates_unparsed,
+        }
+
+    def result(self, headers: list) -> dict:
+        columns = {}
+        for i, name in enumerate(headers[:CHART_MAX_COLUMNS]):
+            if i not in self.lengths:
+                continue
+            lengths = self.lengths[i]
+            top = self.top[i]
+            hist = self.numeric.get(i)
+            numeric = None
+            if hist and hist['bins']:
+                width = 2.0 ** hist['exp']
+                numeric = [
+                    {"start": k * width, "end": (k + 1) * width, "count": hist['bins'].get(k, 0)}
+                    for k in range(min(hist['bins']), max(hist['bins']) + 1)
+                ]
+            columns[name] = {
+                "lengths": [
+                    {"start": 2 ** b, "end": 2 ** (b + 1), "count": int(lengths[b])}
+                    for b in range(int(np.flatnonzero(lengths).min()), int(np.flatnonzero(lengths).max()) + 1)
+                ],
+                "numeric": numeric,
+                "top": top.top(CHART_TOP_N),
+                "top_error": top.counts.error(),
+                "distinct": round(top.distinct.count()),
+                "distinct_error": top.distinct.error(),
+                "approximate": top.counts.error() > 0,
+            }
+        return {"columns": columns, "timeline": self._timeline()}
+
+# Event-time windows
+def validate_windows(windows: dict) -> dict:
+    """Check window settings (minutes), raising ValueError on the first problem"""
+    size, slide = windows.get('size'), windows.get('slide') or windows.get('size')
+    if not isinstance(size, int) or size < 1:
+        raise ValueError("Window size must be a positive number of minutes")
+    if not isinstance(slide, int) or slide < 1 or slide > size or size % slide:
+        raise ValueError("Window slide must divide the window size")
+    if size // slide > WINDOW_MAX_PER_ROW:
+        raise ValueError(f"A row may fall in at most {WINDOW_MAX_PER_ROW} sliding windows")
+    if windows.get('lateness', 0) < 0:
+        raise ValueError("Allowed lateness cannot be negative")
+    if windows.get('order', 'auto') not in ('auto', 'ascending', 'descending'):
+        raise ValueError("Order must be auto, ascending or descending")
+    return {**windows, "slide": slide}
+
+class WindowAggregator:
+    """Tumbling or sliding event-time windows with per-key counts and a watermark.
+
+    Event times are whole minutes. Only windows the watermark has not passed
+    are kept as state, one count array per window indexed by key, so memory
+    follows the number of open windows rather than rows; windows are closed
+    after each batch. Closed windows are emitted into a bounded map that
+    reports the most recent WINDOW_MAX_RESULTS.
+
+    Exports are often newest-first, so the time order is detected from the
+    first batch (or forced with order) and the watermark runs in that
+    direction: ascending input closes windows behind the largest time seen,
+    descending input closes them ahead of the smallest.
+    """
+
+    def __init__(self, size: int, slide: int = None, lateness: int = 0, order: str = "auto",
+                 time_column: str = CHART_DATE_COLUMN, key_column: str = WINDOW_KEY_COLUMN,
+                 date_format: str = YOUTUBE_DATE_FORMAT):
+        self.size = size
+        self.slide = slide or size
+        self.lateness = lateness
+        self.direction = {"ascending": 1, "descending": -1}.get(order)
+        self.time_column = time_column
+        self.key_column = key_column
+        self.date_format = date_format
+        self.keys = {}
+        self.open = {}
+        self.closed = {}
+        self.emitted = 0
+        self.frontier = None
+        self.late_rows = 0
+        self.unparsed = 0
+        self.peak_open = 0
+
+    def _key_index(self, key) -> int:
+        return self.keys.setdefault(key, len(self.keys))
+
+    def _watermark(self, frontier: float) -> float:
+        return frontier - self.direction * self.lateness
+
+    def _is_closed(self, start, watermark):
+        if self.direction > 0:
+            return start + self.size <= watermark
+        return start >= watermark
+
+    def update(self, frame: pd.DataFrame, headers: list):
+        if self.time_column not in headers or headers.index(self.time_column) >= frame.shape[1]:
+            return
+        values = frame[headers.index(self.time_column)]
+        codes, uniques = pd.factorize(values)
+        parsed = pd.to_datetime(pd.Series(uniques, dtype=object), format=self.date_format, errors='coerce')
+        minutes = ((parsed - pd.Timestamp(0)) // pd.Timedelta(minutes=1)).to_numpy(dtype=float, na_value=np.nan)
+        times = np.where(codes >= 0, minutes[np.maximum(codes, 0)], np.nan)
+        parsed_rows = ~np.isnan(times)
+        self.unparsed += int((~parsed_rows).sum())
+
+        if self.key_column in headers and headers.index(self.key_column) < frame.shape[1]:
+            key_values = frame[headers.index(self.key_column)]
+            key_codes, key_uniques = pd.factorize(key_values.where(~_null_mask(key_values), None))
+            index = [self._key_index(k) for k in key_uniques]
+            if (key_codes < 0).any():
+                index.append(self._key_index("(blank)"))  # code -1 picks this trailing slot
+            keys = np.array(index, dtype=np.int64)[key_codes]
+        else:
+            keys = np.full(len(frame), self._key_index("(all)"))
+        times, keys = times[parsed_rows].astype(np.int64), keys[parsed_rows]
+        if not len(times):
+            return
+
+        if self.direction is None:
+            steps = np.diff(times)
+            self.direction = -1 if (steps < 0).sum() > (steps > 0).sum() else 1
+
+        # Watermark in force when each row arrives, from the running extreme before it
+        if self.direction > 0:
+            running = np.maximum.accumulate(times)
+            initial = -np.inf if self.frontier is None else self.frontier
+            before = np.maximum(np.concatenate(([initial], running[:-1])), initial)
+        else:
+            running = np.minimum.accumulate(times)
+            initial = np.inf if self.frontier is None else self.frontier
+            before = np.minimum(np.concatenate(([initial], running[:-1])), initial)
+        watermarks = self._watermark(before)
+
+        first_start = times // self.slide * self.slide
+        late = np.zeros(len(times), dtype=bool)
+        starts, owners = [], []
+        for k in range(self.size // self.slide):
+            start = first_start - k * self.slide
+            closed = self._is_closed(start, watermarks)
+            late |= closed
+            starts.append(start[~closed])
+            owners.append(keys[~closed])
+        self.late_rows += int(late.sum())
+
+        starts, owners = np.concatenate(starts), np.concatenate(owners)
+        if len(starts):
+            width = len(self.keys)
+            base = starts.min()
+            combined, counts = np.unique((starts - base) * width + owners, return_counts=True)
+            for start, key, count in zip((combined // width + base).tolist(), (combined % width).tolist(), counts.tolist()):
+                window = self.open.get(start)
+                if window is None or len(window) < width:
+                    grown = np.zeros(width, dtype=np.int64)
+                    if window is not None:
+                        grown[:len(window)] = window
+                    window = self.open[start] = grown
+                window[key] += count
+        self.peak_open = max(self.peak_open, len(self.open))
+
+        self.frontier = float(running[-1])
+        watermark = self._watermark(self.frontier)
+        for start in [start for start in self.open if self._is_closed(start, watermark)]:
+            self._emit(start, self.open.pop(start))
+
+    def _emit(self, start: int, counts: np.ndarray):
+        self.emitted += 1
+        self.closed[start] = counts
+        if len(self.closed) > 2 * WINDOW_MAX_RESULTS:
+            self._trim()
+
+    def _trim(self):
+        """Keep the newest WINDOW_MAX_RESULTS windows plus the oldest few.
+
+        The oldest windows are kept so that a window split across two byte
+        ranges is still recognised as one when the ranges are merged.
+        """
+        starts = sorted(self.closed)
+        edge = self.size // self.slide
+        for start in starts[edge:-WINDOW_MAX_RESULTS]:
+            del self.closed[start]
+
+    def finish(self):
+        """End of input: the watermark passes every open window"""
+        for start in sorted(self.open):
+            self._emit(start, self.open.pop(start))
+
+    def merge(self, other: "WindowAggregator"):
+        """Fold in windows computed over the rows that follow this aggregator's rows"""
+        self.finish()
+        other.finish()
+        names = list(other.keys)
+        remap = np.array([self._key_index(name) for name in names], dtype=np.int64)
+        width = len(self.keys)
+        for start, counts in other.closed.items():
+            merged = np.zeros(width, dtype=np.int64)
+            mine = self.closed.get(start)
+            if mine is not None:
+                merged[:len(mine)] = mine
+                self.emitted -= 1  # the same window closed on both sides of the split
+            np.add.at(merged, remap[:len(counts)], counts)
+            self.closed[start] = merged
+        self.emitted += other.emitted
+        if len(self.closed) > 2 * WINDOW_MAX_RESULTS:
+            self._trim()
+        self.late_rows += other.late_rows
+        self.unparsed += other.unparsed
+        self.peak_open = max(self.peak_open, other.peak_open)
+        if self.direction is None:
+            self.direction = other.direction
+
+    def result(self) -> dict:
+        self.finish()
+        names = list(self.keys)
+        starts = sorted(self.closed)[-WINDOW_MAX_RESULTS:]
+        return {
+            "kind": "tumbling" if self.slide == self.size else "sliding",
+            "size": self.size,
+            "slide": self.slide,
+            "lateness": self.lateness,
+            "order": {1: "ascending", -1: "descending"}.get(self.direction),
+            "keys": names,
+            "starts": [(pd.Timestamp(0) + pd.Timedelta(minutes=start)).isoformat() for start in starts],
+            "counts": [
+                np.pad(self.closed[start], (0, len(names) - len(self.closed[start]))).tolist() for start in starts
+            ],
+            "windows": self.emitted,
+            "truncated": self.emitted - len(starts),
+            "late_rows": self.late_rows,
+            "unparsed": self.unparsed,
+            "peak_open": self.peak_open,
+        }
+
+# Lookup enrichment
+def file_digest(path: str) -> str:
+    """SHA-256 of a file's bytes"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(PARALLEL_SCAN_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _is_parquet(path: str) -> bool:
+    if not path.lower().endswith(('.parquet', '.pq')):
+        return False
+    if pa is None:
+        raise ValueError("Parquet references need pyarrow")
+    return True
+
+def read_reference(path: str) -> pd.DataFrame:
+    """Load a CSV or Parquet reference table with every column as text"""
+    if _is_parquet(path):
+        frame = pd.read_parquet(path)
+        return frame.astype(str).where(frame.notna(), '')
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+def reference_columns(path: str) -> list:
+    """Column names of a reference table, without loading its rows"""
+    if _is_parquet(path):
+        return pq.read_schema(path).names
+    return list(pd.read_csv(path, dtype=str, nrows=0).columns)
+
+def validate_lookup(lookup: dict) -> dict:
+    """Check lookup-join settings, raising ValueError on the first problem"""
+    if not lookup.get('path') or not os.path.isfile(lookup['path']):
+        raise ValueError("Lookup reference file not found")
+    if not lookup.get('key'):
+        raise ValueError("Lookup needs a reference key column")
+    lookup.setdefault('source_column', 'URL')
+    pattern = lookup.get('pattern')
+    if pattern:
+        try:
+            groups = re.compile(pattern).groups
+        except re.error as e:
+            raise ValueError(f"Bad key pattern ({e})")
+        if groups < 1:
+            raise ValueError("Key pattern needs a capture group around the key")
+    return lookup
+
+def extract_lookup_keys(values: pd.Series, pattern: str = None) -> pd.Series:
+    """Join keys for a column: the first capture group of pattern, or the trimmed value"""
+    values = values.astype(object)
+    if pattern:
+        keys = values.str.extract(pattern, expand=True)[0]
+    else:
+        keys = values.str.strip()
+    return keys.where(keys != '')
+
+class LookupIndex:
+    """Hash index from a reference table's key column to its other columns.
+
+    Keys are unique (the first row for a key wins), so probing a batch is one
+    vectorized hash lookup returning row positions, -1 where nothing matched.
+    """
+
+    def __init__(self, frame: pd.DataFrame, key: str):
+        if key not in frame.columns:
+            raise ValueError(f"Reference has no column '{key}'")
+        keys = frame[key].astype(str).str.strip()
+        keep = (keys != '') & ~keys.duplicated()
+        self.key = key
+        self.keys = pd.Index(keys[keep].to_numpy(dtype=object))
+        self.values = {
+            name: frame.loc[keep, name].to_numpy(dtype=object) for name in frame.columns if name != key
+        }
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def probe(self, keys: np.ndarray) -> np.ndarray:
+        return self.keys.get_indexer(keys)
+
+_LOOKUP_INDEXES = OrderedDict()
+_LOOKUP_LOCK = threading.Lock()
+
+def load_lookup_index(path: str, key: str, cache_dir: str = None) -> tuple:
+    """Return (LookupIndex, how it was obtained, seconds) for a reference file.
+
+    The process keeps the most recent indexes in memory, keyed by the file's
+    path, size and modification time and the key column, so a hit costs one
+    stat. With a cache_dir, a pickled copy named after the file's SHA-256 lets
+    later runs and other processes skip rebuilding it.
+    """
+    started = time.time()
+    info = os.stat(path)
+    cache_key = (path, info.st_size, info.st_mtime_ns, key)
+    with _LOOKUP_LOCK:
+        if cache_key in _LOOKUP_INDEXES:
+            _LOOKUP_INDEXES.move_to_end(cache_key)
+            return _LOOKUP_INDEXES[cache_key], "memory", time.time() - started
+
+    cache_path = None
+    if cache_dir:
+        digest = file_digest(path)
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+        cache_path = os.path.join(cache_dir, f"{digest}-{name}.pkl")
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            index = pickle.load(f)
+        how = "disk"
+    else:
+        index = LookupIndex(read_reference(path), key)
+        how = "built"
+        if cache_path:
+            os.makedirs(cache_dir, exist_ok=True)
+            partial = f"{cache_path}.{uuid.uuid4().hex}"
+            with open(partial, 'wb') as f:
+                pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(partial, cache_path)
+
+    with _LOOKUP_LOCK:
+        _LOOKUP_INDEXES[cache_key] = index
+        while len(_LOOKUP_INDEXES) > LOOKUP_MEMORY_CACHE:
+            _LOOKUP_INDEXES.popitem(last=False)
+    return index, how, time.time() - started
+
+class LookupJoin:
+    """Streams batches through a LookupIndex, appending the reference columns.
+
+    Keys come from one column of the main dataset, optionally through a regex
+    capture group (such as the v= parameter of a YouTube URL). Match counts
+    merge like the other accumulators.
+    """
+
+    def __init__(self, lookup: dict, sample_size: int = LOOKUP_SAMPLE_SIZE):
+        self.lookup = lookup
+        self.index, self.index_source, self.index_seconds = load_lookup_index(
+            lookup['path'], lookup['key'], lookup.get('cache_dir')
+        )
+        self.index_keys = len(self.index)
+        self.columns = list(lookup.get('columns') or self.index.values)
+        for name in self.columns:
+            if name not in self.index.values:
+                raise ValueError(f"Reference has no column '{name}'")
+        self.sample_size = sample_size
+        self.rows = 0
+        self.with_key = 0
+        self.matched = 0
+        self.unmatched = []
+        self.missing_column = False
+
+    def __getstate__(self):
+        # Ship the counts only; enrich() fetches the index from the per-process cache if it needs it
+        state = dict(self.__dict__)
+        state['index'] = None
+        return state
+
+    def names(self, headers: list) -> list:
+        """Output names of the appended columns, renamed where they clash with headers"""
+        return [f"{name} (ref)" if name in headers else name for name in self.columns]
+
+    def enrich(self, frame: pd.DataFrame, headers: list) -> pd.DataFrame:
+        """Return frame cut to the header width with the reference columns appended"""
+        width = len(headers)
+        source = self.lookup['source_column']
+        positions = np.full(len(frame), -1, dtype=np.int64)
+        self.rows += len(frame)
+        if self.index is None:
+            self.index, _, _ = load_lookup_index(self.lookup['path'], self.lookup['key'], self.lookup.get('cache_dir'))
+        if source in headers and headers.index(source) < frame.shape[1]:
+            keys = extract_lookup_keys(frame[headers.index(source)], self.lookup.get('pattern'))
+            present = keys.notna().to_numpy()
+            positions = self.index.probe(keys.to_numpy())
+            self.with_key += int(present.sum())
+            self.matched += int((positions >= 0).sum())
+            room = self.sample_size - len(self.unmatched)
+            if room > 0:
+                misses = keys[present & (positions < 0)].drop_duplicates()
+                self.unmatched += [k for k in misses.tolist() if k not in self.unmatched][:room]
+        else:
+            self.missing_column = True
+
+        enriched = frame.reindex(columns=range(width))
+        hit = positions >= 0
+        for k, name in enumerate(self.columns):
+            column = np.full(len(frame), None, dtype=object)
+            column[hit] = self.index.values[name][positions[hit]]
+            enriched[width + k] = column
+        return enriched
+
+    def merge(self, other: "LookupJoin"):
+        self.rows += other.rows
+        self.with_key += other.with_key
+        self.matched += other.matched
+        self.missing_column |= other.missing_column
+        room = self.sample_size - len(self.unmatched)
+        self.unmatched += [k for k in other.unmatched if k not in self.unmatched][:max(room, 0)]
+
+    def result(self, headers: list) -> dict:
+        return {
+            "reference": self.lookup.get('name') or os.path.basename(self.lookup['path']),
+            "key": self.lookup['key'],
+            "source_column": self.lookup['source_column'],
+            "pattern": self.lookup.get('pattern'),
+            "columns": self.names(headers),
+            "index_keys": self.index_keys,
+            "index_source": self.index_source,
+            "index_seconds": round(self.index_seconds, 3),
+            "rows": self.rows,
+            "with_key": self.with_key,
+            "matched": self.matched,
+            "match_rate": round(self.matched / self.rows * 100, 1) if self.rows else None,
+            "key_match_rate": round(self.matched / self.with_key * 100, 1) if self.with_key else None,
+            "unmatched_sample": self.unmatched,
+            "missing_column": self.missing_column,
+        }
+
+# Stage scheduling
+class StageGraph:
+    """Pipeline stages with declared inputs and outputs.
+
+    A stage starts as soon as every value it reads exists and every stage it
+    is ordered after has finished, so independent stages overlap on a thread
+    pool. Simulated stages (added with seconds) only take part in the
+    schedule and are never slept through. run() reports the schedule with
+    the critical path: the chain of stages that each waited on the one
+    before it.
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    def add(self, name: str, fn, inputs=(), outputs=(), after=(), before=(), seconds: float = None):
+        """fn(**inputs) returns a dict holding the declared outputs; after/before only order stages.
+
+        With seconds, the stage is simulated: fn is not called and the stage
+        lasts that long in the schedule.
+        """
+        if name in self.stages:
+            raise ValueError(f"Stage '{name}' is defined twice")
+        if seconds is not None and outputs:
+            raise ValueError(f"Simulated stage '{name}' cannot produce values")
+        self.stages[name] = {"fn": fn, "inputs": tuple(inputs), "outputs": tuple(outputs),
+                             "after": tuple(after), "before": tuple(before), "seconds": seconds}
+
+    def dependencies(self, provided=()) -> dict:
+        """{stage: set of stages it waits for}, raising ValueError for unknown names or a cycle"""
+        producers = {output: name for name, stage in self.stages.items() for output in stage['outputs']}
+        deps = {name: set(stage['after']) for name, stage in self.stages.items()}
+        for name, stage in self.stages.items():
+            for value in stage['inputs']:
+                if value in producers:
+                    deps[name].add(producers[value])
+                elif value not in provided:
+                    raise ValueError(f"Stage '{name}' reads '{value}', which no stage produces")
+            for later in stage['before']:
+                if later not in deps:
+                    raise ValueError(f"Stage '{name}' must run before unknown stage '{later}'")
+                deps[later].add(name)
+        for name, needs in deps.items():
+            unknown = needs - set(self.stages)
+            if unknown:
+                raise ValueError(f"Stage '{name}' runs after unknown stage '{sorted(unknown)[0]}'")
+        remaining = {name: set(needs) for name, needs in deps.items()}
+        while remaining:
+            ready = [name for name, needs in remaining.items() if not needs]
+            if not ready:
+                raise ValueError(f"Stages {', '.join(sorted(remaining))} depend on each other in a cycle")
+            for name in ready:
+                del remaining[name]
+            for needs in remaining.values():
+                needs.difference_update(ready)
+        return deps
+
+    def _run_stage(self, name: str, kwargs: dict) -> tuple:
+        started = time.time()
+        outputs = self.stages[name]['fn'](**kwargs) or {}
+        missing = set(self.stages[name]['outputs']) - set(outputs)
+        if missing:
+            raise ValueError(f"Stage '{name}' did not produce {', '.join(sorted(missing))}")
+        return started, time.time(), outputs
+
+    def run(self, values: dict, completed: dict = None, max_workers: int = STAGE_MAX_WORKERS) -> list:
+        """Run every stage not in completed ({stage: (start, end)}), adding the outputs to values.
+
+        Returns the schedule in start order: [{"stage", "after", "start",
+        "seconds", "critical", "simulated"}] with times in seconds from the
+        first start. Each stage is placed when the last stage it waits for
+        ends and lasts as long as it ran (or its simulated seconds), so the
+        schedule is the one the real stages would follow if simulated work
+        actually took that long.
+        """
+        deps = self.dependencies(values)
+        completed = dict(completed or {})
+        for name in completed:
+            if not deps[name] <= completed.keys():
+                raise ValueError(f"Stage '{name}' has already run, so nothing can be scheduled before it")
+        done = dict(completed)
+        pending = [name for name in self.stages if name not in done]
+        running = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            while pending or running:
+                for name in [name for name in pending if deps[name] <= done.keys()]:
+                    pending.remove(name)
+                    if self.stages[name]['seconds'] is not None:
+                        now = time.time()
+                        done[name] = (now, now)
+                        continue
+                    kwargs = {value: values[value] for value in self.stages[name]['inputs']}
+                    running[pool.submit(self._run_stage, name, kwargs)] = name
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    started, ended, outputs = future.result()
+                    values.update(outputs)
+                    done[name] = (started, ended)
+
+        # Lay the stages out in dependency order with their measured or simulated durations
+        timeline = {}
+        for name in sorted(done, key=lambda n: done[n]):
+            self._place(name, deps, done, timeline)
+        critical = set()
+        name = max(timeline, key=lambda n: timeline[n][1]) if timeline else None
+        while name is not None:
+            critical.add(name)
+            name = max(deps[name], key=lambda n: timeline[n][1]) if deps[name] else None
+        origin = min(start for start, _ in timeline.values()) if timeline else 0
+        return [
+            {"stage": name, "after": sorted(deps[name]), "start": round(timeline[name][0] - origin, 4),
+             "seconds": round(timeline[name][1] - timeline[name][0], 4), "critical": name in critical,
+             "simulated": self.stages[name]['seconds'] is not None}
+            for name in sorted(timeline, key=lambda n: timeline[n])
+        ]
+
+    def _place(self, name: str, deps: dict, done: dict, timeline: dict) -> tuple:
+        if name not in timeline:
+            start, end = done[name]
+            seconds = self.stages[name]['seconds']
+            duration = end - start if seconds is None else seconds
+            if deps[name]:
+                start = max(self._place(dep, deps, done, timeline)[1] for dep in deps[name])
+            timeline[name] = (start, start + duration)
+        return timeline[name]
+
+def validate_stages(stages: list) -> list:
+    """Check custom stage specs ({"name", "after", "before", "seconds"}) against the built-in stages"""
+    graph = StageGraph()
+    for name in STAGE_BUILTIN:
+        graph.add(name, None)
+    checked = []
+    for stage in stages:
+        name = str(stage.get('name', '')).strip()
+        if not name:
+            raise ValueError("Every custom stage needs a name")
+        seconds = stage.get('seconds', 0)
+        if not isinstance(seconds, (int, float)) or seconds < 0:
+            raise ValueError(f"Stage '{name}': simulated work must be a non-negative number of seconds")
+        checked.append({"name": name, "after": list(stage.get('after') or []),
+                        "before": list(stage.get('before') or []), "seconds": float(seconds)})
+        if "parse" in checked[-1]['before']:
+            raise ValueError(f"Stage '{name}' cannot run before parse: custom stages start once parsing has finished")
+        graph.add(name, None, after=checked[-1]['after'], before=checked[-1]['before'])
+    graph.dependencies()
+    return checked
+
+class StatsAccumulator:
+    """Running totals behind process_csv_file, fed one batch of parsed rows at a time.
+
+    Accumulators are mergeable, so partial results from separate chunks of the
+    same file can be combined into the statistics of the whole file.
+    """
+
+    def __init__(self, expect_header: bool = True, rules: list = None, headers: list = None,
+                 preview_dir: str = None, windows: dict = None, lookup: dict = None):
+        self.expect_header = expect_header
+        self.headers = None
+        self.columns = headers  # names for the batch consumers when starting mid-file
+        self.rules = RuleEngine(rules) if rules else None
+        self.charts = ChartAccumulator()
+        self.windows = WindowAggregator(**windows) if windows else None
+        self.lookup = LookupJoin(lookup) if lookup else None
+        self.preview_dir = preview_dir if pa is not None else None
+        self.segments = []
+        self.text_chunks = []
+        self._segment = None
+        self._text = None
+        self.rows = 0
+        self.nulls = 0
+        self.youtube_first_col = 0
+        self.youtube_videos = 0
+        self.music = 0
+        self.started = time.time()
+        self._pending = []
+
+    def update(self, rows: list):
+        if self.expect_header and rows:
+            self.headers = rows[0]
+            self.expect_header = False
+            rows = rows[1:]
+            if self.columns is None:
+                self.columns = self.headers
+        self._pending.extend(rows)
+        if len(self._pending) >= FRAME_BATCH_ROWS:
+            self.flush()
+        self.rows += len(rows)
+        for row in rows:
+            for cell in row:
+                if not cell or cell == 'null':
+                    self.nulls += 1
+            activity = row[0]
+            if 'YouTube' in activity:
+                self.youtube_first_col += 1
+                if 'Music' not in activity:
+                    self.youtube_videos += 1
+            if 'Music' in activity:
+                self.music += 1
+
+    def flush(self):
+        """Hand buffered rows to the rules engine and chart aggregates as one DataFrame"""
+        rows, self._pending = self._pending, []
+        if not rows:
+            return
+        frame = pd.DataFrame(rows, dtype=object) if self.columns else None
+        if frame is not None:
+            enriched, names = frame, self.columns
+            if self.lookup is not None:
+                enriched = self.lookup.enrich(frame, self.columns)
+                names = self.columns + self.lookup.names(self.columns)
+            self.charts.update(enriched, names)
+            if self.windows is not None:
+                self.windows.update(frame, self.columns)
+            if self.preview_dir:
+                if self._segment is None:
+                    self._segment = SegmentWriter(self.preview_dir, len(names))
+                    if TEXT_INDEX_COLUMN in self.columns:
+                        self._text = TextIndexWriter(self.preview_dir, self._segment.path)
+                self._segment.write(enriched)
+                if self._text is not None:
+                    i = self.columns.index(TEXT_INDEX_COLUMN)
+                    self._text.add(frame[i] if i < frame.shape[1] else pd.Series([None] * len(frame), dtype=object))
+        if self.rules is not None:
+            self.rules.update(rows, frame, self.columns)
+
+    def close(self):
+        """Flush buffered rows and finish the open preview segment"""
+        self.flush()
+        if self._segment is not None:
+            self.segments.append(self._segment.close())
+            self._segment = None
+        if self._text is not None:
+            self.text_chunks += self._text.close()
+            self._text = None
+
+    def files(self) -> list:
+        """Preview segments and text-index chunk files written so far"""
+        chunks = [f"{chunk['path']}.{part}.npy" for chunk in self.text_chunks for part in ("terms", "offsets", "rows", "pos")]
+        return self.segments + chunks
+
+    def discard_files(self):
+        """Delete the preview segments and text-index chunks written so far"""
+        for path in self.files():
+            os.remove(path)
+
+    def merge(self, other: "StatsAccumulator"):
+        """Fold in the totals of the rows that follow this accumulator's rows"""
+        self.close()
+        other.close()
+        self.segments += other.segments
+        self.text_chunks += other.text_chunks
+        if self.headers is None:
+            self.headers = other.headers
+        self.started = min(self.started, other.started)
+        self.rows += other.rows
+        self.nulls += other.nulls
+        self.youtube_first_col += other.youtube_first_col
+        self.youtube_videos += other.youtube_videos
+        self.music += other.music
+        self.charts.merge(other.charts)
+        if self.windows is not None:
+            self.windows.merge(other.windows)
+        if self.lookup is not None:
+            self.lookup.merge(other.lookup)
+        if self.rules is not None:
+            self.rules.merge(other.rules)
+
+    def stage_graph(self, filename: str, stages: list = None) -> StageGraph:
+        """The statistics that follow the parse, as stages over its totals"""
+        headers = self.headers
+        names = headers + self.lookup.names(headers) if self.lookup is not None else headers
+        
+        def completeness(rows, nulls):
+            cells = rows * len(headers)
+            return {"completeness": round((cells - nulls) / cells * 100) if cells > 0 else 0}
+        
+        def classify(rows, youtube_rows):
+            return {"classification": classify_from_counts(filename, headers, rows, youtube_rows)}
+        
+        def rules():
+            if self.rules is None:
+                return {"rule_results": None, "rule_failures": None}
+            return {"rule_results": self.rules.results(), "rule_failures": self.rules.failure_sample()}
+        
+        def quality(rows, nulls, rule_results):
+            return {"quality_score": calculate_quality_score(rows, nulls, len(headers), rule_results)}
+        
+        def insights(rows, classification, youtube_videos, music):
+            if "YouTube" not in classification['type'] or rows <= 0:
+                return {"insights": ""}
+            return {"insights": f"YouTube Videos: {round(youtube_videos / rows * 100)}% | Music: {round(music / rows * 100)}%"}
+        
+        graph = StageGraph()
+        graph.add("parse", None, outputs=("rows", "nulls", "youtube_rows", "youtube_videos", "music"))
+        graph.add("completeness", completeness, inputs=("rows", "nulls"), outputs=("completeness",))
+        graph.add("classify", classify, inputs=("rows", "youtube_rows"), outputs=("classification",))
+        graph.add("rules", rules, after=("parse",), outputs=("rule_results", "rule_failures"))
+        graph.add("quality", quality, inputs=("rows", "nulls", "rule_results"), outputs=("quality_score",))
+        graph.add("insights", insights, inputs=("rows", "classification", "youtube_videos", "music"), outputs=("insights",))
+        graph.add("charts", lambda: {"charts": self.charts.result(names)}, after=("parse",), outputs=("charts",))
+        graph.add("windows", lambda: {"windows": self.windows.result() if self.windows is not None else None},
+                  after=("parse",), outputs=("windows",))
+        graph.add("lookup", lambda: {"lookup": self.lookup.result(headers) if self.lookup is not None else None},
+                  after=("parse",), outputs=("lookup",))
+        for stage in stages or []:
+            graph.add(stage['name'], None, after=stage['after'] or ("parse",), before=stage['before'],
+                      seconds=stage['seconds'])
+        return graph
+
+    def result(self, filename: str, stages: list = None) -> dict:
+        """Statistics of everything parsed so far; stages are validated custom stages to schedule alongside"""
+        if self.headers is None or self.rows < 1:
+            raise ValueError("CSV must have at least header and one data row")
+        self.close()
+        
+        headers = self.headers
+        names = headers + self.lookup.names(headers) if self.lookup is not None else headers
+        values = {"rows": self.rows, "nulls": self.nulls, "youtube_rows": self.youtube_first_col,
+                  "youtube_videos": self.youtube_videos, "music": self.music}
+        schedule = self.stage_graph(filename, stages).run(values, completed={"parse": (self.started, time.time())})
+        
+        result = {
+            "rows": self.rows,
+            "columns": len(headers),
+            "nulls": self.nulls,
+            "completeness": values['completeness'],
+            "dataset_type": values['classification']['type'],
+            "quality_score": values['quality_score'],
+            "insights": values['insights'],
+            "headers": headers,
+            "status": "success",
+            "charts": values['charts'],
+            "schedule": schedule,
+        }
+        if values['rule_results'] is not None:
+            result['rules'] = values['rule_results']
+            result['rule_failures'] = values['rule_failures']
+        if values['windows'] is not None:
+            result['windows'] = values['windows']
+        if values['lookup'] is not None:
+            result['lookup'] = values['lookup']
+        if self.preview_dir:
+            result['preview'] = {"dir": self.preview_dir, "columns": names, "segments": self.segments}
+            if self.text_chunks:
+                result['preview']['text'] = {"column": TEXT_INDEX_COLUMN, "chunks": self.text_chunks}
+        return result
+
+# Checkpointing
+def checkpoint_path(directory: str, fingerprint: str, options: dict) -> str:
+    """Checkpoint file for one source (by content fingerprint) parsed with these options"""
+    settings = {key: value for key, value in options.items() if key not in ("checkpoint", "preview_dir", "stages")}
+    if settings.get('tolerance'):
+        settings['tolerance'] = {k: v for k, v in settings['tolerance'].items() if k != "quarantine_path"}
+    settings['preview'] = bool(options.get('preview_dir'))
+    digest = hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()[:12]
+    return os.path.join(directory, f"{fingerprint[:32]}-{digest}.ckpt")
+
+def purge_checkpoints(directory: str, max_age: float = CHECKPOINT_MAX_AGE):
+    """Delete checkpoints (and their lock files) no run has come back for"""
+    if not os.path.isdir(directory):
+        return
+    cutoff = time.time() - max_age
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if name.endswith((".ckpt", ".lock")) and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+def _remove_unlisted(directory: str, keep: list):
+    """Delete preview files written after the checkpoint a run resumed from"""
+    if not directory or not os.path.isdir(directory):
+        return
+    keep = set(keep)
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if path not in keep:
+            os.remove(path)
+
+_checkpoint_locks = set()  # lock files held by this process
+
+def _drop_inherited_locks():
+    # A flock is shared with forked children, and parse workers can outlive a killed run
+    for lock in _checkpoint_locks:
+        lock.close()
+    _checkpoint_locks.clear()
+
+if fcntl is not None:
+    os.register_at_fork(after_in_child=_drop_inherited_locks)
+
+class Checkpoint:
+    """A pickled snapshot of a running parse, saved atomically to local disk.
+
+    A serial parse saves the source position, the parser and the accumulators
+    at most every interval seconds, always at a batch boundary so the batches
+    a resumed run sees are the ones an uninterrupted run would have seen. A
+    parallel parse saves each byte range as it finishes. The file is loaded
+    when the checkpoint is opened and deleted once the run has a result.
+
+    Preview and quarantine files stay where the run that wrote them put them;
+    the accumulators in the checkpoint carry those paths, so a resumed run
+    keeps writing next to them. Only one live run may hold a checkpoint:
+    a run that finds it locked gets locked == False and should run without it.
+    """
+
+    def __init__(self, path: str, interval: float = CHECKPOINT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.saves = 0
+        self.state = None
+        self._saved_at = time.time()
+        self._lock = None
+        self.locked = self._acquire()
+        if not self.locked:
+            return
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+            if state.get('version') == CHECKPOINT_VERSION:
+                self.state = state
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+            pass
+
+    def _acquire(self) -> bool:
+        if fcntl is None:
+            return True
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        lock = open(self.path + ".lock", 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            return False
+        os.utime(lock.name)
+        self._lock = lock
+        _checkpoint_locks.add(lock)
+        return True
+
+    def restored(self, kind: str) -> dict:
+        """The saved state of this kind, if every file it lists is still on disk"""
+        if self.state is None or self.state['kind'] != kind:
+            return None
+        if not all(os.path.exists(path) for path in self.state['outputs']):
+            return None
+        return self.state
+
+    def due(self) -> bool:
+        return time.time() - self._saved_at >= self.interval
+
+    def save(self, kind: str, outputs: list, **state):
+        """Replace the saved state; outputs are the files a resumed run needs to find"""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temp = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        with open(temp, 'wb') as f:
+            pickle.dump({"version": CHECKPOINT_VERSION, "kind": kind, "saved_at": time.time(), "outputs": outputs,
+                         **state}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, self.path)
+        self.saves += 1
+        self._saved_at = time.time()
+
+    def discard(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def close(self):
+        """Release the lock; the lock file stays, since another run may be about to lock it"""
+        if self._lock is not None:
+            _checkpoint_locks.discard(self._lock)
+            self._lock.close()
+            self._lock = None
+
+    def summary(self, resumed: dict = None) -> dict:
+        return {"saves": self.saves, "resumed": resumed}
+
+def process_csv_stream(text_chunks, filename: str, tolerance: dict = None, rules: list = None,
+                       preview_dir: str = None, windows: dict = None, lookup: dict = None,
+                       stages: list = None, checkpoint: Checkpoint = None) -> dict:
+    """Process CSV text arriving in chunks and return statistics.
+
+    Only the rows of the chunk being parsed are held in memory. Passing a
+    tolerance dict (max_field_size, max_record_size, resync_pattern,
+    quarantine_path) switches to TolerantCsvParser; a rules list adds the
+    data-quality rule results, preview_dir writes the rows for the preview,
+    windows (WindowAggregator settings) adds event-time window counts,
+    lookup (LookupJoin settings) appends reference columns by key and stages
+    (validate_stages specs) are scheduled with the statistics stages. With a
+    checkpoint, text_chunks must be a StagedText; a saved checkpoint's parser
+    and totals replace fresh ones, and new checkpoints are saved as it goes.
+    """
+    quarantine = None
+    restored = checkpoint.restored("stream") if checkpoint is not None else None
+    resumed = None
+    try:
+        if restored is not None:
+            parser, stats, quarantine = restored['parser'], restored['stats'], restored['quarantine']
+            _remove_unlisted(stats.preview_dir, stats.files())
+            stats.started = time.time()
+            resumed = {"offset": restored['source']['offset'], "rows": stats.rows}
+        elif tolerance is not None:
+            quarantine = Quarantine(tolerance.get('quarantine_path'))
+            parser = TolerantCsvParser(
+                quarantine,
+                max_field_size=tolerance.get('max_field_size', TOLERANT_MAX_FIELD_SIZE),
+                max_record_size=tolerance.get('max_record_size', TOLERANT_MAX_RECORD_SIZE),
+                resync_pattern=tolerance.get('resync_pattern'),
+            )
+        else:
+            parser = CsvStreamParser()
+        if restored is None:
+            stats = StatsAccumulator(rules=rules, preview_dir=preview_dir, windows=windows, lookup=lookup)
+        for chunk in text_chunks:
+            stats.update(parser.feed(chunk))
+            if checkpoint is not None and checkpoint.due() and not stats._pending:
+                stats.close()
+                outputs = stats.files() + ([quarantine.path] if quarantine is not None and quarantine.path else [])
+                checkpoint.save("stream", outputs, source=text_chunks.state(), parser=parser, stats=stats,
+                                quarantine=quarantine)
+        stats.update(parser.close())
+        result = stats.result(filename, stages)
+        if quarantine is not None:
+            result['quarantine'] = quarantine.summary()
+        if checkpoint is not None:
+            result['checkpoint'] = checkpoint.summary(resumed)
+        return result
+    
+    except Exception as e:
+        return {
+            "status": "error",
+            "message": str(e)
+        }
+    finally:
+        if quarantine is not None:
+            quarantine.close()
+
+def process_csv_file(file_content: str, filename: str) -> dict:
+    """Process CSV and return statistics"""
+    return process_csv_stream([file_content], filename)
+
+# Compressed input
+class _ChunkReader:
+    """File-like view over an iterator of byte chunks, with peek support"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+
+    def _fill(self, size: int) -> bool:
+        while len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return False
+            self._buffer += chunk
+        return True
+
+    def peek(self, size: int) -> bytes:
+        self._fill(size)
+        return self._buffer[:size]
+
+    def read(self, size: int = -1) -> bytes:
+        """Return up to size bytes; an empty result means end of stream"""
+        if not self._buffer:
+            self._buffer = next(self._chunks, b'')
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def read_exact(self, size: int) -> bytes:
+        if not self._fill(size):
+            raise ValueError("Unexpected end of compressed stream")
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def unread(self, data: bytes):
+        self._buffer = data + self._buffer
+
+COMPRESSION_MAGIC = [
+    (b'\x1f\x8b', "gzip"),
+    (b'BZh', "bz2"),
+    (b'\xfd7zXZ\x00', "xz"),
+    (b'\x28\xb5\x2f\xfd', "zstd"),
+    (b'PK\x03\x04', "zip"),
+]
+
+def detect_compression(head: bytes) -> str:
+    """Identify the compression format from the leading magic bytes"""
+    for magic, kind in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return kind
+    return None
+
+def _iter_zlib(reader: _ChunkReader, wbits: int, single_member: bool = False):
+    """Inflate gzip (or raw deflate) members with bounded output per step"""
+    decompressor = zlib.decompressobj(wbits)
+    while True:
+        data = reader.read(STREAM_CHUNK_SIZE)
+        if not data:
+            if not decompressor.eof and not single_member:
+                tail = decompressor.flush()
+                if tail:
+                    yield tail
+            return
+        while data:
+            out = decompressor.decompress(data, STREAM_CHUNK_SIZE)
+            if out:
+                yield out
+            data = decompressor.unconsumed_tail
+            if decompressor.eof:
+                # At the end of a member the rest of the input is in unused_data; unconsumed_tail repeats it
+                leftover = decompressor.unused_data
+                if single_member:
+                    reader.unread(leftover)
+                    return
+                # Concatenated gzip members are decoded as one stream
+                decompressor = zlib.decompressobj(wbits)
+                data = leftover
+                if not data:
+                    break
+
+def _iter_buffered(reader: _ChunkReader, factory):
+    """Decode bz2/xz streams, restarting on concatenated streams"""
+    decompressor = factory()
+    while True:
+        data = reader.read(STREAM_CHUNK_SIZE)
+        if not data:
+            return
+        while True:
+            out = decompressor.decompress(data, max_length=STREAM_CHUNK_SIZE)
+            if out:
+                yield out
+            data = b''
+            if decompressor.eof:
+                leftover = decompressor.unused_data
+                decompressor = factory()
+                if not leftover:
+                    break
+                data = leftover
+            elif decompressor.needs_input:
+                break
+
+def _iter_zstd(reader: _ChunkReader):
+    if zstandard is None:
+        raise ValueError("Reading .zst input requires the 'zstandard' package")
+    stream = zstandard.ZstdDecompressor().stream_reader(reader, read_across_frames=True)
+    while True:
+        out = stream.read(STREAM_CHUNK_SIZE)
+        if not out:
+            return
+        yield out
+
+def _iter_zip(reader: _ChunkReader):
+    """Stream the first data member of a zip archive from its local headers"""
+    while reader.peek(4) == b'PK\x03\x04':
+        header = reader.read_exact(30)
+        flags, method = struct.unpack('<HH', header[6:10])
+        compressed_size = struct.unpack('<I', header[18:22])[0]
+        name_len, extra_len = struct.unpack('<HH', header[26:30])
+        name = reader.read_exact(name_len).decode('utf-8', errors='ignore')
+        reader.read_exact(extra_len)
+        skip = name.endswith('/') or name.startswith('__MACOSX')
+        has_descriptor = bool(flags & 0x08)
+
+        if method == 8:
+            members = _iter_zlib(reader, -zlib.MAX_WBITS, single_member=True)
+        elif method == 0 and not has_descriptor:
+            members = _iter_stored(reader, compressed_size)
+        else:
+            raise ValueError(f"Unsupported zip compression method {method} for '{name}'")
+
+        if not skip:
+            yield from members
+            return
+        for _ in members:
+            pass
+        if has_descriptor:
+            descriptor = reader.peek(4)
+            reader.read_exact(16 if descriptor == b'PK\x07\x08' else 12)
+    raise ValueError("Zip archive contains no data file")
+
+def _iter_stored(reader: _ChunkReader, size: int):
+    while size > 0:
+        data = reader.read(min(size, STREAM_CHUNK_SIZE))
+        if not data:
+            raise ValueError("Unexpected end of zip archive")
+        size -= len(data)
+        yield data
+
+def decompress_chunks(chunks) -> tuple:
+    """Sniff the compression format and return (kind, decompressed byte chunks)"""
+    reader = _ChunkReader(chunks)
+    kind = detect_compression(reader.peek(8))
+    if kind is None:
+        stream = iter(lambda: reader.read(STREAM_CHUNK_SIZE), b'')
+    elif kind == "gzip":
+        stream = _iter_zlib(reader, 16 + zlib.MAX_WBITS)
+    elif kind == "bz2":
+        stream = _iter_buffered(reader, bz2.BZ2Decompressor)
+    elif kind == "xz":
+        stream = _iter_buffered(reader, lzma.LZMADecompressor)
+    elif kind == "zstd":
+        stream = _iter_zstd(reader)
+    else:
+        stream = _iter_zip(reader)
+    return kind, stream
+
+def iter_source_bytes(source: dict):
+    """Read a fetched or uploaded source body in chunks"""
+    body = source['body']
+    body.seek(0)
+    return iter(lambda: body.read(STREAM_CHUNK_SIZE), b'')
+
+def iter_text(byte_chunks):
+    """Decode UTF-8 byte chunks without splitting multi-byte characters"""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    for chunk in byte_chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+def open_source_text(source: dict) -> tuple:
+    """Return (compression kind, decoded text chunks) for a source"""
+    kind, stream = decompress_chunks(iter_source_bytes(source))
+    return kind, iter_text(stream)
+
+def _skip_bytes(chunks, count: int):
+    for chunk in chunks:
+        if count >= len(chunk):
+            count -= len(chunk)
+            continue
+        yield chunk[count:]
+        count = 0
+
+class StagedText:
+    """Decoded text chunks of a staged file that can report where they are and restart there.
+
+    The offset counts decompressed bytes, and the decoder state carries any
+    partial UTF-8 character, so state() taken between chunks is enough to
+    continue the text exactly. Uncompressed files seek straight to the
+    offset; compressed ones are decompressed again up to it.
+    """
+
+    def __init__(self, path: str, offset: int = 0, decoder: tuple = None):
+        self.path = path
+        self.offset = offset
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        if decoder is not None:
+            self._decoder.setstate(decoder)
+
+    def __iter__(self):
+        with open(self.path, 'rb') as body:
+            kind = detect_compression(body.read(8))
+            body.seek(self.offset if kind is None else 0)
+            chunks = iter(lambda: body.read(STREAM_CHUNK_SIZE), b'')
+            if kind is not None:
+                chunks = _skip_bytes(decompress_chunks(chunks)[1], self.offset)
+            for chunk in chunks:
+                self.offset += len(chunk)
+                text = self._decoder.decode(chunk)
+                if text:
+                    yield text
+        tail = self._decoder.decode(b'', final=True)
+        if tail:
+            yield tail
+
+    def state(self) -> dict:
+        return {"offset": self.offset, "decoder": self._decoder.getstate()}
+
+
+# Shared worker pool
+def estimate_job_memory(size_bytes: int, compressed: bool = False) -> int:
+    """Rough peak memory for parsing a source of the given size in a worker"""
+    inflated = size_bytes * (JOB_INFLATE_RATIO if compressed else 1)
+    return JOB_BASE_MEMORY + int(inflated * JOB_MEMORY_PER_BYTE)
+
+def _make_pool(max_workers: int):
+    """Process pool where fork is available, threads elsewhere.
+
+    Spawned children would re-execute the Streamlit script as their main
+    module, so only fork gives real processes here.
+    """
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('fork'))
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+
+class JobScheduler:
+    """Shared, bounded executor with per-session queues and memory admission.
+
+    Sessions are served round-robin, so one user's queue cannot starve
+    another's, and a job only starts once its memory estimate fits in what
+    is left of the budget. Jobs are plain dicts; callers poll status().
+    """
+
+    def __init__(self, max_workers: int = JOB_MAX_WORKERS, memory_budget: int = JOB_MEMORY_BUDGET, pool_factory=_make_pool):
+        self.max_workers = max_workers
+        self.memory_budget = memory_budget
+        self._pool_factory = pool_factory
+        self._executor = pool_factory(max_workers)
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()
+        self.jobs = {}
+        self.running = 0
+        self.memory_in_use = 0
+        threading.Thread(target=self._dispatch_loop, name="job-dispatcher", daemon=True).start()
+
+    def submit(self, session_id: str, fn, args: tuple, memory_estimate: int, label: str = "", key: str = None) -> str:
+        """Queue a job and return its id.
+
+        A job submitted with the key of one that is still queued or running is
+        not run twice: the caller becomes another watcher of the existing job
+        and gets its id. A finished job stays around until every watcher has
+        popped it, or until JOB_RESULT_TTL has passed.
+        """
+        if key is not None:
+            with self._cond:
+                self._expire()
+                for job in self.jobs.values():
+                    if job['key'] == key and job['state'] in ("queued", "running"):
+                        job['watchers'] += 1
+                        return job['id']
+        if memory_estimate > self.memory_budget:
+            raise ValueError(
+                f"Job needs ~{memory_estimate // 2 ** 20} MB, more than the worker "
+                f"memory budget of {self.memory_budget // 2 ** 20} MB"
+            )
+        job_id = uuid.uuid4().hex
+        with self._cond:
+            self.jobs[job_id] = {
+                "id": job_id,
+                "session": session_id,
+                "label": label,
+                "key": key,
+                "watchers": 1,
+                "fn": fn,
+                "args": args,
+                "memory": memory_estimate,
+                "state": "queued",
+                "submitted": time.time(),
+                "started": None,
+                "finished": None,
+                "result": None,
+                "error": None,
+            }
+            self._queues.setdefault(session_id, deque()).append(job_id)
+            self._cond.notify_all()
+        return job_id
+
+    def _next_job(self):
+        """Take the first session head that fits, then rotate that session to the back"""
+        free = self.memory_budget - self.memory_in_use
+        for session_id, queue in self._queues.items():
+            job = self.jobs[queue[0]]
+            if job['memory'] <= free:
+                queue.popleft()
+                if queue:
+                    self._queues.move_to_end(session_id)
+                else:
+                    del self._queues[session_id]
+                return job
+        return None
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                job = None
+                while job is None:
+                    if self.running < self.max_workers:
+                        job = self._next_job()
+                    if job is None:
+                        self._cond.wait()
+                job['state'] = "running"
+                job['started'] = time.time()
+                self.running += 1
+                self.memory_in_use += job['memory']
+            try:
+                future = self._executor.submit(job['fn'], *job['args'])
+            except BrokenProcessPool:
+                self._executor = self._pool_factory(self.max_workers)
+                future = self._executor.submit(job['fn'], *job['args'])
+            except Exception as e:
+                self._finish(job, None, e)
+                continue
+            future.add_done_callback(lambda f, job=job: self._finish(job, f))
+
+    def _finish(self, job: dict, future, error: Exception = None):
+        result = None
+        if error is None:
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                error = RuntimeError("Worker process crashed (possibly out of memory)")
+                self._executor = self._pool_factory(self.max_workers)
+            except Exception as e:
+                error = e
+        with self._cond:
+            if job['state'] != "cancelled":
+                job['state'] = "error" if error is not None else "done"
+            job['result'] = result
+            job['error'] = str(error) if error is not None else None
+            job['finished'] = time.time()
+            self.running -= 1
+            self.memory_in_use -= job['memory']
+            self._cond.notify_all()
+
+    def _expire(self):
+        """Forget finished jobs whose watchers never came back for them"""
+        cutoff = time.time() - JOB_RESULT_TTL
+        for job_id in [job_id for job_id, job in self.jobs.items() if (job['finished'] or cutoff) < cutoff]:
+            del self.jobs[job_id]
+
+    def _dispatch_order(self) -> list:
+        """Queued job ids in the order round-robin would start them"""
+        queues = [list(q) for q in self._queues.values()]
+        order = []
+        depth = 0
+        while any(depth < len(q) for q in queues):
+            order.extend(q[depth] for q in queues if depth < len(q))
+            depth += 1
+        return order
+
+    def status(self, job_id: str) -> dict:
+        """Snapshot of a job, with its queue position while it waits"""
+        with self._cond:
+            self._expire()
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            snapshot = {k: v for k, v in job.items() if k not in ("fn", "args")}
+            if job['state'] == "queued":
+                order = self._dispatch_order()
+                snapshot['position'] = order.index(job_id) + 1
+                snapshot['queued_total'] = len(order)
+            return snapshot
+
+    def cancel(self, job_id: str):
+        """Stop watching a job; once nobody watches it, drop it if queued or discard its result if running"""
+        with self._cond:
+            job = self.jobs.get(job_id)
+            if job is None or job['state'] == "cancelled":
+                return
+            job['watchers'] -= 1
+            if job['finished'] is not None:
+                if job['watchers'] <= 0:
+                    del self.jobs[job_id]
+                return
+            if job['watchers'] > 0:
+                return
+            if job['state'] == "queued":
+                queue = self._queues.get(job['session'])
+                if queue is not None and job_id in queue:
+                    queue.remove(job_id)
+                    if not queue:
+                        del self._queues[job['session']]
+                job['finished'] = time.time()
+            job['state'] = "cancelled"
+            self._cond.notify_all()
+
+    def pop(self, job_id: str) -> dict:
+        """Collect a finished job, forgetting it once its last watcher has.
+
+        Returns a snapshot like status(); its watchers count is how many
+        watchers have still to collect the job.
+        """
+        with self._cond:
+            self._expire()
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if job['finished'] is not None:
+                job['watchers'] -= 1
+                if job['watchers'] <= 0:
+                    del self.jobs[job_id]
+            return {k: v for k, v in job.items() if k not in ("fn", "args")}
+
+    def summary(self) -> dict:
+        with self._cond:
+            return {
+                "running": self.running,
+                "queued": sum(len(q) for q in self._queues.values()),
+                "sessions": len(self._queues),
+                "memory_in_use": self.memory_in_use,
+                "memory_budget": self.memory_budget,
+            }
+
+
+# Parallel parsing
+def _find_record_boundary(f, pos: int, inside_quotes: bool) -> int:
+    """Offset just past the first unquoted newline at or after pos (or EOF)"""
+    f.seek(pos)
+    offset = pos
+    while True:
+        block = f.read(PARALLEL_SCAN_BLOCK)
+        if not block:
+            return offset
+        i = 0
+        while True:
+            if inside_quotes:
+                q = block.find(b'"', i)
+                if q == -1:
+                    break
+                inside_quotes = False
+                i = q + 1
+            else:
+                nl = block.find(b'\n', i)
+                q = block.find(b'"', i)
+                if nl != -1 and (q == -1 or nl < q):
+                    return offset + nl + 1
+                if q == -1:
+                    break
+                inside_quotes = True
+                i = q + 1
+        offset += len(block)
+
+def _guess_quote_state(sample: bytes) -> bool:
+    """Speculate whether the first byte of sample lies inside a quoted field.
+
+    The first quote that clearly opens a field (after a delimiter, before
+    content) means we started outside; one that clearly closes a field
+    (after content, before a delimiter) means we started inside.
+    """
+    q = sample.find(b'"')
+    while q != -1:
+        prev = sample[q - 1:q]
+        nxt = sample[q + 1:q + 2]
+        if prev in (b',', b'\n') and nxt not in (b',', b'\r', b'\n', b'"', b''):
+            return False
+        if nxt in (b',', b'\r', b'\n') and prev not in (b',', b'\n', b'"', b''):
+            return True
+        q = sample.find(b'"', q + 1)
+    return False
+
+def _read_range(f, start: int, end: int):
+    f.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        block = f.read(min(remaining, PARALLEL_SCAN_BLOCK))
+        if not block:
+            return
+        remaining -= len(block)
+        yield block
+
+def parse_byte_range(path: str, start: int, end: int, inside_quotes: bool, first: bool,
+                     rules: list = None, headers: list = None, preview_dir: str = None,
+                     windows: dict = None, lookup: dict = None) -> dict:
+    """Parse the records owned by the nominal byte range [start, end).
+
+    A range owns every record that starts in it: parsing begins after the
+    first unquoted newline at or after start (given the assumed quote state
+    there) and runs to the first unquoted newline at or after end.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        quotes = sum(block.count(b'"') for block in _read_range(f, start, end))
+        parity = bool(quotes % 2)
+        record_start = start if first else _find_record_boundary(f, start, inside_quotes)
+        record_end = size if end >= size else _find_record_boundary(f, end, inside_quotes != parity)
+        stats = StatsAccumulator(expect_header=first, rules=rules, headers=None if first else headers,
+                                 preview_dir=preview_dir, windows=windows, lookup=lookup)
+        parser = CsvStreamParser()
+        if record_end > record_start:
+            for text in iter_text(_read_range(f, record_start, record_end)):
+                stats.update(parser.feed(text))
+        stats.update(parser.close())
+    stats.close()
+    return {
+        "start": start,
+        "inside_quotes": inside_quotes,
+        "parity": parity,
+        "record_start": record_start,
+        "record_end": record_end,
+        "stats": stats,
+    }
+
+def _read_header(f) -> list:
+    """Parse the first record of the file"""
+    end = _find_record_boundary(f, 0, False)
+    parser = CsvStreamParser()
+    rows = parser.feed(''.join(iter_text(_read_range(f, 0, end)))) + parser.close()
+    return rows[0] if rows else None
+
+def available_cpus() -> int:
+    """CPUs this process may run on; parallel ranges beyond this only add overhead"""
+    try:
+        return len(os.sched_getaffinity(0)) or 1
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def parse_file_parallel(path: str, filename: str, workers: int, pool=None, rules: list = None,
+                        preview_dir: str = None, windows: dict = None, lookup: dict = None,
+                        stages: list = None, checkpoint: Checkpoint = None) -> dict:
+    """Parse one uncompressed file as N byte ranges on a process pool.
+
+    Each range speculates its starting quote state; once every range has
+    reported its quote parity the true states are known, and ranges that
+    guessed wrong are parsed again before the partial statistics are merged
+    in file order. Counts match the serial parser exactly, except that each
+    range runs its own event-time watermark, so late-row counts for windows
+    can differ near range boundaries. With a checkpoint, each finished range
+    is saved and a resumed run only parses the ranges that were missing.
+    """
+    started = time.time()
+    size = os.path.getsize(path)
+    bounds = [size * i // workers for i in range(workers + 1)]
+    with open(path, 'rb') as f:
+        headers = _read_header(f)
+        guesses = [False]
+        for pos in bounds[1:-1]:
+            f.seek(pos)
+            guesses.append(_guess_quote_state(f.read(PARALLEL_SPECULATION_WINDOW)))
+
+    restored = checkpoint.restored("ranges") if checkpoint is not None else None
+    if restored is not None and restored['bounds'] != bounds:
+        restored = None
+    done = dict(restored['parts']) if restored is not None else {}
+    if restored is not None:
+        # Finish in the directory the saved ranges were written to
+        preview_dir = restored['preview_dir']
+        _remove_unlisted(preview_dir, restored['outputs'])
+
+    own_pool = pool is None
+    pool = pool or _make_pool(workers)
+    try:
+        futures = {
+            pool.submit(parse_byte_range, path, bounds[i], bounds[i + 1], guesses[i], i == 0,
+                        rules, headers, preview_dir, windows, lookup): i
+            for i in range(workers) if i not in done
+        }
+        for future in as_completed(futures):
+            done[futures[future]] = future.result()
+            if checkpoint is not None:
+                outputs = [f for part in done.values() for f in part['stats'].files()]
+                checkpoint.save("ranges", outputs, bounds=bounds, parts=done, preview_dir=preview_dir)
+        parts = [done[i] for i in range(workers)]
+
+        # Fix-up pass: replay the true quote state through the parities
+        redo = []
+        state = False
+        for i, part in enumerate(parts):
+            if part['inside_quotes'] != state:
+                redo.append((i, state))
+            state = state != part['parity']
+        if redo:
+            fixed = pool.map(
+                parse_byte_range,
+                [path] * len(redo), [bounds[i] for i, _ in redo], [bounds[i + 1] for i, _ in redo],
+                [state for _, state in redo], [i == 0 for i, _ in redo],
+                [rules] * len(redo), [headers] * len(redo), [preview_dir] * len(redo), [windows] * len(redo),
+                [lookup] * len(redo)
+            )
+            for (i, _), part in zip(redo, fixed):
+                parts[i]['stats'].discard_files()
+                parts[i] = part
+    finally:
+        if own_pool:
+            pool.shutdown()
+
+    stats = parts[0]['stats']
+    for part in parts[1:]:
+        stats.merge(part['stats'])
+    stats.started = started
+    result = stats.result(filename, stages)
+    result['parallel'] = {"ranges": workers, "fixups": len(redo)}
+    if restored is not None:
+        # Workers of the killed run can outlive it and finish their range into the same directory
+        _remove_unlisted(preview_dir, stats.files())
+    if checkpoint is not None:
+        result['checkpoint'] = checkpoint.summary({"ranges": len(restored['parts'])} if restored else None)
+    return result
+
+def run_pipeline_job(path: str, filename: str, options: dict = None) -> dict:
+    """Worker entry point: stream a staged source file through the parser"""
+    options = options or {}
+    workers = min(options.get('parse_workers', 1), available_cpus())
+    tolerance = options.get('tolerance')
+    rules = options.get('rules')
+    preview_dir = options.get('preview_dir')
+    windows = options.get('windows')
+    lookup = options.get('lookup')
+    stages = options.get('stages')
+    with open(path, 'rb') as body:
+        compression = detect_compression(body.read(8))
+    if lookup:
+        # Build (or load) the index before any parse workers fork, so they inherit it
+        try:
+            _, index_source, index_seconds = load_lookup_index(lookup['path'], lookup['key'], lookup.get('cache_dir'))
+        except (OSError, ValueError, pd.errors.ParserError) as e:
+            return {"status": "error", "message": f"Lookup reference: {e}", "compression": compression}
+    checkpoint = None
+    if options.get('checkpoint'):
+        settings = options['checkpoint']
+        checkpoint = Checkpoint(checkpoint_path(settings['dir'], settings['key'], options),
+                                settings.get('interval', CHECKPOINT_INTERVAL))
+        if not checkpoint.locked:
+            checkpoint = None  # another live run of this source and settings is checkpointing
+    
+    try:
+        # Resyncing after a bad quote changes record boundaries, so tolerant runs stay serial
+        if workers > 1 and tolerance is None and compression is None and os.path.getsize(path) >= PARALLEL_MIN_BYTES:
+            try:
+                result = parse_file_parallel(path, filename, workers, rules=rules, preview_dir=preview_dir,
+                                             windows=windows, lookup=lookup, stages=stages, checkpoint=checkpoint)
+            except ValueError as e:
+                result = {"status": "error", "message": str(e)}
+        else:
+            restored = checkpoint.restored("stream") if checkpoint is not None else None
+            text_chunks = StagedText(path, **restored['source']) if restored is not None else StagedText(path)
+            result = process_csv_stream(text_chunks, filename, tolerance, rules, preview_dir, windows, lookup, stages,
+                                        checkpoint)
+        if checkpoint is not None:
+            checkpoint.discard()
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+    result['compression'] = compression
+    if result.get('lookup'):
+        result['lookup'].update(index_source=index_source, index_seconds=round(index_seconds, 3))
+    return result
+
+
+# Approximate preview
+def plan_sample_ranges(total_bytes: int, mode: str, head_bytes: int, ranges: int = 0,
+                       range_bytes: int = 0, seed: int = None) -> list:
+    """Byte ranges (offset, length) to read for an approximate preview.
+
+    "head" reads the first head_bytes. "random" reads range_bytes from the
+    start of the file (for the header) plus one range at a random offset in
+    each of `ranges` equal strata, so the sample spreads over the whole file.
+    Without a known size only the head can be read.
+    """
+    if mode == "head" or not total_bytes:
+        return [(0, head_bytes if not total_bytes else min(head_bytes, total_bytes))]
+    if (ranges + 1) * range_bytes >= total_bytes:
+        return [(0, total_bytes)]
+    rng = np.random.default_rng(seed)
+    stratum = (total_bytes - range_bytes) / ranges
+    plan = [(0, range_bytes)]
+    for i in range(ranges):
+        lo = range_bytes + int(i * stratum)
+        hi = range_bytes + int((i + 1) * stratum) - range_bytes
+        plan.append((int(rng.integers(lo, hi + 1)), range_bytes))
+    return plan
+
+def _parse_records(text: str) -> list:
+    parser = CsvStreamParser()
+    return parser.feed(text) + parser.close()
+
+def _last_record_end(data: bytes, start: int) -> int:
+    """Offset just past the last unquoted newline after start (start if none)"""
+    quotes = data.count(b'"', start)
+    end = len(data)
+    while True:
+        nl = data.rfind(b'\n', start, end)
+        if nl == -1:
+            return start
+        quotes -= data.count(b'"', nl, end)
+        if quotes % 2 == 0:
+            return nl + 1
+        end = nl
+
+def _split_clusters(data: bytes, start: int, complete: bool) -> list:
+    """Cut data[start:] into pieces of about APPROX_CLUSTER_BYTES whole records.
+
+    Unless the data runs to the end of the file, the trailing partial record
+    is dropped.
+    """
+    f = io.BytesIO(data)
+    pieces = []
+    while start < len(data):
+        cut = start + APPROX_CLUSTER_BYTES
+        if cut < len(data):
+            end = _find_record_boundary(f, cut, bool(data.count(b'"', start, cut) % 2))
+        else:
+            end = len(data)
+        if end >= len(data) and not complete:
+            end = _last_record_end(data, start)
+        if end <= start:
+            break
+        pieces.append(data[start:end])
+        start = end
+    return pieces
+
+def _parse_clusters(data: bytes, start: int, complete: bool) -> list:
+    """(bytes, parsed rows) for each cluster of data[start:]"""
+    return [(len(piece), _parse_records(piece.decode('utf-8', errors='ignore')))
+            for piece in _split_clusters(data, start, complete)]
+
+def _width_match(clusters: list, width: int) -> float:
+    """Share of parsed rows with exactly `width` fields"""
+    rows = [row for _, cluster in clusters for row in cluster]
+    return sum(1 for row in rows if len(row) == width) / len(rows) if rows else 0.0
+
+def _inflate_head(data: bytes) -> tuple:
+    """Decompress the head of a compressed stream, up to APPROX_INFLATE_LIMIT.
+
+    Returns (decompressed bytes, compressed bytes consumed, whole stream read).
+    """
+    consumed = 0
+
+    def chunks():
+        nonlocal consumed
+        for i in range(0, len(data), APPROX_CLUSTER_BYTES):
+            consumed = min(len(data), i + APPROX_CLUSTER_BYTES)
+            yield data[i:i + APPROX_CLUSTER_BYTES]
+
+    out = []
+    size = 0
+    finished = True
+    try:
+        for chunk in decompress_chunks(chunks())[1]:
+            out.append(chunk)
+            size += len(chunk)
+            if size >= APPROX_INFLATE_LIMIT:
+                finished = False
+                break
+    except (EOFError, OSError, ValueError, zlib.error, lzma.LZMAError):
+        finished = False  # the sample stops mid-stream
+    return b''.join(out), consumed, finished
+
+def _ratio_estimate(y: np.ndarray, x: np.ndarray, coverage: float) -> tuple:
+    """Ratio sum(y)/sum(x) over sampled clusters and its APPROX_Z half-width.
+
+    The half-width is None with fewer than two clusters and shrinks to 0 as
+    the sample covers the whole file.
+    """
+    ratio = float(y.sum() / x.sum()) if x.sum() else 0.0
+    if coverage >= 1:
+        return ratio, 0.0
+    n = len(x)
+    if n < 2:
+        return ratio, None
+    se = np.sqrt(((y - ratio * x) ** 2).sum() / (n * (n - 1))) / x.mean()
+    return ratio, float(APPROX_Z * se * np.sqrt(1 - coverage))
+
+def estimate_from_blocks(blocks: list, total_bytes: int, filename: str) -> dict:
+    """Estimate the headline statistics of a file from sampled byte ranges.
+
+    blocks are (offset, bytes) pairs and must include offset 0 for the header.
+    Each block is cut into clusters of whole records; the row count is a
+    ratio estimate of rows per byte and the rates are ratio estimates across
+    sampled ranges (or across the clusters of a head-only sample), each with
+    a normal-approximation interval. A head-only sample is one contiguous
+    run, so its intervals assume the head is typical of the rest of the
+    file. Compressed files are estimated from the decompressed head, scaled
+    by the share of compressed bytes read.
+    """
+    blocks = sorted(blocks)
+    if not blocks or blocks[0][0] != 0:
+        raise ValueError("The sample must start at the beginning of the file")
+    sampled_bytes = sum(len(data) for _, data in blocks)
+    total = total_bytes
+    compression = detect_compression(blocks[0][1][:8])
+    if compression is not None:
+        inflated, consumed, finished = _inflate_head(blocks[0][1])
+        blocks = [(0, inflated)]
+        if finished and total_bytes and consumed >= total_bytes:
+            total = len(inflated)
+        else:
+            total = len(inflated) * total_bytes / consumed if total_bytes and consumed else None
+
+    headers = None
+    header_bytes = 0
+    clusters = []  # (block, bytes, rows, nulls, youtube rows)
+    for index, (offset, data) in enumerate(blocks):
+        complete = bool(total) and offset + len(data) >= total
+        f = io.BytesIO(data)
+        if offset == 0:
+            start = header_bytes = _find_record_boundary(f, 0, False)
+            records = _parse_records(data[:start].decode('utf-8', errors='ignore'))
+            headers = records[0] if records else None
+            pieces = _parse_clusters(data, start, complete)
+        else:
+            # A wrong quote-state guess misaligns every record, so keep whichever
+            # reading gives more rows of the header's width
+            guess = _guess_quote_state(data[:PARALLEL_SPECULATION_WINDOW])
+            readings = [_parse_clusters(data, _find_record_boundary(f, 0, state), complete)
+                        for state in (guess, not guess)]
+            pieces = max(readings, key=lambda r: _width_match(r, len(headers or ())))
+        for size, rows in pieces:
+            nulls = sum(1 for row in rows for cell in row if not cell or cell == 'null')
+            youtube = sum(1 for row in rows if 'YouTube' in row[0])
+            clusters.append((index, size, len(rows), nulls, youtube))
+    if not headers or not clusters:
+        raise ValueError("The sample holds no complete data rows; read more bytes")
+
+    totals = np.array(clusters, dtype=float)
+    if len(blocks) > 1:
+        # Clusters cut from one range are correlated, so each range is one sampling unit
+        index = totals[:, 0].astype(np.int64)
+        totals = np.stack([np.bincount(index, weights=totals[:, k]) for k in range(5)], axis=1)
+        totals = totals[np.bincount(index) > 0]
+    _, size, rows, nulls, youtube = totals.T
+    columns = len(headers)
+    sampled_rows = int(rows.sum())
+    data_bytes = total - header_bytes if total else None
+    coverage = min(1.0, size.sum() / data_bytes) if data_bytes else 0.0
+    exact = coverage >= 1 and len(blocks) == 1
+
+    result = {
+        "status": "success",
+        "approximate": not exact,
+        "sampled_bytes": sampled_bytes,
+        "total_bytes": total_bytes,
+        "coverage": round(float(coverage) * 100, 2),
+        "compression": compression,
+        "clusters": len(clusters),
+        "sampled_rows": sampled_rows,
+        "headers": headers,
+        "columns": columns,
+        "rows": None,
+        "rows_interval": None,
+    }
+    if data_bytes:
+        per_byte, half = _ratio_estimate(rows, size, coverage)
+        estimate = per_byte * data_bytes
+        result['rows'] = sampled_rows if exact else round(estimate)
+        if half is not None:
+            low = max(sampled_rows, round(estimate - half * data_bytes))
+            result['rows_interval'] = [min(low, result['rows']), max(result['rows'], round(estimate + half * data_bytes))]
+
+    null_rate, null_half = _ratio_estimate(nulls, rows * columns, coverage)
+    share, share_half = _ratio_estimate(youtube, rows, coverage)
+
+    def interval(value, half, scale=100):
+        if half is None:
+            return None
+        return [round(max(0.0, value - half) * scale, 2), round(min(1.0, value + half) * scale, 2)]
+
+    result['null_rate'] = round(null_rate * 100, 2)
+    result['null_rate_interval'] = interval(null_rate, null_half)
+    result['completeness'] = round(100 - null_rate * 100, 2)
+    result['completeness_interval'] = (
+        None if null_half is None else [round(100 - b, 2) for b in reversed(result['null_rate_interval'])]
+    )
+    result['youtube_share'] = round(share * 100, 2)
+    result['youtube_share_interval'] = interval(share, share_half)
+
+    classification = classify_from_counts(filename, headers, sampled_rows, int(youtube.sum()))
+    result['dataset_type'] = classification['type']
+    result['dataset_type_certain'] = share_half is not None and (
+        share - share_half > 0.5 or share + share_half < 0.5
+    )
+
+    rows_low, rows_high = result['rows_interval'] or [result['rows'] or sampled_rows] * 2
+    null_low, null_high = result['null_rate_interval'] or [result['null_rate']] * 2
+    result['quality_score_interval'] = [
+        calculate_quality_score(rows_low, round(rows_low * columns * null_high / 100), columns),
+        calculate_quality_score(rows_high, round(rows_high * columns * null_low / 100), columns),
+    ]
+    return result
+
+
+# Metrics
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _metric_labels(names: tuple, values: tuple, le: str = None) -> str:
+    """Prometheus label set, escaped per the text exposition format"""
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _metric_number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class MetricsRegistry:
+    """Counters, gauges and histograms rendered in the Prometheus text format.
+
+    Metrics are declared once with their label names; inc(), set() and
+    observe() then take the label values as keywords. A gauge may instead
+    be given a function, which is read whenever the registry is rendered.
+    Safe to update from any thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = OrderedDict()
+
+    def _declare(self, name: str, kind: str, help_text: str, labels: tuple, **extra):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = {"kind": kind, "help": help_text, "labels": tuple(labels), "series": {}, **extra}
+            return self._metrics[name]
+
+    def counter(self, name: str, help_text: str, labels: tuple = ()):
+        if not name.endswith("_total"):
+            raise ValueError(f"Counter '{name}' must end in _total")
+        self._declare(name, "counter", help_text, labels)
+
+    def gauge(self, name: str, help_text: str, labels: tuple = (), fn=None):
+        self._declare(name, "gauge", help_text, labels, fn=fn)
+
+    def histogram(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = METRICS_LATENCY_BUCKETS):
+        self._declare(name, "histogram", help_text, labels, buckets=tuple(sorted(buckets)))
+
+    def _series(self, name: str, kind: str, labels: dict):
+        metric = self._metrics.get(name)
+        if metric is None or metric['kind'] != kind:
+            raise ValueError(f"No {kind} named '{name}'")
+        if set(labels) != set(metric['labels']):
+            raise ValueError(f"Metric '{name}' takes labels {list(metric['labels'])}, got {sorted(labels)}")
+        return metric, tuple(str(labels[label]) for label in metric['labels'])
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if value < 0:
+            raise ValueError("Counters only go up")
+        with self._lock:
+            metric, key = self._series(name, "counter", labels)
+            metric['series'][key] = metric['series'].get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            metric, key = self._series(name, "gauge", labels)
+            metric['series'][key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        with self._lock:
+            metric, key = self._series(name, "histogram", labels)
+            series = metric['series'].get(key)
+            if series is None:
+                series = metric['series'][key] = {"buckets": [0] * len(metric['buckets']), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(metric['buckets']):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self) -> str:
+        """The registry in the Prometheus text exposition format (version 0.0.4)"""
+        with self._lock:
+            metrics = [(name, dict(metric, series=dict(metric['series']))) for name, metric in self._metrics.items()]
+        lines = []
+        for name, metric in metrics:
+            series = metric['series']
+            if metric.get('fn') is not None:
+                try:
+                    series = {(): metric['fn']()}
+                except Exception:
+                    continue
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['kind']}")
+            labels = metric['labels']
+            for key, value in sorted(series.items()):
+                if metric['kind'] != "histogram":
+                    lines.append(f"{name}{_metric_labels(labels, key)} {_metric_number(value)}")
+                    continue
+                for bound, count in zip(metric['buckets'] + (math.inf,), value['buckets'] + [value['count']]):
+                    lines.append(f"{name}_bucket{_metric_labels(labels, key, _metric_number(bound))} {count}")
+                lines.append(f"{name}_sum{_metric_labels(labels, key)} {_metric_number(value['sum'])}")
+                lines.append(f"{name}_count{_metric_labels(labels, key)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """Write the rendered registry to a file atomically, for runs nobody scrapes"""
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(temp_path, path)
+
+def serve_metrics(registry: MetricsRegistry, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Expose the registry on http://host:port/metrics from a daemon thread"""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+class ActiveSessions:
+    """Sessions that reran the script within the last few minutes"""
+
+    def __init__(self, window: float = METRICS_SESSION_WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        self._seen = {}
+
+    def touch(self, session_id: str):
+        with self._lock:
+            self._seen[session_id] = time.time()
+
+    def count(self) -> int:
+        cutoff = time.time() - self.window
+        with self._lock:
+            for session_id in [s for s, seen in self._seen.items() if seen < cutoff]:
+                del self._seen[session_id]
+            return len(self._seen)
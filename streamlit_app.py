@@ -1,11 +1,108 @@
 import streamlit as st
 import pandas as pd
+import altair as alt
 import requests
 import boto3
 from datetime import datetime
+import base64
+import csv
+import hashlib
+import hmac
+import html
 import io
+import ipaddress
+import itertools
+import json
+import logging
+import logging.handlers
+import math
+import os
+import shutil
 import re
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from urllib.parse import quote, unquote, urlparse
+from xml.etree import ElementTree
 from botocore.exceptions import ClientError
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from pipeline_engine import (
+    ActiveSessions,
+    DEFAULT_QUALITY_RULES,
+    CsvStreamParser,
+    JobScheduler,
+    METRICS_THROUGHPUT_BUCKETS,
+    MetricsRegistry,
+    PARALLEL_MIN_BYTES,
+    PreviewStore,
+    SKETCH_DEPTH,
+    STAGE_BUILTIN,
+    TOLERANT_MAX_FIELD_SIZE,
+    TOLERANT_MAX_RECORD_SIZE,
+    checkpoint_path,
+    YOUTUBE_ID_PATTERN,
+    decompress_chunks,
+    detect_compression,
+    estimate_from_blocks,
+    estimate_job_memory,
+    iter_text,
+    pa,
+    parse_search,
+    plan_sample_ranges,
+    purge_checkpoints,
+    reference_columns,
+    run_pipeline_job,
+    serve_metrics,
+    validate_lookup,
+    validate_rules,
+    validate_stages,
+    validate_windows,
+    weighted_pass_rate,
+)
+
+# Fetch tuning
+FETCH_CHUNK_SIZE = 1024 * 1024
+FETCH_SPOOL_MAX_MEMORY = 32 * 1024 * 1024
+FETCH_MAX_WORKERS = 4
+AZURE_PARALLEL_THRESHOLD = 8 * 1024 * 1024
+AZURE_BLOCK_SIZE = 4 * 1024 * 1024
+AZURE_DOWNLOAD_WORKERS = 4
+AZURE_LIST_LIMIT = 500
+APPROX_FETCH_WORKERS = 8
+APPROX_HEAD_MB = 4
+APPROX_RANGES = 16
+APPROX_RANGE_KB = 256
+JOB_POLL_INTERVAL = 0.5
+# Scales the staged connect/produce delays; 0 skips them (see benchmark_reruns.py)
+SIMULATED_LATENCY = float(os.environ.get("PIPELINE_SIMULATED_LATENCY", 1))
+JOB_STAGING_DIR = os.path.join(tempfile.gettempdir(), "transparent_pipeline", "jobs")
+CHECKPOINT_DIR = os.path.join(tempfile.gettempdir(), "transparent_pipeline", "checkpoints")
+LOOKUP_REFERENCE_DIR = os.path.join(tempfile.gettempdir(), "transparent_pipeline", "reference")
+LOOKUP_CACHE_DIR = os.path.join(tempfile.gettempdir(), "transparent_pipeline", "lookup")
+# Directories whose files a lookup reference may be read from by server path; unset allows uploads only
+LOOKUP_LOCAL_DIRS = [os.path.realpath(d) for d in os.environ.get("PIPELINE_LOOKUP_DIRS", "").split(os.pathsep) if d]
+LOOKUP_EXTRACTIONS = {"YouTube video ID (v=)": YOUTUBE_ID_PATTERN, "Whole value": None, "Custom regex": None}
+LOOKUP_INDEX_SOURCES = {"built": "built", "disk": "loaded from cache", "memory": "reused in memory"}
+HISTORY_DB_PATH = os.environ.get(
+    "PIPELINE_HISTORY_DB", os.path.join(os.path.expanduser("~"), ".transparent_pipeline", "history.sqlite3")
+)
+HISTORY_RECENT_LIMIT = 50
+WINDOW_CHART_LIMIT = 500
+SEARCH_CHART_ROWS = 500_000
+SEARCH_SAMPLE_ROWS = 20
+STAGE_LABELS = {1: "Connecting", 2: "Validating", 3: "Producing", 4: "Completed"}
+# Where a custom stage runs in the stage schedule when no dependencies are picked: (after, before)
+STAGE_POSITION_DEPENDENCIES = {
+    "After Ingestion": (["parse"], []),
+    "After Validation": (["quality"], []),
+    "After Kafka Production": (["classify"], []),
+    "Pre-Analytics": (["quality"], ["insights", "charts"]),
+}
 
 st.set_page_config(
     page_title="The Transparent Pipeline",
@@ -362,9 +459,99 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# Log store
+LOG_CAPACITY = 5000
+LOG_CONSOLE_TAIL = 200
+LOG_FILE_MAX_BYTES = 5 * 1024 * 1024
+LOG_FILE_BACKUPS = 3
+LOG_ICONS = {
+    "INFO": "🔵",
+    "SUCCESS": "🟢",
+    "ERROR": "🔴",
+    "WARNING": "🟡"
+}
+
+class LogStore:
+    """Fixed-capacity ring buffer of console log entries.
+
+    Each entry's console HTML is rendered once on append, so drawing the
+    console is a join over the visible tail rather than over every log.
+    """
+
+    def __init__(self, capacity: int = LOG_CAPACITY, file_logger: logging.Logger = None):
+        self.entries = deque(maxlen=capacity)
+        self.total = 0
+        self.file_logger = file_logger
+
+    def append(self, message: str, level: str = "INFO") -> dict:
+        now = datetime.now()
+        entry = {
+            "time": now.strftime("%H:%M:%S"),
+            "level": level,
+            "message": message,
+        }
+        icon = LOG_ICONS.get(level, "⚪")
+        # Messages carry rule names, file headers and error text, so only the markup around them is trusted
+        entry["html"] = (
+            f'<div class="log-entry log-{level.lower()}">{icon} [{entry["time"]}] '
+            f'<strong>{level}</strong> - {html.escape(message)}</div>'
+        )
+        self.entries.append(entry)
+        self.total += 1
+        if self.file_logger is not None:
+            self.file_logger.info(json.dumps({"timestamp": now.isoformat(), "level": level, "message": message}, ensure_ascii=False))
+        return entry
+
+    @property
+    def dropped(self) -> int:
+        """Entries evicted from the ring buffer"""
+        return self.total - len(self.entries)
+
+    def tail(self, count: int = LOG_CONSOLE_TAIL, levels=None) -> list:
+        """Return the newest entries, oldest first, optionally limited to some levels"""
+        picked = []
+        for entry in reversed(self.entries):
+            if levels is None or entry["level"] in levels:
+                picked.append(entry)
+                if len(picked) >= count:
+                    break
+        picked.reverse()
+        return picked
+
+    def to_jsonl(self, levels=None) -> str:
+        return ''.join(
+            json.dumps({k: v for k, v in entry.items() if k != "html"}, ensure_ascii=False) + '\n'
+            for entry in self.entries
+            if levels is None or entry["level"] in levels
+        )
+
+    def clear(self):
+        self.entries.clear()
+        self.total = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+@st.cache_resource
+def get_log_file_logger():
+    """Rotating JSONL log shared by all sessions, enabled with PIPELINE_LOG_FILE"""
+    path = os.environ.get("PIPELINE_LOG_FILE")
+    if not path:
+        return None
+    logger = logging.getLogger("transparent_pipeline.console")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    return logger
+
 # Initialize session state
 if 'logs' not in st.session_state:
-    st.session_state.logs = []
+    st.session_state.logs = LogStore(file_logger=get_log_file_logger())
 if 'pipeline_running' not in st.session_state:
     st.session_state.pipeline_running = False
 if 'stats' not in st.session_state:
@@ -379,238 +566,1157 @@ if 'source_type' not in st.session_state:
 # Helper functions
 def add_log(message: str, level: str = "INFO"):
     """Add log entry with timestamp"""
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    st.session_state.logs.append({
-        "time": timestamp,
-        "level": level,
-        "message": message
-    })
+    st.session_state.logs.append(message, level)
 
 def update_step(step_num: int):
-    """Update current processing step"""
+    """Update current processing step, timing the step it leaves"""
+    now = time.time()
+    previous = st.session_state.current_step
+    if previous in STAGE_LABELS and 'stage_started' in st.session_state:
+        timings = st.session_state.setdefault('stage_timings', {})
+        timings[STAGE_LABELS[previous]] = now - st.session_state.stage_started
+    st.session_state.stage_started = now
     st.session_state.current_step = step_num
 
-def parse_csv_proper(file_content: str) -> list:
-    """RFC 4180 CSV Parser"""
-    rows = []
-    current = []
-    current_field = ''
-    inside_quotes = False
-    
-    i = 0
-    while i < len(file_content):
-        char = file_content[i]
-        next_char = file_content[i + 1] if i + 1 < len(file_content) else None
-        
-        if char == '"':
-            if inside_quotes and next_char == '"':
-                current_field += '"'
-                i += 1
-            else:
-                inside_quotes = not inside_quotes
-        elif char == ',' and not inside_quotes:
-            current.append(current_field.strip())
-            current_field = ''
-        elif (char in ['\n', '\r']) and not inside_quotes:
-            if current_field or len(current) > 0:
-                current.append(current_field.strip())
-                if any(field for field in current):
-                    rows.append(current)
-                current = []
-                current_field = ''
-            if char == '\r' and next_char == '\n':
-                i += 1
-        else:
-            current_field += char
-        
-        i += 1
-    
-    if current_field or len(current) > 0:
-        current.append(current_field.strip())
-        if any(field for field in current):
-            rows.append(current)
-    
-    return rows
-
-def classify_dataset(filename: str, headers: list, data: list) -> dict:
-    """Detect dataset type"""
-    name = filename.lower()
-    dataset_type = "📊 Generic Dataset"
-    confidence = 0
-    
-    if 'youtube' in name or 'myactivity' in name:
-        dataset_type = '🎥 YouTube Activity History'
-        confidence = 95
-    elif 'netflix' in name:
-        dataset_type = '📺 Netflix Viewing History'
-        confidence = 90
-    elif 'amazon' in name or 'orders' in name:
-        dataset_type = '🛒 E-commerce Orders'
-        confidence = 85
-    elif 'spotify' in name or 'music' in name:
-        dataset_type = '🎵 Music Streaming Activity'
-        confidence = 90
-    elif 'fitness' in name or 'health' in name:
-        dataset_type = '🏃 Fitness Data'
-        confidence = 85
-    elif 'bank' in name or 'transaction' in name:
-        dataset_type = '💳 Financial Transactions'
-        confidence = 80
-    
-    if headers and len(data) > 0:
-        first_col = [row[0] if len(row) > 0 else '' for row in data]
-        youtube_count = sum(1 for val in first_col if 'YouTube' in str(val))
-        if youtube_count > len(data) * 0.5:
-            dataset_type = '🎥 YouTube Activity History'
-            confidence = 98
-    
-    return {"type": dataset_type, "confidence": confidence}
-
-def calculate_quality_score(rows_count: int, nulls_count: int, columns_count: int) -> int:
-    """Calculate quality score (0-100)"""
-    score = 0
-    total_cells = rows_count * columns_count if columns_count > 0 else 1
-    null_percent = (nulls_count / total_cells) * 100 if total_cells > 0 else 0
-    completeness = max(0, 100 - null_percent)
-    score += (completeness / 100) * 35
-    size_score = min(25, (rows_count / 100) * 5)
-    score += size_score
-    score += 20  # Diversity
-    score += 18  # Freshness
-    return round(score)
-
-def process_csv_file(file_content: str, filename: str) -> dict:
-    """Process CSV and return statistics"""
-    try:
-        all_rows = parse_csv_proper(file_content)
-        
-        if len(all_rows) < 2:
-            raise ValueError("CSV must have at least header and one data row")
-        
-        headers = all_rows[0]
-        data_rows = all_rows[1:]
-        
-        rows = len(data_rows)
-        columns = len(headers)
-        
-        nulls = 0
-        for row in data_rows:
-            for cell in row:
-                if not cell or cell == '' or cell == 'null':
-                    nulls += 1
-        
-        classification = classify_dataset(filename, headers, data_rows)
-        quality_score = calculate_quality_score(rows, nulls, columns)
-        
-        insights = ""
-        if "YouTube" in classification['type']:
-            activity_types = [row[0] for row in data_rows if len(row) > 0]
-            youtube_count = sum(1 for a in activity_types if 'YouTube' in str(a) and 'Music' not in str(a))
-            music_count = sum(1 for a in activity_types if 'Music' in str(a))
-            youtube_pct = round((youtube_count / rows) * 100) if rows > 0 else 0
-            music_pct = round((music_count / rows) * 100) if rows > 0 else 0
-            insights = f"YouTube Videos: {youtube_pct}% | Music: {music_pct}%"
-        
-        return {
-            "rows": rows,
-            "columns": columns,
-            "nulls": nulls,
-            "completeness": round(((rows * columns - nulls) / (rows * columns) * 100)) if (rows * columns) > 0 else 0,
-            "dataset_type": classification['type'],
-            "quality_score": quality_score,
-            "insights": insights,
-            "headers": headers,
-            "status": "success"
-        }
-    
-    except Exception as e:
-        return {
-            "status": "error",
-            "message": str(e)
-        }
+class FetchCancelled(Exception):
+    """Raised inside a fetch when the user cancels the download"""
+
+class FetchError(str):
+    """Failure message from a fetch_from_* function, tagged with the branch that produced it"""
 
-def fetch_from_url(url: str) -> tuple:
+    def __new__(cls, reason: str, message: str):
+        error = super().__new__(cls, message)
+        error.reason = reason
+        return error
+
+
+def _spool_chunks(chunks, total: int = None, progress=None, cancel=None) -> dict:
+    """Stream byte chunks into a spooled temp file, reporting progress"""
+    spool = tempfile.SpooledTemporaryFile(max_size=FETCH_SPOOL_MAX_MEMORY)
+    done = 0
+    for chunk in chunks:
+        if cancel is not None and cancel.is_set():
+            spool.close()
+            raise FetchCancelled()
+        if chunk:
+            spool.write(chunk)
+            done += len(chunk)
+            if progress:
+                progress(done, total)
+    spool.seek(0)
+    return {"body": spool, "bytes": done}
+
+def fetch_from_url(url: str, progress=None, cancel=None) -> tuple:
     """Fetch CSV from public URL"""
     try:
-        response = requests.get(url, timeout=10)
-        if response.status_code == 200:
-            return response.text, True
-        else:
-            return f"Error: HTTP {response.status_code}", False
+        with requests.get(url, timeout=10, stream=True) as response:
+            if response.status_code == 200:
+                total = int(response.headers.get('Content-Length') or 0) or None
+                return _spool_chunks(response.iter_content(FETCH_CHUNK_SIZE), total, progress, cancel), True
+            else:
+                return FetchError("http_status", f"Error: HTTP {response.status_code}"), False
+    except FetchCancelled:
+        raise
     except Exception as e:
-        return f"Error fetching URL: {str(e)}", False
+        return FetchError("request_failed", f"Error fetching URL: {str(e)}"), False
+
+# S3 pushdown
+_FILTER_CONDITION = re.compile(
+    r"""\s*(?P<col>"[^"]+"|[A-Za-z_]\w*)\s*"""
+    r"""(?P<op><=|>=|!=|<>|=|<|>|NOT\s+LIKE\b|LIKE\b)\s*"""
+    r"""(?P<val>'(?:[^']|'')*'|-?\d+(?:\.\d+)?)\s*""",
+    re.IGNORECASE
+)
+_FILTER_AND = re.compile(r'\s*AND\s+', re.IGNORECASE)
+
+def parse_filter_expression(expression: str) -> list:
+    """Parse `Col op value [AND ...]` into (column, op, value) conditions.
+
+    Values are 'quoted strings' or numbers; ops are = != < <= > >= LIKE NOT LIKE.
+    """
+    conditions = []
+    pos = 0
+    expression = (expression or '').strip()
+    while pos < len(expression):
+        match = _FILTER_CONDITION.match(expression, pos)
+        if not match:
+            raise ValueError(f"Cannot parse filter near: {expression[pos:pos + 30]!r}")
+        column = match.group('col').strip('"')
+        op = ' '.join(match.group('op').upper().split())
+        if op == '<>':
+            op = '!='
+        raw = match.group('val')
+        value = raw[1:-1].replace("''", "'") if raw.startswith("'") else float(raw)
+        conditions.append((column, op, value))
+        pos = match.end()
+        if pos < len(expression):
+            joiner = _FILTER_AND.match(expression, pos)
+            if not joiner:
+                raise ValueError(f"Expected AND near: {expression[pos:pos + 30]!r}")
+            pos = joiner.end()
+    return conditions
+
+def filter_to_sql(columns: list, conditions: list) -> str:
+    """Render a projection and conditions as an S3 Select statement"""
+    def quote(name):
+        return 's."' + name.replace('"', '""') + '"'
+
+    projection = ', '.join(quote(c) for c in columns) if columns else '*'
+    clauses = []
+    for column, op, value in conditions:
+        if isinstance(value, float):
+            clauses.append(f"CAST({quote(column)} AS FLOAT) {op} {value}")
+        else:
+            literal = value.replace("'", "''")
+            clauses.append(f"{quote(column)} {op} '{literal}'")
+    sql = f"SELECT {projection} FROM S3Object s"
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    return sql
+
+def _like_to_regex(pattern: str):
+    escaped = ''.join('.*' if c == '%' else '.' if c == '_' else re.escape(c) for c in pattern)
+    return re.compile(escaped + r'\Z', re.DOTALL)
+
+def make_row_filter(headers: list, columns: list, conditions: list):
+    """Build (predicate, projection) over parsed rows mirroring filter_to_sql"""
+    index = {name: i for i, name in enumerate(headers)}
+    for name in list(columns or []) + [c[0] for c in conditions]:
+        if name not in index:
+            raise ValueError(f"Unknown column '{name}'. Available: {', '.join(headers)}")
+
+    checks = []
+    for column, op, value in conditions:
+        i = index[column]
+        if op in ('LIKE', 'NOT LIKE'):
+            regex = _like_to_regex(value)
+            negate = op == 'NOT LIKE'
+            checks.append(lambda row, i=i, r=regex, n=negate: (i < len(row) and r.match(row[i]) is not None) != n)
+        else:
+            compare = {
+                '=': lambda a, b: a == b, '!=': lambda a, b: a != b,
+                '<': lambda a, b: a < b, '<=': lambda a, b: a <= b,
+                '>': lambda a, b: a > b, '>=': lambda a, b: a >= b,
+            }[op]
+
+            def check(row, i=i, value=value, compare=compare):
+                if i >= len(row):
+                    return False
+                cell = row[i]
+                if isinstance(value, float):
+                    try:
+                        cell = float(cell)
+                    except ValueError:
+                        return False
+                return compare(cell, value)
+            checks.append(check)
 
-def fetch_from_s3(s3_uri: str, aws_key: str = None, aws_secret: str = None) -> tuple:
+    projection = [index[c] for c in columns] if columns else None
+
+    def predicate(row):
+        return all(check(row) for check in checks)
+
+    return predicate, projection
+
+def _csv_line(fields: list) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerow(fields)
+    return buffer.getvalue().encode('utf-8')
+
+def _s3_select_compression(key: str) -> str:
+    """Compression types S3 Select can read; None means it cannot scan the object"""
+    name = key.lower()
+    if name.endswith('.gz'):
+        return 'GZIP'
+    if name.endswith('.bz2'):
+        return 'BZIP2'
+    if name.endswith(('.csv', '.txt', '.tsv')) or '.' not in name.split('/')[-1]:
+        return 'NONE'
+    return None
+
+def _s3_header(s3_client, bucket_name: str, key: str) -> list:
+    """Read just enough of the object to parse its header row"""
+    body = s3_client.get_object(Bucket=bucket_name, Key=key)['Body']
+    try:
+        _, stream = decompress_chunks(body.iter_chunks(64 * 1024))
+        parser = CsvStreamParser()
+        for text in iter_text(stream):
+            rows = parser.feed(text)
+            if rows:
+                return rows[0]
+        rows = parser.close()
+        return rows[0] if rows else []
+    finally:
+        body.close()
+
+def _s3_select(s3_client, bucket_name: str, key: str, columns: list, conditions: list,
+               compression: str, progress=None, cancel=None) -> dict:
+    """Run the query server-side with S3 Select"""
+    headers = columns or _s3_header(s3_client, bucket_name, key)
+    total = s3_client.head_object(Bucket=bucket_name, Key=key).get('ContentLength')
+    response = s3_client.select_object_content(
+        Bucket=bucket_name,
+        Key=key,
+        ExpressionType='SQL',
+        Expression=filter_to_sql(columns, conditions),
+        InputSerialization={
+            'CSV': {'FileHeaderInfo': 'USE', 'AllowQuotedRecordDelimiter': True},
+            'CompressionType': compression,
+        },
+        OutputSerialization={'CSV': {}},
+        RequestProgress={'Enabled': True},
+    )
+    scan = {"mode": "s3-select", "bytes_scanned": 0, "bytes_returned": 0}
+
+    def records():
+        yield _csv_line(headers)
+        for event in response['Payload']:
+            if 'Records' in event:
+                yield event['Records']['Payload']
+            elif 'Progress' in event and progress:
+                progress(event['Progress']['Details'].get('BytesScanned', 0), total)
+            elif 'Stats' in event:
+                details = event['Stats']['Details']
+                scan['bytes_scanned'] = details.get('BytesScanned', 0)
+                scan['bytes_returned'] = details.get('BytesReturned', 0)
+
+    result = _spool_chunks(records(), cancel=cancel)
+    result['pushdown'] = scan
+    return result
+
+def _s3_filter_client_side(s3_client, bucket_name: str, key: str, columns: list, conditions: list,
+                           progress=None, cancel=None) -> dict:
+    """Stream the whole object and apply the same projection and filter locally"""
+    response = s3_client.get_object(Bucket=bucket_name, Key=key)
+    total = response.get('ContentLength')
+    scan = {"mode": "client", "bytes_scanned": 0, "bytes_returned": 0}
+
+    def raw_chunks():
+        for chunk in response['Body'].iter_chunks(FETCH_CHUNK_SIZE):
+            scan['bytes_scanned'] += len(chunk)
+            if progress:
+                progress(scan['bytes_scanned'], total)
+            yield chunk
+
+    def records():
+        _, stream = decompress_chunks(raw_chunks())
+        parser = CsvStreamParser()
+        predicate = projection = None
+        texts = iter_text(stream)
+        for text in itertools.chain(texts, [None]):
+            rows = parser.feed(text) if text is not None else parser.close()
+            for row in rows:
+                if predicate is None:
+                    predicate, projection = make_row_filter(row, columns, conditions)
+                    yield _csv_line([row[i] for i in projection] if projection else row)
+                    continue
+                if predicate(row):
+                    yield _csv_line([row[i] if i < len(row) else '' for i in projection] if projection else row)
+
+    result = _spool_chunks(records(), cancel=cancel)
+    scan['bytes_returned'] = result['bytes']
+    result['pushdown'] = scan
+    return result
+
+def split_s3_uri(s3_uri: str) -> tuple:
+    """Return (bucket, key) for s3://bucket-name/path/to/file.csv"""
+    s3_path = s3_uri.replace('s3://', '')
+    return s3_path.split('/')[0], '/'.join(s3_path.split('/')[1:])
+
+def s3_client_for(aws_key: str = None, aws_secret: str = None, endpoint_url: str = None):
+    """S3 client with explicit keys, or the default credential chain"""
+    client_kwargs = {'endpoint_url': endpoint_url} if endpoint_url else {}
+    if aws_key and aws_secret:
+        return boto3.client(
+            's3',
+            aws_access_key_id=aws_key,
+            aws_secret_access_key=aws_secret,
+            **client_kwargs
+        )
+    return boto3.client('s3', **client_kwargs)
+
+def fetch_from_s3(s3_uri: str, aws_key: str = None, aws_secret: str = None, columns: list = None,
+                  where: str = None, endpoint_url: str = None, progress=None, cancel=None) -> tuple:
     """Fetch CSV from S3 bucket
     URI format: s3://bucket-name/path/to/file.csv
+    With columns or a where filter, the query is pushed down to S3 Select and
+    falls back to filtering the stream client-side when Select is unavailable.
     """
     try:
         # Parse S3 URI
         if not s3_uri.startswith('s3://'):
-            return "Invalid S3 URI. Use format: s3://bucket-name/path/file.csv", False
+            return FetchError("invalid_uri", "Invalid S3 URI. Use format: s3://bucket-name/path/file.csv"), False
         
-        s3_path = s3_uri.replace('s3://', '')
-        bucket_name = s3_path.split('/')[0]
-        key = '/'.join(s3_path.split('/')[1:])
+        bucket_name, key = split_s3_uri(s3_uri)
+        s3_client = s3_client_for(aws_key, aws_secret, endpoint_url)
         
-        # Create S3 client
-        if aws_key and aws_secret:
-            s3_client = boto3.client(
-                's3',
-                aws_access_key_id=aws_key,
-                aws_secret_access_key=aws_secret
-            )
-        else:
-            s3_client = boto3.client('s3')
+        # Pushdown: project and filter before the bytes leave S3
+        conditions = parse_filter_expression(where) if where else []
+        if columns or conditions:
+            compression = _s3_select_compression(key)
+            if compression is not None:
+                try:
+                    return _s3_select(s3_client, bucket_name, key, columns, conditions, compression, progress, cancel), True
+                except FetchCancelled:
+                    raise
+                except Exception as e:
+                    # Select is unavailable on many accounts and stand-ins; filter locally instead
+                    if isinstance(e, ClientError) and e.response['Error']['Code'] in ('NoSuchKey', 'AccessDenied'):
+                        raise
+            return _s3_filter_client_side(s3_client, bucket_name, key, columns, conditions, progress, cancel), True
         
-        # Get object
+        # Get object and stream the body
         response = s3_client.get_object(Bucket=bucket_name, Key=key)
-        file_content = response['Body'].read().decode('utf-8', errors='ignore')
-        
-        return file_content, True
+        total = response.get('ContentLength')
+        return _spool_chunks(response['Body'].iter_chunks(FETCH_CHUNK_SIZE), total, progress, cancel), True
+    except FetchCancelled:
+        raise
     except ClientError as e:
         if e.response['Error']['Code'] == 'NoSuchKey':
-            return "File not found in S3 bucket", False
+            return FetchError("not_found", "File not found in S3 bucket"), False
         elif e.response['Error']['Code'] == 'AccessDenied':
-            return "Access denied. Check your AWS credentials", False
+            return FetchError("access_denied", "Access denied. Check your AWS credentials"), False
         else:
-            return f"S3 Error: {str(e)}", False
+            return FetchError("service_error", f"S3 Error: {str(e)}"), False
     except Exception as e:
-        return f"Error fetching from S3: {str(e)}", False
+        return FetchError("request_failed", f"Error fetching from S3: {str(e)}"), False
+
+# Azure Blob Storage
+AZURITE_ACCOUNT = "devstoreaccount1"
+AZURITE_KEY = "Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw=="
+
+def _is_path_style_host(hostname: str) -> bool:
+    """Whether an endpoint host names the account in the path (emulators, IP addresses)"""
+    if hostname == "localhost":
+        return True
+    try:
+        ipaddress.ip_address(hostname)
+    except ValueError:
+        return False
+    return True
+
+def parse_azure_connection_string(connection_string: str) -> dict:
+    """Split an Azure Storage connection string into account, key, SAS and blob endpoint"""
+    parts = {}
+    for item in connection_string.strip().strip(';').split(';'):
+        if '=' in item:
+            name, value = item.split('=', 1)
+            parts[name.strip()] = value.strip()
+    if parts.get('UseDevelopmentStorage', '').lower() == 'true':
+        return {
+            "account": AZURITE_ACCOUNT,
+            "key": AZURITE_KEY,
+            "sas": None,
+            "endpoint": f"http://127.0.0.1:10000/{AZURITE_ACCOUNT}",
+        }
+    account = parts.get('AccountName')
+    endpoint = parts.get('BlobEndpoint')
+    if not endpoint:
+        if not account:
+            raise ValueError("Connection string needs AccountName or BlobEndpoint")
+        protocol = parts.get('DefaultEndpointsProtocol', 'https')
+        suffix = parts.get('EndpointSuffix', 'core.windows.net')
+        endpoint = f"{protocol}://{account}.blob.{suffix}"
+    if not account:
+        parsed = urlparse(endpoint)
+        if _is_path_style_host(parsed.hostname):
+            account = parsed.path.strip('/').split('/')[0]  # http://127.0.0.1:10000/devstoreaccount1
+        else:
+            account = parsed.hostname.split('.')[0]
+        if not account:
+            raise ValueError("Cannot tell the account from BlobEndpoint; add AccountName")
+    return {
+        "account": account,
+        "key": parts.get('AccountKey'),
+        "sas": parts.get('SharedAccessSignature'),
+        "endpoint": endpoint.rstrip('/'),
+    }
+
+class AzureBlobClient:
+    """Minimal Blob REST client: SharedKey or SAS auth, listing and ranged reads.
+
+    Works against *.blob.core.windows.net as well as path-style endpoints
+    such as Azurite (http://127.0.0.1:10000/devstoreaccount1).
+    """
+
+    API_VERSION = "2021-08-06"
+
+    def __init__(self, account: str, endpoint: str, key: str = None, sas: str = None):
+        self.account = account
+        self.endpoint = endpoint.rstrip('/')
+        self.key = base64.b64decode(key) if key else None
+        self.sas = sas.lstrip('?') if sas else None
+        self.session = requests.Session()
+
+    def url(self, container: str, blob: str = None) -> str:
+        path = f"{self.endpoint}/{quote(container)}"
+        return f"{path}/{quote(blob)}" if blob else path
+
+    def _sign(self, method: str, url: str, headers: dict, params: dict) -> str:
+        parsed = urlparse(url)
+        canonical_headers = ''.join(
+            f"{name}:{value}\n" for name, value in sorted(
+                (k.lower(), v) for k, v in headers.items() if k.lower().startswith('x-ms-')
+            )
+        )
+        resource = f"/{self.account}{parsed.path}"
+        for name in sorted(params, key=str.lower):
+            resource += f"\n{name.lower()}:{params[name]}"
+        string_to_sign = '\n'.join([
+            method,
+            headers.get('Content-Encoding', ''),
+            headers.get('Content-Language', ''),
+            headers.get('Content-Length', ''),
+            headers.get('Content-MD5', ''),
+            headers.get('Content-Type', ''),
+            '',  # Date (x-ms-date is used instead)
+            headers.get('If-Modified-Since', ''),
+            headers.get('If-Match', ''),
+            headers.get('If-None-Match', ''),
+            headers.get('If-Unmodified-Since', ''),
+            headers.get('Range', ''),
+            canonical_headers + resource,
+        ])
+        digest = hmac.new(self.key, string_to_sign.encode('utf-8'), hashlib.sha256).digest()
+        return f"SharedKey {self.account}:{base64.b64encode(digest).decode()}"
 
-def fetch_from_azure(azure_uri: str, connection_string: str = None) -> tuple:
+    def request(self, method: str, url: str, params: dict = None, headers: dict = None, stream: bool = False):
+        params = dict(params or {})
+        headers = dict(headers or {})
+        headers['x-ms-date'] = formatdate(usegmt=True)
+        headers['x-ms-version'] = self.API_VERSION
+        if self.key is not None:
+            headers['Authorization'] = self._sign(method, url, headers, params)
+        elif self.sas:
+            url += ('&' if '?' in url else '?') + self.sas
+        response = self.session.request(method, url, params=params, headers=headers, timeout=30, stream=stream)
+        if response.status_code >= 400:
+            response.close()
+            raise AzureBlobError(response.status_code, response.headers.get('x-ms-error-code', ''))
+        return response
+
+    def list_blobs(self, container: str, prefix: str = "", limit: int = AZURE_LIST_LIMIT) -> list:
+        """List blobs under a prefix, following continuation markers"""
+        blobs = []
+        marker = None
+        while len(blobs) < limit:
+            params = {"restype": "container", "comp": "list", "prefix": prefix, "maxresults": str(min(5000, limit))}
+            if marker:
+                params["marker"] = marker
+            response = self.request("GET", self.url(container), params)
+            root = ElementTree.fromstring(response.content)
+            for blob in root.iter('Blob'):
+                blobs.append({
+                    "name": blob.findtext('Name'),
+                    "size": int(blob.findtext('Properties/Content-Length') or 0),
+                })
+            marker = root.findtext('NextMarker')
+            if not marker:
+                break
+        return blobs[:limit]
+
+    def blob_size(self, container: str, blob: str) -> int:
+        response = self.request("HEAD", self.url(container, blob))
+        return int(response.headers.get('Content-Length') or 0)
+
+    def read_range(self, container: str, blob: str, start: int, end: int) -> bytes:
+        """Read bytes [start, end] of a blob"""
+        response = self.request("GET", self.url(container, blob), headers={"x-ms-range": f"bytes={start}-{end}"})
+        return response.content
+
+    def iter_blob(self, container: str, blob: str, size: int, cancel=None):
+        """Yield a blob's bytes in order, fetching ranges in parallel for large blobs"""
+        if size <= AZURE_PARALLEL_THRESHOLD:
+            with self.request("GET", self.url(container, blob), stream=True) as response:
+                yield from response.iter_content(FETCH_CHUNK_SIZE)
+            return
+        ranges = [(start, min(start + AZURE_BLOCK_SIZE, size) - 1) for start in range(0, size, AZURE_BLOCK_SIZE)]
+        with ThreadPoolExecutor(max_workers=AZURE_DOWNLOAD_WORKERS, thread_name_prefix="azure") as pool:
+            pending = deque()
+            for start, end in ranges:
+                # Keep a bounded window of blocks in flight and hand them out in order
+                pending.append(pool.submit(self.read_range, container, blob, start, end))
+                if len(pending) >= AZURE_DOWNLOAD_WORKERS * 2:
+                    yield pending.popleft().result()
+                if cancel is not None and cancel.is_set():
+                    for future in pending:
+                        future.cancel()
+                    return
+            while pending:
+                yield pending.popleft().result()
+
+class AzureBlobError(Exception):
+    def __init__(self, status: int, code: str = ""):
+        self.status = status
+        self.code = code
+        super().__init__(f"HTTP {status}{f' ({code})' if code else ''}")
+
+def azure_client_for(azure_uri: str, connection_string: str = None, sas_token: str = None) -> tuple:
+    """Return (client, container, blob path) for a blob URL or a container/blob path"""
+    parsed = urlparse(azure_uri.strip())
+    sas = sas_token or parsed.query or None
+    credentials = parse_azure_connection_string(connection_string) if connection_string else None
+    
+    if parsed.scheme in ('http', 'https'):
+        segments = [unquote(s) for s in parsed.path.lstrip('/').split('/')]
+        host = parsed.netloc
+        if '.blob.' in parsed.hostname:
+            account = parsed.hostname.split('.')[0]
+            endpoint = f"{parsed.scheme}://{host}"
+        else:
+            # Path-style endpoint (Azurite): the account is the first path segment
+            account = segments.pop(0)
+            endpoint = f"{parsed.scheme}://{host}/{account}"
+    elif credentials:
+        segments = azure_uri.strip().lstrip('/').split('/')
+        account = credentials['account']
+        endpoint = credentials['endpoint']
+    else:
+        raise ValueError("Use a full blob URL, or container/path with a connection string")
+    
+    if not segments or not segments[0]:
+        raise ValueError("Azure URI must include a container")
+    key = None
+    if credentials and credentials['account'] == account:
+        key = credentials['key']
+        sas = sas or credentials['sas']
+    client = AzureBlobClient(account, endpoint, key=key, sas=sas)
+    return client, segments[0], '/'.join(segments[1:])
+
+def fetch_from_azure(azure_uri: str, connection_string: str = None, sas_token: str = None,
+                     progress=None, cancel=None) -> tuple:
     """Fetch CSV from Azure Blob Storage
     URI format: https://account.blob.core.windows.net/container/file.csv
+    Private containers need a SAS token (or ?sv=... on the URI) or a connection string.
     """
     try:
-        response = requests.get(azure_uri, timeout=10)
-        if response.status_code == 200:
-            return response.text, True
+        client, container, blob = azure_client_for(azure_uri, connection_string, sas_token)
+        if not blob:
+            return FetchError("invalid_uri", "Azure URI points at a container. Pick a blob to download."), False
+        size = client.blob_size(container, blob)
+        return _spool_chunks(client.iter_blob(container, blob, size, cancel), size, progress, cancel), True
+    except FetchCancelled:
+        raise
+    except AzureBlobError as e:
+        if e.status == 404:
+            return FetchError("not_found", "Blob not found in Azure container"), False
+        elif e.status in (401, 403):
+            return FetchError("access_denied", "Access denied. Check your SAS token or connection string"), False
         else:
-            return f"Error: HTTP {response.status_code}", False
+            return FetchError("service_error", f"Azure Error: {str(e)}"), False
     except Exception as e:
-        return f"Error fetching from Azure: {str(e)}", False
+        return FetchError("request_failed", f"Error fetching from Azure: {str(e)}"), False
+
+def gcs_public_url(gcs_uri: str) -> str:
+    """Convert gs://bucket/key to its public https:// URL"""
+    gcs_path = gcs_uri.replace('gs://', '')
+    bucket_name = gcs_path.split('/')[0]
+    key = '/'.join(gcs_path.split('/')[1:])
+    return f"https://storage.googleapis.com/{bucket_name}/{key}"
 
-def fetch_from_gcs(gcs_uri: str) -> tuple:
+def fetch_from_gcs(gcs_uri: str, progress=None, cancel=None) -> tuple:
     """Fetch CSV from Google Cloud Storage
     URI format: gs://bucket-name/path/to/file.csv
     For public buckets only
     """
     try:
-        # Convert gs:// to https://
-        gcs_path = gcs_uri.replace('gs://', '')
-        bucket_name = gcs_path.split('/')[0]
-        key = '/'.join(gcs_path.split('/')[1:])
-        
-        url = f"https://storage.googleapis.com/{bucket_name}/{key}"
-        response = requests.get(url, timeout=10)
-        
-        if response.status_code == 200:
-            return response.text, True
-        else:
-            return f"Error: HTTP {response.status_code}. Check bucket permissions.", False
+        url = gcs_public_url(gcs_uri)
+        with requests.get(url, timeout=10, stream=True) as response:
+            if response.status_code == 200:
+                total = int(response.headers.get('Content-Length') or 0) or None
+                return _spool_chunks(response.iter_content(FETCH_CHUNK_SIZE), total, progress, cancel), True
+            else:
+                return FetchError("http_status", f"Error: HTTP {response.status_code}. Check bucket permissions."), False
+    except FetchCancelled:
+        raise
+    except Exception as e:
+        return FetchError("request_failed", f"Error fetching from GCS: {str(e)}"), False
+
+# Approximate preview: ranged reads instead of a full download
+def upload_range_reader(uploaded) -> tuple:
+    """(size, read(offset, length), random access) for an uploaded file"""
+    lock = threading.Lock()
+
+    def read(offset: int, length: int) -> bytes:
+        with lock:
+            uploaded.seek(offset)
+            return uploaded.read(length)
+
+    return uploaded.size, read, True
+
+def http_range_reader(url: str) -> tuple:
+    """(size, read(offset, length), random access) for a public HTTP(S) object.
+
+    Servers that ignore Range headers only allow the head to be read.
+    """
+    head = requests.head(url, timeout=10, allow_redirects=True)
+    if head.status_code != 200:
+        raise ValueError(f"HTTP {head.status_code}")
+    size = int(head.headers.get('Content-Length') or 0) or None
+    ranged = head.headers.get('Accept-Ranges', '').lower() == 'bytes'
+
+    def read(offset: int, length: int) -> bytes:
+        headers = {"Range": f"bytes={offset}-{offset + length - 1}"}
+        with requests.get(url, timeout=10, stream=True, headers=headers) as response:
+            if response.status_code == 206:
+                return response.content
+            if response.status_code != 200 or offset != 0:
+                raise ValueError(f"HTTP {response.status_code} for a ranged read")
+            data = bytearray()
+            for chunk in response.iter_content(FETCH_CHUNK_SIZE):
+                data += chunk
+                if len(data) >= length:
+                    break
+            return bytes(data[:length])
+
+    return size, read, ranged
+
+def s3_range_reader(s3_uri: str, aws_key: str = None, aws_secret: str = None, endpoint_url: str = None) -> tuple:
+    """(size, read(offset, length), random access) for an S3 object"""
+    bucket_name, key = split_s3_uri(s3_uri)
+    s3_client = s3_client_for(aws_key, aws_secret, endpoint_url)
+    size = s3_client.head_object(Bucket=bucket_name, Key=key)['ContentLength']
+
+    def read(offset: int, length: int) -> bytes:
+        response = s3_client.get_object(Bucket=bucket_name, Key=key, Range=f"bytes={offset}-{offset + length - 1}")
+        return response['Body'].read()
+
+    return size, read, True
+
+def azure_range_reader(azure_uri: str, connection_string: str = None, sas_token: str = None) -> tuple:
+    """(size, read(offset, length), random access) for an Azure blob"""
+    client, container, blob = azure_client_for(azure_uri, connection_string, sas_token)
+    if not blob:
+        raise ValueError("Azure URI points at a container. Pick a blob to sample.")
+    size = client.blob_size(container, blob)
+    return size, lambda offset, length: client.read_range(container, blob, offset, offset + length - 1), True
+
+def run_estimate(filename: str, reader_fn, *args) -> dict:
+    """Read a sample of the source with ranged reads and estimate its statistics"""
+    started = time.time()
+    try:
+        size, read, ranged = reader_fn(*args)
+        mode = "random" if ranged and st.session_state.approx_mode == "Random ranges" else "head"
+        plan = plan_sample_ranges(
+            size, mode, int(st.session_state.get('approx_head_mb', APPROX_HEAD_MB)) * 1024 * 1024,
+            int(st.session_state.get('approx_ranges', APPROX_RANGES)),
+            int(st.session_state.get('approx_range_kb', APPROX_RANGE_KB)) * 1024
+        )
+        with ThreadPoolExecutor(max_workers=APPROX_FETCH_WORKERS, thread_name_prefix="approx") as pool:
+            blocks = list(zip([offset for offset, _ in plan], pool.map(lambda r: read(*r), plan)))
+        result = estimate_from_blocks(blocks, size, filename)
     except Exception as e:
-        return f"Error fetching from GCS: {str(e)}", False
+        return {"status": "error", "message": str(e)}
+    result['mode'] = mode
+    result['seconds'] = time.time() - started
+    return result
+
+def render_estimate(estimate: dict, exact: dict = None):
+    """Card with the approximate statistics and their 95% intervals, next to the exact run if one finished"""
+    if estimate['status'] != 'success':
+        st.warning(f"Approximate preview failed: {estimate['message']}")
+        return
+
+    def bounds(interval, unit=""):
+        return f"95% CI {interval[0]:,}{unit} – {interval[1]:,}{unit}" if interval else "No interval (one sample)"
+
+    kind = "Estimate" if estimate['approximate'] else "Exact (whole file sampled)"
+    st.markdown(f"**⚡ {kind}**")
+    col_rows, col_nulls, col_complete, col_type = st.columns(4)
+    with col_rows:
+        rows = estimate['rows']
+        st.metric("Rows", f"~{rows:,}" if rows is not None else f"≥{estimate['sampled_rows']:,}")
+        st.caption(bounds(estimate['rows_interval']) if rows is not None else "Size unknown")
+    with col_nulls:
+        st.metric("Null rate", f"{estimate['null_rate']}%")
+        st.caption(bounds(estimate['null_rate_interval'], "%"))
+    with col_complete:
+        st.metric("Completeness", f"{estimate['completeness']}%")
+        st.caption(bounds(estimate['completeness_interval'], "%"))
+    with col_type:
+        st.metric("Dataset", estimate['dataset_type'].split(' ', 1)[0])
+        certainty = "confident" if estimate['dataset_type_certain'] else "uncertain"
+        st.caption(f"{estimate['dataset_type'].split(' ', 1)[-1]} ({certainty}; YouTube rows {estimate['youtube_share']}%)")
+    total = format_bytes(estimate['total_bytes']) if estimate['total_bytes'] else "unknown size"
+    score_low, score_high = estimate['quality_score_interval']
+    st.caption(
+        f"{estimate['mode'].capitalize()} sample: {format_bytes(estimate['sampled_bytes'])} of {total} "
+        f"({estimate['coverage']}% of the data), {estimate['sampled_rows']:,} rows in {estimate['clusters']} clusters, "
+        f"{estimate['seconds']:.2f}s · quality score {score_low}–{score_high}"
+    )
+    if estimate['mode'] == "head" and estimate['approximate']:
+        st.caption("Head intervals assume the rest of the file looks like its first bytes.")
+    if exact and exact.get('status') == 'success':
+        interval = estimate['rows_interval']
+        verdict = ""
+        if interval:
+            verdict = " — inside the interval" if interval[0] <= exact['rows'] <= interval[1] else " — outside the interval"
+        st.caption(f"Exact run: {exact['rows']:,} rows, {exact['completeness']}% complete{verdict}")
+
+# Background fetch manager
+class FetchManager:
+    """Runs source downloads on background threads and tracks their progress.
+
+    Each job is a plain dict keyed by a source key, so several sources can
+    download at once and the script thread only ever reads job state.
+    Finished downloads are counted in the metrics registry, when given one.
+    """
+
+    def __init__(self, max_workers: int = FETCH_MAX_WORKERS, metrics: MetricsRegistry = None):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fetch")
+        self._lock = threading.Lock()
+        self.metrics = metrics
+        self.jobs = {}
+
+    def submit(self, key: str, label: str, fetch_fn, *args) -> dict:
+        """Start a download unless one for this key already exists"""
+        with self._lock:
+            job = self.jobs.get(key)
+            if job is not None:
+                return job
+            job = {
+                "key": key,
+                "label": label,
+                "status": "queued",
+                "bytes": 0,
+                "total": None,
+                "result": None,
+                "error": None,
+                "cancel": threading.Event(),
+                "started": time.time(),
+                "finished": None,
+            }
+            self.jobs[key] = job
+        self._executor.submit(self._run, job, fetch_fn, args)
+        return job
+
+    def _run(self, job: dict, fetch_fn, args: tuple):
+        job['status'] = "running"
+
+        def progress(done, total):
+            job['bytes'] = done
+            job['total'] = total
+
+        try:
+            payload, success = fetch_fn(*args, progress=progress, cancel=job['cancel'])
+            if success:
+                job['result'] = payload
+                job['status'] = "done"
+            else:
+                job['error'] = payload
+                job['status'] = "error"
+        except FetchCancelled:
+            job['status'] = "cancelled"
+        except Exception as e:
+            job['error'] = FetchError("unexpected", f"Unexpected fetch failure: {str(e)}")
+            job['status'] = "error"
+        finally:
+            job['finished'] = time.time()
+            if self.metrics is not None:
+                self._record(job, fetch_fn.__name__.replace("fetch_from_", ""))
+
+    def _record(self, job: dict, source: str):
+        """Count a finished download: bytes and time on success, the failure branch otherwise"""
+        if job['status'] == "done":
+            self.metrics.inc("pipeline_fetch_bytes_total", job['bytes'], source=source)
+            self.metrics.observe("pipeline_fetch_seconds", job['finished'] - job['started'], source=source)
+        elif job['status'] == "error":
+            self.metrics.inc("pipeline_fetch_errors_total", source=source, reason=getattr(job['error'], 'reason', "unknown"))
+        elif job['status'] == "cancelled":
+            self.metrics.inc("pipeline_fetch_cancelled_total", source=source)
+
+    def cancel(self, key: str):
+        job = self.jobs.get(key)
+        if job is not None and job['status'] in ("queued", "running"):
+            job['cancel'].set()
+
+    def forget(self, key: str):
+        """Drop a job so the next submit for this key starts a fresh download"""
+        with self._lock:
+            job = self.jobs.pop(key, None)
+        if job is not None:
+            job['cancel'].set()
+            if job['result']:
+                job['result']['body'].close()
+
+    def clear(self):
+        for key in list(self.jobs):
+            self.forget(key)
+
+    def active_jobs(self) -> list:
+        return [job for job in self.jobs.values() if job['status'] in ("queued", "running")]
+
+def get_fetch_manager() -> FetchManager:
+    """Return this session's fetch manager, creating it on first use"""
+    if 'fetch_manager' not in st.session_state:
+        st.session_state.fetch_manager = FetchManager(metrics=get_metrics())
+    return st.session_state.fetch_manager
+
+def format_bytes(num: float) -> str:
+    """Human readable byte count"""
+    for unit in ["B", "KB", "MB", "GB"]:
+        if num < 1024 or unit == "GB":
+            return f"{num:.1f} {unit}" if unit != "B" else f"{int(num)} B"
+        num /= 1024
+
+def format_seconds(seconds: float) -> str:
+    """Human readable duration"""
+    return f"{seconds * 1000:.0f} ms" if seconds < 1 else f"{seconds:.2f}s"
+
+def fetch_progress_text(job: dict) -> tuple:
+    """Return (fraction, label) describing a job's download progress"""
+    if job['total']:
+        fraction = min(1.0, job['bytes'] / job['total'])
+        return fraction, f"{job['label']} — {format_bytes(job['bytes'])} / {format_bytes(job['total'])} ({fraction * 100:.0f}%)"
+    return 0.0, f"{job['label']} — {format_bytes(job['bytes'])} downloaded"
+
+def start_fetch(source_key: str, label: str, fetch_fn, *args):
+    """Kick off (or look up) a background fetch and return the finished source, if any"""
+    manager = get_fetch_manager()
+    job = manager.submit(source_key, label, fetch_fn, *args)
+    if job['status'] == "done":
+        pushdown = job['result'].get('pushdown')
+        if pushdown:
+            st.caption(
+                f"✅ Pushdown ({pushdown['mode']}): scanned {format_bytes(pushdown['bytes_scanned'])}, "
+                f"returned {format_bytes(pushdown['bytes_returned'])}"
+            )
+        else:
+            st.caption(f"✅ Downloaded {format_bytes(job['bytes'])}")
+        return job['result']
+    if job['status'] == "error":
+        st.error(job['error'])
+    elif job['status'] == "cancelled":
+        st.warning("Download cancelled")
+    if job['status'] in ("error", "cancelled"):
+        if st.button("🔄 Retry download", key=f"retry_{source_key}"):
+            manager.forget(source_key)
+            st.rerun()
+    return None
+
+def render_downloads():
+    """Show progress for every in-flight download, with cancel buttons"""
+    manager = get_fetch_manager()
+    active = manager.active_jobs()
+    if not active:
+        if st.session_state.get('downloads_active'):
+            st.session_state.downloads_active = False
+            st.rerun()
+        return
+    st.session_state.downloads_active = True
+    st.markdown("**⬇️ Downloads**")
+    for job in active:
+        col_bar, col_cancel = st.columns([5, 1])
+        with col_bar:
+            fraction, label = fetch_progress_text(job)
+            st.progress(fraction, text=label)
+        with col_cancel:
+            if st.button("✖", key=f"cancel_{job['key']}", help="Cancel this download"):
+                manager.cancel(job['key'])
+
+def source_key(*parts) -> str:
+    """Stable key for a source, hashing anything that may hold credentials"""
+    return hashlib.sha1("|".join(str(p or '') for p in parts).encode('utf-8')).hexdigest()
+
+# Shared worker pool
+@st.cache_resource
+def get_job_scheduler() -> JobScheduler:
+    """One bounded worker pool shared by every session of this server"""
+    return JobScheduler()
+
+def current_session_id() -> str:
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else "local"
+
+# Metrics
+@st.cache_resource
+def get_active_sessions() -> ActiveSessions:
+    return ActiveSessions()
+
+@st.cache_resource
+def get_metrics() -> MetricsRegistry:
+    """Process-wide metrics, served on PIPELINE_METRICS_PORT when it is set"""
+    metrics = MetricsRegistry()
+    metrics.counter("pipeline_fetch_bytes_total", "Bytes downloaded by finished fetches", ("source",))
+    metrics.histogram("pipeline_fetch_seconds", "Fetch duration from submit to finish, queueing included", ("source",))
+    metrics.counter("pipeline_fetch_errors_total", "Failed fetches by fetch_from_* failure branch", ("source", "reason"))
+    metrics.counter("pipeline_fetch_cancelled_total", "Fetches cancelled by the user", ("source",))
+    metrics.counter("pipeline_runs_total", "Finished pipeline runs", ("status",))
+    metrics.counter("pipeline_rows_parsed_total", "Rows parsed by successful runs", ("source_type",))
+    metrics.histogram("pipeline_parse_rows_per_second", "Parse throughput per run", buckets=METRICS_THROUGHPUT_BUCKETS)
+    metrics.histogram("pipeline_step_seconds", "Time spent in each pipeline step", ("step",))
+    metrics.histogram("pipeline_stage_seconds", "Time spent in each statistics stage; custom stages are pooled", ("stage",))
+    metrics.gauge("pipeline_active_sessions", "Sessions that reran the app in the last 5 minutes", fn=get_active_sessions().count)
+    scheduler = get_job_scheduler()
+    metrics.gauge("pipeline_jobs_running", "Parse jobs running in the shared worker pool", fn=lambda: scheduler.summary()['running'])
+    metrics.gauge("pipeline_jobs_queued", "Parse jobs waiting for a worker", fn=lambda: scheduler.summary()['queued'])
+    port = os.environ.get("PIPELINE_METRICS_PORT")
+    if port:
+        try:
+            serve_metrics(metrics, int(port), os.environ.get("PIPELINE_METRICS_HOST", "127.0.0.1"))
+        except OSError as e:
+            logging.getLogger("transparent_pipeline.metrics").warning("Metrics endpoint not started on port %s: %s", port, e)
+    return metrics
+
+def record_run_metrics(stats: dict, timings: dict):
+    """Count a finished run, and refresh PIPELINE_METRICS_FILE when it is set"""
+    metrics = get_metrics()
+    metrics.inc("pipeline_runs_total", status=stats.get('status', "error"))
+    for step, seconds in timings.items():
+        metrics.observe("pipeline_step_seconds", seconds, step=step)
+    if stats.get('status') == 'success':
+        source_type = st.session_state.get('pipeline_source', {}).get('source_type', "unknown")
+        metrics.inc("pipeline_rows_parsed_total", stats['rows'], source_type=source_type)
+        for stage in stats.get('schedule', []):
+            if stage.get('simulated'):
+                continue
+            name = stage['stage'] if stage['stage'] in STAGE_BUILTIN else "custom"
+            metrics.observe("pipeline_stage_seconds", stage['seconds'], stage=name)
+            if stage['stage'] == "parse" and stage['seconds'] > 0:
+                metrics.observe("pipeline_parse_rows_per_second", stats['rows'] / stage['seconds'])
+    path = os.environ.get("PIPELINE_METRICS_FILE")
+    if path:
+        try:
+            metrics.write(path)
+        except OSError as e:
+            add_log(f"Could not write metrics file: {e}", "WARNING")
+
+get_active_sessions().touch(current_session_id())
+
+def peek_source(source: dict, size: int = 8) -> bytes:
+    body = source['body']
+    body.seek(0)
+    head = body.read(size)
+    body.seek(0)
+    return head
+
+def stage_source(source: dict) -> tuple:
+    """Copy a source body to disk so a worker process can stream it.
+
+    Returns (staged path, SHA-256 fingerprint of the bytes).
+    """
+    os.makedirs(JOB_STAGING_DIR, exist_ok=True)
+    body = source['body']
+    body.seek(0)
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=JOB_STAGING_DIR, suffix=".src", delete=False) as staged:
+        for chunk in iter(lambda: body.read(FETCH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            staged.write(chunk)
+    return staged.name, digest.hexdigest()
+
+def get_preview_store(preview: dict) -> PreviewStore:
+    """Open the run's preview segments once per session"""
+    cached = st.session_state.get('preview_store')
+    if cached is None or cached[0] != preview['segments']:
+        st.session_state.preview_store = (preview['segments'], PreviewStore(preview))
+    return st.session_state.preview_store[1]
+
+def search_charts(store: PreviewStore, segments: list, query: str) -> tuple:
+    """Run a description search and chart its matches, cached per query for the session"""
+    cached = st.session_state.get('search_charts')
+    if cached is None or cached[0] != (segments, query):
+        started = time.perf_counter()
+        ids = store.text.search(query)
+        elapsed = (time.perf_counter() - started) * 1000
+        charts = store.chart_rows(ids[:SEARCH_CHART_ROWS]) if len(ids) else None
+        st.session_state.search_charts = ((segments, query), (ids, elapsed, charts))
+    return st.session_state.search_charts[1]
+
+def discard_run_files(stats: dict):
+    """Delete the quarantine file and preview segments a finished run left on disk"""
+    stats = stats or {}
+    quarantine_path = (stats.get('quarantine') or {}).get('path')
+    if quarantine_path and os.path.exists(quarantine_path):
+        os.remove(quarantine_path)
+    if stats.get('preview'):
+        st.session_state.pop('preview_store', None)
+        shutil.rmtree(stats['preview']['dir'], ignore_errors=True)
+
+def _link_or_copy(source: str, target: str):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+def copy_run_files(result: dict) -> dict:
+    """Give this session its own links to the output files of a job other sessions also watch.
+
+    Each watcher deletes its copies when it moves on; the last one to collect
+    the job keeps the originals. Returns the result with the paths rewritten.
+    """
+    result = dict(result)
+    quarantine = result.get('quarantine')
+    if quarantine and quarantine['path'] and os.path.exists(quarantine['path']):
+        fd, path = tempfile.mkstemp(dir=JOB_STAGING_DIR, suffix=".quarantine.jsonl")
+        os.close(fd)
+        os.remove(path)
+        _link_or_copy(quarantine['path'], path)
+        result['quarantine'] = {**quarantine, "path": path}
+    preview = result.get('preview')
+    if preview:
+        directory = tempfile.mkdtemp(dir=JOB_STAGING_DIR, suffix=".preview")
+        for name in os.listdir(preview['dir']):
+            _link_or_copy(os.path.join(preview['dir'], name), os.path.join(directory, name))
+        moved = lambda path: os.path.join(directory, os.path.basename(path))
+        result['preview'] = {**preview, "dir": directory, "segments": [moved(path) for path in preview['segments']]}
+        if preview.get('text'):
+            chunks = [{**chunk, "path": moved(chunk['path']), "segment": moved(chunk['segment'])}
+                      for chunk in preview['text']['chunks']]
+            result['preview']['text'] = {**preview['text'], "chunks": chunks}
+    return result
+
+# Run history
+class RunHistory:
+    """SQLite store of finished runs, shared by every session of this server.
+
+    Runs are indexed by source and start time, so trend queries for one source
+    and the latest-run overview stay fast with thousands of runs.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY,
+        started_at REAL NOT NULL,
+        finished_at REAL NOT NULL,
+        source_type TEXT,
+        source TEXT NOT NULL,
+        filename TEXT,
+        fingerprint TEXT,
+        bytes INTEGER,
+        status TEXT NOT NULL,
+        message TEXT,
+        rows INTEGER,
+        columns INTEGER,
+        nulls INTEGER,
+        completeness REAL,
+        quality_score REAL,
+        dataset_type TEXT,
+        stats_json TEXT
+    );
+    CREATE INDEX IF NOT EXISTS runs_source_time ON runs (source, started_at);
+    CREATE INDEX IF NOT EXISTS runs_time ON runs (started_at);
+    CREATE INDEX IF NOT EXISTS runs_fingerprint ON runs (fingerprint);
+    CREATE TABLE IF NOT EXISTS run_stages (
+        run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+        stage TEXT NOT NULL,
+        seconds REAL NOT NULL,
+        PRIMARY KEY (run_id, stage)
+    ) WITHOUT ROWID;
+    """
+
+    # Bulky or path-bound parts of a result that are not worth keeping
+    SKIPPED_STATS = ("charts", "preview", "rule_failures", "headers")
+
+    def __init__(self, path: str = HISTORY_DB_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA foreign_keys=ON")
+            self.conn.executescript(self.SCHEMA)
+
+    def record(self, run: dict, stats: dict, stages: dict) -> int:
+        """Store one run with its statistics and per-stage timings"""
+        stats = stats or {}
+        kept = {k: v for k, v in stats.items() if k not in self.SKIPPED_STATS}
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                """INSERT INTO runs (started_at, finished_at, source_type, source, filename, fingerprint, bytes,
+                                     status, message, rows, columns, nulls, completeness, quality_score,
+                                     dataset_type, stats_json)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    run['started_at'], run['finished_at'], run.get('source_type'), run['source'],
+                    run.get('filename'), run.get('fingerprint'), run.get('bytes'),
+                    stats.get('status', 'error'), stats.get('message'), stats.get('rows'), stats.get('columns'),
+                    stats.get('nulls'), stats.get('completeness'), stats.get('quality_score'),
+                    stats.get('dataset_type'), json.dumps(kept, default=str),
+                )
+            )
+            self.conn.executemany(
+                "INSERT INTO run_stages (run_id, stage, seconds) VALUES (?, ?, ?)",
+                [(cursor.lastrowid, stage, seconds) for stage, seconds in stages.items()]
+            )
+        return cursor.lastrowid
+
+    def _query(self, sql: str, params: tuple = ()) -> pd.DataFrame:
+        with self.lock:
+            return pd.read_sql_query(sql, self.conn, params=params)
+
+    def count(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+
+    def sources(self) -> pd.DataFrame:
+        """Latest successful run per source with its change against the run before"""
+        return self._query("""
+            WITH ranked AS (
+                SELECT source, started_at, rows, quality_score,
+                       ROW_NUMBER() OVER (PARTITION BY source ORDER BY started_at DESC) AS newest,
+                       LAG(rows) OVER (PARTITION BY source ORDER BY started_at) AS previous_rows,
+                       LAG(quality_score) OVER (PARTITION BY source ORDER BY started_at) AS previous_quality,
+                       COUNT(*) OVER (PARTITION BY source) AS runs
+                FROM runs WHERE status = 'success'
+            )
+            SELECT source, runs, started_at AS last_run, rows,
+                   rows - previous_rows AS row_change,
+                   quality_score, quality_score - previous_quality AS quality_drift
+            FROM ranked WHERE newest = 1
+            ORDER BY last_run DESC
+        """)
+
+    def trend(self, source: str) -> pd.DataFrame:
+        """Rows and quality of every successful run of one source, oldest first"""
+        return self._query("""
+            SELECT id, started_at, rows, quality_score, completeness, fingerprint,
+                   rows - LAG(rows) OVER (ORDER BY started_at) AS row_change,
+                   quality_score - LAG(quality_score) OVER (ORDER BY started_at) AS quality_drift
+            FROM runs WHERE source = ? AND status = 'success'
+            ORDER BY started_at
+        """, (source,))
+
+    def stage_summary(self, source: str = None) -> pd.DataFrame:
+        """Average and worst seconds per stage, optionally for one source"""
+        where = "WHERE r.source = ?" if source else ""
+        return self._query(f"""
+            SELECT s.stage, COUNT(*) AS runs, AVG(s.seconds) AS avg_seconds, MAX(s.seconds) AS max_seconds
+            FROM run_stages s JOIN runs r ON r.id = s.run_id {where}
+            GROUP BY s.stage
+        """, (source,) if source else ())
+
+    def recent(self, limit: int = HISTORY_RECENT_LIMIT, source: str = None) -> pd.DataFrame:
+        where = "WHERE source = ?" if source else ""
+        return self._query(f"""
+            SELECT id, started_at, finished_at - started_at AS seconds, source_type, source, status,
+                   rows, quality_score, substr(fingerprint, 1, 12) AS fingerprint, message
+            FROM runs {where}
+            ORDER BY started_at DESC LIMIT ?
+        """, ((source,) if source else ()) + (limit,))
+
+@st.cache_resource
+def get_run_history() -> RunHistory:
+    """One history database shared by every session of this server"""
+    return RunHistory()
+
+def record_run(stats: dict):
+    """Add the run that just finished or failed to the history"""
+    timings = dict(st.session_state.get('stage_timings', {}))
+    step = st.session_state.current_step
+    if step in STAGE_LABELS and 'stage_started' in st.session_state:
+        timings[STAGE_LABELS[step]] = time.time() - st.session_state.stage_started
+    run = {
+        "started_at": st.session_state.get('pipeline_started', time.time()),
+        "finished_at": time.time(),
+        **st.session_state.get('pipeline_source', {}),
+        "fingerprint": st.session_state.pop('pipeline_fingerprint', None),
+    }
+    try:
+        get_run_history().record(run, stats, timings)
+    except sqlite3.Error as e:
+        add_log(f"Could not save run history: {e}", "WARNING")
+    record_run_metrics(stats, timings)
 
 # HEADER
 st.markdown("""
@@ -620,6 +1726,182 @@ st.markdown("""
 </div>
 """, unsafe_allow_html=True)
 
+def load_rules(text: str) -> list:
+    """Parse and validate the rules JSON from the sidebar"""
+    try:
+        rules = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Rules are not valid JSON: {e}")
+    return validate_rules(rules)
+
+def stage_reference(uploaded) -> str:
+    """Write an uploaded reference table to disk once, named by its content hash"""
+    staged = st.session_state.get('lookup_staged')
+    if staged and staged[0] == uploaded.file_id and os.path.exists(staged[1]):
+        return staged[1]
+    data = uploaded.getvalue()
+    extension = os.path.splitext(uploaded.name)[1].lower()
+    path = os.path.join(LOOKUP_REFERENCE_DIR, hashlib.sha256(data).hexdigest() + extension)
+    if not os.path.exists(path):
+        os.makedirs(LOOKUP_REFERENCE_DIR, exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+    st.session_state.lookup_staged = (uploaded.file_id, path)
+    return path
+
+def resolve_local_reference(path: str) -> str:
+    """Real path of a server-side reference file, which must lie in one of LOOKUP_LOCAL_DIRS"""
+    real = os.path.realpath(path)
+    if not any(os.path.commonpath([real, directory]) == directory for directory in LOOKUP_LOCAL_DIRS):
+        raise ValueError("Reference paths must be inside " + ", ".join(LOOKUP_LOCAL_DIRS))
+    return real
+
+# SIDEBAR: Pipeline settings
+with st.sidebar:
+    st.markdown('<div class="card-title">⚙️ Pipeline Settings</div>', unsafe_allow_html=True)
+    
+    with st.expander("🧵 Parsing", expanded=True):
+        parse_workers = st.number_input(
+            "Parallel parse workers", min_value=1, max_value=32,
+            value=min(4, os.cpu_count() or 1), key="parse_workers",
+            help=f"Uncompressed files over {PARALLEL_MIN_BYTES // 2 ** 20} MB are split into byte ranges "
+                 "and parsed on this many processes, at most one per CPU. 1 parses serially."
+        )
+        st.toggle(
+            "Checkpoint long runs", value=True, key="checkpoint_enabled",
+            help="Save parse progress to local disk as it goes. Starting the same source with the same settings "
+                 "after a refresh or restart picks up from the last checkpoint, or rejoins the run if it is still going."
+        )
+
+    with st.expander("🛡️ Error Tolerance"):
+        tolerant_parse = st.toggle(
+            "Quarantine malformed records", key="tolerant_parse",
+            help="Rows with the wrong field count, oversized fields and unbalanced quotes are set aside "
+                 "with their line and byte offsets instead of being parsed as ragged rows."
+        )
+        st.number_input("Max field size (KB)", min_value=1, value=TOLERANT_MAX_FIELD_SIZE // 1024, key="max_field_kb")
+        st.number_input("Max record size (KB)", min_value=1, value=TOLERANT_MAX_RECORD_SIZE // 1024, key="max_record_kb")
+        resync_rule = st.selectbox("Resync after a bad record at", ["Next line", "Next line matching pattern"], key="resync_rule")
+        if resync_rule == "Next line matching pattern":
+            st.text_input("Record start pattern (regex)", value=r"YouTube", key="resync_pattern")
+        if tolerant_parse and parse_workers > 1:
+            st.caption("Tolerant parsing runs serially.")
+
+    with st.expander("📏 Quality Rules"):
+        st.toggle("Evaluate data-quality rules", value=True, key="quality_rules_enabled")
+        rules_json = st.text_area(
+            "Rules (JSON)", value=json.dumps(DEFAULT_QUALITY_RULES, indent=2), height=260, key="quality_rules_json",
+            help="Rule types: not_null, regex (pattern), enum (values), range (min/max, optional date format), "
+                 "unique, cross (when/then conditions). Each rule may set a weight in the quality score."
+        )
+        try:
+            st.caption(f"{len(load_rules(rules_json))} rules")
+        except ValueError as e:
+            st.error(str(e))
+
+    with st.expander("🪟 Event-Time Windows"):
+        st.toggle("Aggregate by Date windows", value=True, key="windows_enabled")
+        window_kind = st.radio("Window", ["Tumbling", "Sliding"], horizontal=True, key="window_kind")
+        st.number_input("Size (minutes)", min_value=1, value=60, key="window_size")
+        if window_kind == "Sliding":
+            st.number_input("Slide (minutes)", min_value=1, value=15, key="window_slide",
+                            help="Must divide the window size")
+        st.number_input("Allowed lateness (minutes)", min_value=0, value=60, key="window_lateness",
+                        help="Rows arriving after the watermark has passed their window are counted as late and dropped")
+        st.selectbox("Time order", ["auto", "ascending", "descending"], key="window_order",
+                     help="Exports are usually newest-first; auto detects the order from the first rows")
+
+    with st.expander("🔗 Lookup Enrichment"):
+        st.toggle("Join a reference table", key="lookup_enabled",
+                  help="Appends reference columns to each row by key, e.g. video ID → channel and category")
+        if not LOOKUP_LOCAL_DIRS or st.radio("Reference", ["Upload", "Local path"], horizontal=True,
+                                             key="lookup_source") == "Upload":
+            reference = st.file_uploader("Reference file", type=['csv', 'parquet'], key="lookup_upload")
+            st.session_state.lookup_path = stage_reference(reference) if reference else None
+            st.session_state.lookup_name = reference.name if reference else None
+        else:
+            local_path = st.text_input("Path on the server", key="lookup_local_path",
+                                       placeholder=os.path.join(LOOKUP_LOCAL_DIRS[0], "videos.parquet"),
+                                       help="Allowed directories: " + ", ".join(LOOKUP_LOCAL_DIRS)).strip()
+            st.session_state.lookup_path = None
+            st.session_state.lookup_name = os.path.basename(local_path) or None
+            if local_path:
+                try:
+                    st.session_state.lookup_path = resolve_local_reference(local_path)
+                except ValueError as e:
+                    st.error(str(e))
+        if st.session_state.lookup_path:
+            try:
+                columns = reference_columns(st.session_state.lookup_path)
+            except (OSError, ValueError, pd.errors.ParserError) as e:
+                columns = []
+                st.error(f"Cannot read reference: {e}")
+            if columns:
+                st.selectbox("Reference key column", columns, key="lookup_key")
+                st.multiselect("Columns to add", columns, key="lookup_columns",
+                               help="Leave empty to add every column except the key")
+        st.text_input("Key column in the data", value="URL", key="lookup_source_column")
+        extraction = st.selectbox("Key extraction", list(LOOKUP_EXTRACTIONS), key="lookup_extraction")
+        if extraction == "Custom regex":
+            st.text_input("Pattern (the first capture group is the key)", value=YOUTUBE_ID_PATTERN, key="lookup_pattern")
+        st.caption("The hash index is cached by the reference file's SHA-256 and reused across runs.")
+
+    with st.expander("⚡ Approximate Preview"):
+        approx_mode = st.radio("Sample", ["Random ranges", "Head"], horizontal=True, key="approx_mode",
+                               help="Random ranges need a known size and Range support; otherwise the head is read")
+        if approx_mode == "Head":
+            st.number_input("Head size (MB)", min_value=1, value=APPROX_HEAD_MB, key="approx_head_mb")
+        else:
+            st.number_input("Ranges", min_value=2, max_value=256, value=APPROX_RANGES, key="approx_ranges")
+            st.number_input("Range size (KB)", min_value=16, value=APPROX_RANGE_KB, key="approx_range_kb")
+        st.toggle("Continue with the exact run", value=True, key="approx_continue",
+                  help="Start the full pipeline as soon as the download finishes")
+
+def pipeline_options() -> dict:
+    """Settings forwarded to the parse job"""
+    options = {
+        "parse_workers": int(st.session_state.parse_workers),
+        "tolerance": None,
+        "rules": None,
+        "windows": None,
+        "lookup": None,
+        "stages": validate_stages(st.session_state.custom_stages) if st.session_state.custom_stages else None,
+    }
+    if st.session_state.lookup_enabled:
+        if not st.session_state.get('lookup_path') or not st.session_state.get('lookup_key'):
+            raise ValueError("Choose a reference file and key column for the lookup join")
+        extraction = st.session_state.lookup_extraction
+        key = st.session_state.lookup_key
+        options['lookup'] = validate_lookup({
+            "path": st.session_state.lookup_path,
+            "name": st.session_state.lookup_name,
+            "key": key,
+            "columns": [c for c in st.session_state.get('lookup_columns', []) if c != key] or None,
+            "source_column": st.session_state.lookup_source_column.strip() or "URL",
+            "pattern": st.session_state.get('lookup_pattern') if extraction == "Custom regex" else LOOKUP_EXTRACTIONS[extraction],
+            "cache_dir": LOOKUP_CACHE_DIR,
+        })
+    if st.session_state.windows_enabled:
+        size = int(st.session_state.window_size)
+        options['windows'] = validate_windows({
+            "size": size,
+            "slide": int(st.session_state.window_slide) if st.session_state.window_kind == "Sliding" else size,
+            "lateness": int(st.session_state.window_lateness),
+            "order": st.session_state.window_order,
+        })
+    if st.session_state.quality_rules_enabled:
+        options['rules'] = load_rules(st.session_state.quality_rules_json)
+    if st.session_state.tolerant_parse:
+        pattern = None
+        if st.session_state.resync_rule == "Next line matching pattern":
+            pattern = st.session_state.get('resync_pattern') or None
+        options['tolerance'] = {
+            "max_field_size": int(st.session_state.max_field_kb) * 1024,
+            "max_record_size": int(st.session_state.max_record_kb) * 1024,
+            "resync_pattern": pattern,
+        }
+    return options
+
 # MAIN LAYOUT
 col1, col2 = st.columns(2, gap="large")
 
@@ -636,12 +1918,18 @@ with col1:
     
     file_content = None
     filename = None
+    source_uri = None
+    sampler = None  # (range reader, *args) for the approximate preview
     
     if source_type == "CSV File":
-        uploaded_file = st.file_uploader("Upload CSV (Max 100MB)", type=['csv'])
+        uploaded_file = st.file_uploader(
+            "Upload CSV (Max 100MB)", type=['csv', 'gz', 'bz2', 'xz', 'zst', 'zip'],
+            help="Compressed CSVs (.gz, .bz2, .xz, .zst, .zip) are decompressed on the fly"
+        )
         if uploaded_file:
-            filename = uploaded_file.name
-            file_content = uploaded_file.read().decode('utf-8', errors='ignore')
+            filename = source_uri = uploaded_file.name
+            file_content = {"body": uploaded_file, "bytes": uploaded_file.size}
+            sampler = (upload_range_reader, uploaded_file)
     
     elif source_type == "S3 URI":
         st.markdown("**S3 Storage Path**")
@@ -653,73 +1941,177 @@ with col1:
                 aws_key = st.text_input("AWS Access Key", type="password", placeholder="Leave blank for default credentials")
             with col_secret:
                 aws_secret = st.text_input("AWS Secret Key", type="password", placeholder="Leave blank for default credentials")
+            s3_endpoint = st.text_input("Endpoint URL (Optional)", placeholder="http://localhost:9000 for an S3-compatible stand-in")
+        
+        with st.expander("🎯 Pushdown Query (Optional)"):
+            s3_columns = st.text_input("Columns", placeholder="Activity, Date, URL")
+            s3_where = st.text_input("Filter", placeholder="Activity = 'YouTube' AND Date LIKE 'Nov%'")
+            st.caption("Runs server-side with S3 Select when available, otherwise filters the stream locally.")
+        
+        pushdown_columns = [c.strip() for c in s3_columns.split(',') if c.strip()]
+        pushdown_error = None
+        if s3_where:
+            try:
+                parse_filter_expression(s3_where)
+            except ValueError as e:
+                pushdown_error = str(e)
+                st.error(f"Invalid filter: {pushdown_error}")
         
-        if s3_uri:
-            with st.spinner("Fetching from S3..."):
-                file_content, success = fetch_from_s3(s3_uri, aws_key or None, aws_secret or None)
-                filename = s3_uri.split('/')[-1]
-                if not success:
-                    st.error(file_content)
-                    file_content = None
+        if s3_uri and not pushdown_error:
+            filename = s3_uri.split('/')[-1]
+            source_uri = s3_uri
+            file_content = start_fetch(
+                source_key("s3", s3_uri, aws_key, aws_secret, s3_endpoint, ','.join(pushdown_columns), s3_where),
+                f"S3: {filename}",
+                fetch_from_s3, s3_uri, aws_key or None, aws_secret or None,
+                pushdown_columns, s3_where or None, s3_endpoint or None
+            )
+            if not (pushdown_columns or s3_where):
+                sampler = (s3_range_reader, s3_uri, aws_key or None, aws_secret or None, s3_endpoint or None)
     
     elif source_type == "Azure Blob":
         st.markdown("**Azure Blob Storage**")
-        azure_uri = st.text_input("Azure URI", placeholder="https://account.blob.core.windows.net/container/file.csv")
+        azure_uri = st.text_input(
+            "Azure URI", key="azure_uri",
+            placeholder="https://account.blob.core.windows.net/container/file.csv"
+        )
+        
+        with st.expander("🔑 Azure Credentials (Optional)"):
+            azure_sas = st.text_input("SAS Token", type="password", placeholder="sv=...&sig=...")
+            azure_conn = st.text_input(
+                "Connection String", type="password",
+                placeholder="AccountName=...;AccountKey=... or UseDevelopmentStorage=true"
+            )
+        
+        with st.expander("📂 Browse Container"):
+            col_container, col_prefix = st.columns(2)
+            with col_container:
+                azure_container = st.text_input("Container", placeholder="https://account.blob.core.windows.net/container")
+            with col_prefix:
+                azure_prefix = st.text_input("Prefix", placeholder="exports/2025/")
+            if st.button("List blobs", key="azure_list") and azure_container:
+                try:
+                    client, container, _ = azure_client_for(azure_container, azure_conn or None, azure_sas or None)
+                    st.session_state.azure_listing = {
+                        "base": client.url(container),
+                        "blobs": client.list_blobs(container, azure_prefix),
+                    }
+                except (AzureBlobError, ValueError, requests.RequestException) as e:
+                    st.session_state.azure_listing = None
+                    st.error(f"Could not list container: {str(e)}")
+            listing = st.session_state.get('azure_listing')
+            if listing:
+                blobs = listing['blobs']
+                st.caption(f"{len(blobs)} blobs")
+                if blobs:
+                    picked = st.selectbox(
+                        "Blob", blobs, index=None,
+                        format_func=lambda b: f"{b['name']} ({format_bytes(b['size'])})"
+                    )
+                    if picked:
+                        st.button(
+                            "Use this blob",
+                            on_click=st.session_state.update,
+                            kwargs={"azure_uri": f"{listing['base']}/{quote(picked['name'])}"}
+                        )
         
         if azure_uri:
-            with st.spinner("Fetching from Azure..."):
-                file_content, success = fetch_from_azure(azure_uri)
-                filename = azure_uri.split('/')[-1]
-                if not success:
-                    st.error(file_content)
-                    file_content = None
+            filename = urlparse(azure_uri).path.split('/')[-1] or azure_uri.split('/')[-1]
+            source_uri = azure_uri
+            file_content = start_fetch(
+                source_key("azure", azure_uri, azure_sas, azure_conn), f"Azure: {filename}",
+                fetch_from_azure, azure_uri, azure_conn or None, azure_sas or None
+            )
+            sampler = (azure_range_reader, azure_uri, azure_conn or None, azure_sas or None)
     
     elif source_type == "Google Cloud":
         st.markdown("**Google Cloud Storage (Public)**")
         gcs_uri = st.text_input("GCS URI", placeholder="gs://bucket-name/path/file.csv")
         
         if gcs_uri:
-            with st.spinner("Fetching from GCS..."):
-                file_content, success = fetch_from_gcs(gcs_uri)
-                filename = gcs_uri.split('/')[-1]
-                if not success:
-                    st.error(file_content)
-                    file_content = None
+            filename = gcs_uri.split('/')[-1]
+            source_uri = gcs_uri
+            file_content = start_fetch(source_key("gcs", gcs_uri), f"GCS: {filename}", fetch_from_gcs, gcs_uri)
+            sampler = (http_range_reader, gcs_public_url(gcs_uri))
     
     else:  # Public URL
         st.markdown("**Public CSV URL**")
         url = st.text_input("URL", placeholder="https://raw.githubusercontent.com/user/repo/main/data.csv")
         
         if url:
-            with st.spinner("Fetching file..."):
-                file_content, success = fetch_from_url(url)
-                filename = url.split('/')[-1]
-                if not success:
-                    st.error(file_content)
-                    file_content = None
+            filename = url.split('/')[-1]
+            source_uri = url
+            file_content = start_fetch(source_key("url", url), f"URL: {filename}", fetch_from_url, url)
+            sampler = (http_range_reader, url)
+    
+    # Downloads keep running in the background; only this panel polls for progress
+    if get_fetch_manager().active_jobs():
+        st.fragment(run_every=0.5)(render_downloads)()
+    else:
+        render_downloads()
+    
+    # Approximate preview: sample byte ranges while the full download runs
+    if sampler:
+        if st.button("⚡ Preview estimate", key="approx_run",
+                     help="Estimate rows, null rate and completeness from a sample of byte ranges"):
+            with st.spinner("Sampling byte ranges..."):
+                estimate = run_estimate(filename, *sampler)
+            estimate['source'] = source_uri
+            st.session_state.approx_estimate = estimate
+            if estimate['status'] == 'success':
+                rows = f"~{estimate['rows']:,}" if estimate['rows'] is not None else f"≥{estimate['sampled_rows']:,}"
+                add_log(
+                    f"⚡ Approximate preview: {rows} rows, {estimate['completeness']}% complete "
+                    f"from {format_bytes(estimate['sampled_bytes'])} in {estimate['seconds']:.2f}s", "INFO"
+                )
+                if st.session_state.approx_continue and not st.session_state.pipeline_running:
+                    st.session_state.approx_continue_pending = source_uri
+            else:
+                add_log(f"Approximate preview failed: {estimate['message']}", "WARNING")
+        estimate = st.session_state.get('approx_estimate')
+        if estimate and estimate['source'] == source_uri:
+            exact = None
+            if (st.session_state.get('pipeline_source') or {}).get('source') == (source_uri or '').split('?')[0]:
+                exact = st.session_state.stats
+            render_estimate(estimate, exact)
+            if st.session_state.get('approx_continue_pending') == source_uri and not file_content:
+                st.caption("The exact run starts when the download finishes.")
 
 # RIGHT: Live Console
 with col2:
     st.markdown('<div class="card-title">📡 Live Console</div>', unsafe_allow_html=True)
     
+    logs = st.session_state.logs
+    log_levels = st.multiselect(
+        "Levels", list(LOG_ICONS), default=list(LOG_ICONS),
+        key="console_levels", label_visibility="collapsed"
+    )
+    
     console_html = '<div class="console-container">'
     
-    if st.session_state.logs:
-        for log in st.session_state.logs:
-            level_class = f"log-{log['level'].lower()}"
-            icon_map = {
-                "INFO": "🔵",
-                "SUCCESS": "🟢",
-                "ERROR": "🔴",
-                "WARNING": "🟡"
-            }
-            icon = icon_map.get(log['level'], "⚪")
-            console_html += f'<div class="log-entry {level_class}">{icon} [{log["time"]}] <strong>{log["level"]}</strong> - {log["message"]}</div>'
+    if len(logs):
+        console_html += ''.join(entry["html"] for entry in logs.tail(LOG_CONSOLE_TAIL, set(log_levels)))
     else:
         console_html += '<div class="log-entry log-info">🔵 [--:--:--] <strong>INFO</strong> - Console ready. Waiting for pipeline trigger...</div>'
     
     console_html += '</div>'
     st.markdown(console_html, unsafe_allow_html=True)
+    
+    if len(logs):
+        col_count, col_export = st.columns([3, 1])
+        with col_count:
+            shown = min(LOG_CONSOLE_TAIL, len(logs))
+            note = f" ({logs.dropped:,} older entries rotated out)" if logs.dropped else ""
+            st.caption(f"Showing last {shown:,} of {len(logs):,} entries{note}")
+        with col_export:
+            if st.button("📥 Export", key="export_logs", help="Export the buffered log as JSONL"):
+                st.session_state.log_export = logs.to_jsonl(set(log_levels))
+        if st.session_state.get('log_export'):
+            st.download_button(
+                "Download pipeline_logs.jsonl", st.session_state.log_export,
+                file_name="pipeline_logs.jsonl", mime="application/json",
+                on_click=lambda: st.session_state.pop('log_export', None)
+            )
 
 # PROGRESS STEPS
 st.markdown("<hr>", unsafe_allow_html=True)
@@ -748,26 +2140,44 @@ if st.session_state.current_step > 0:
     progress_pct = (st.session_state.current_step / 4) * 100
     st.progress(progress_pct / 100)
 
+def start_pipeline():
+    """Reset the console and run the pipeline on the current source"""
+    st.session_state.logs.clear()
+    st.session_state.current_step = 0
+    st.session_state.pipeline_running = True
+    st.session_state.pipeline_started = time.time()
+    st.session_state.stage_timings = {}
+    st.session_state.pipeline_source = {
+        "source_type": source_type,
+        "source": (source_uri or filename).split('?')[0],
+        "filename": filename,
+        "bytes": file_content['bytes'],
+    }
+
+    add_log("Pipeline initialized", "INFO")
+    add_log("━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━", "INFO")
+
+    update_step(1)
+    add_log("📡 Connecting to Upstash Kafka...", "INFO")
+    add_log("Endpoint: kafka-broker-1.upstash.io:9092", "INFO")
+    st.rerun()
+
 # START PIPELINE BUTTON
 col_status, col_button = st.columns([3, 1])
 
 with col_button:
     if st.button("▶️ Start Pipeline", use_container_width=True, type="primary"):
         if file_content:
-            st.session_state.logs = []
-            st.session_state.current_step = 0
-            st.session_state.pipeline_running = True
-            
-            add_log("Pipeline initialized", "INFO")
-            add_log("━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━", "INFO")
-            
-            update_step(1)
-            add_log("📡 Connecting to Upstash Kafka...", "INFO")
-            add_log("Endpoint: kafka-broker-1.upstash.io:9092", "INFO")
-            st.rerun()
+            start_pipeline()
         else:
             st.error("❌ Please provide a data source (file, URL, or cloud storage)")
 
+# An approximate preview asked to continue with the exact run once the source is ready
+if (st.session_state.get('approx_continue_pending') == source_uri and file_content
+        and not st.session_state.pipeline_running):
+    st.session_state.approx_continue_pending = None
+    start_pipeline()
+
 with col_status:
     if st.session_state.stats:
         if st.session_state.stats['status'] == 'success':
@@ -778,7 +2188,7 @@ with col_status:
 # CONTINUE PROCESSING IF PIPELINE RUNNING
 if st.session_state.pipeline_running and st.session_state.current_step == 1:
     import time
-    time.sleep(1.2)
+    time.sleep(1.2 * SIMULATED_LATENCY)
     
     add_log("✓ Connection established to Kafka broker", "SUCCESS")
     add_log("Authentication: SASL/SSL enabled", "SUCCESS")
@@ -788,13 +2198,115 @@ if st.session_state.pipeline_running and st.session_state.current_step == 1:
 
 elif st.session_state.pipeline_running and st.session_state.current_step == 2:
     import time
-    time.sleep(0.8)
+    scheduler = get_job_scheduler()
+    job_id = st.session_state.get('pipeline_job')
+    
+    if job_id is None:
+        time.sleep(0.8 * SIMULATED_LATENCY)
+        
+        if file_content:
+            compressed = detect_compression(peek_source(file_content)) is not None
+            staged_path, st.session_state.pipeline_fingerprint = stage_source(file_content)
+            try:
+                options = pipeline_options()
+                job_key = None
+                if st.session_state.checkpoint_enabled:
+                    options['checkpoint'] = {"dir": CHECKPOINT_DIR, "key": st.session_state.pipeline_fingerprint}
+                    job_key = checkpoint_path(CHECKPOINT_DIR, st.session_state.pipeline_fingerprint, options)
+                    purge_checkpoints(CHECKPOINT_DIR)
+                if options['tolerance'] is not None:
+                    options['tolerance']['quarantine_path'] = staged_path + ".quarantine.jsonl"
+                if pa is not None:
+                    options['preview_dir'] = staged_path + ".preview"
+                job_id = scheduler.submit(
+                    current_session_id(), run_pipeline_job, (staged_path, filename, options),
+                    estimate_job_memory(file_content['bytes'] or 0, compressed), label=filename, key=job_key
+                )
+            except ValueError as e:
+                os.remove(staged_path)
+                add_log(f"ERROR: {str(e)}", "ERROR")
+                record_run({"status": "error", "message": str(e)})
+                st.session_state.pipeline_running = False
+                st.rerun()
+            st.session_state.pipeline_job = job_id
+            st.session_state.pipeline_job_path = staged_path
+            st.session_state.pipeline_pushdown = file_content.get('pushdown')
+            if scheduler.status(job_id)['session'] != current_session_id():
+                add_log("♻️ Rejoined the parse already running for this source and settings", "INFO")
+            else:
+                add_log("Submitted parse job to shared worker pool", "INFO")
+            st.rerun()
     
-    if file_content:
-        result = process_csv_file(file_content, filename)
+    else:
+        job = scheduler.status(job_id)
+        
+        if job is not None and job['state'] in ("queued", "running"):
+            with col_status:
+                if job['state'] == "queued":
+                    st.info(f"⏳ Waiting for a worker — position {job['position']} of {job['queued_total']} in the queue")
+                else:
+                    st.info(f"⚙️ Parsing in worker… {time.time() - job['started']:.1f}s")
+            time.sleep(JOB_POLL_INTERVAL)
+            st.rerun()
+        
+        collected = scheduler.pop(job_id)
+        staged_path = st.session_state.pop('pipeline_job_path', None)
+        if staged_path and os.path.exists(staged_path):
+            os.remove(staged_path)
+        st.session_state.pipeline_job = None
+        pushdown = st.session_state.pop('pipeline_pushdown', None)
+        
+        if job is None or job['state'] != "done":
+            message = job['error'] if job else "Parse job was lost"
+            result = {"status": "error", "message": message}
+        elif collected is not None and collected['watchers'] > 0:
+            result = copy_run_files(job['result'])  # another session joined this run and uses the originals
+        else:
+            result = job['result']
         
         if result['status'] == 'success':
+            if result.get('compression'):
+                add_log(f"Detected {result['compression']} input, decompressed as a stream", "INFO")
+            resumed = (result.get('checkpoint') or {}).get('resumed')
+            if resumed and 'ranges' in resumed:
+                add_log(f"♻️ Resumed from checkpoint: {resumed['ranges']} byte ranges were already parsed", "INFO")
+            elif resumed:
+                add_log(
+                    f"♻️ Resumed from checkpoint: {resumed['rows']:,} rows ({format_bytes(resumed['offset'])}) "
+                    f"were already parsed", "INFO"
+                )
+            if result.get('parallel'):
+                parallel = result['parallel']
+                add_log(
+                    f"Parallel parse: {parallel['ranges']} byte ranges, "
+                    f"{parallel['fixups']} re-parsed after quote-state fix-up", "INFO"
+                )
+            if pushdown:
+                add_log(
+                    f"Pushdown via {pushdown['mode']}: scanned {format_bytes(pushdown['bytes_scanned'])}, "
+                    f"returned {format_bytes(pushdown['bytes_returned'])}", "INFO"
+                )
+                result['pushdown'] = pushdown
             add_log(f"✓ Successfully parsed {result['rows']:,} rows", "SUCCESS")
+            quarantine = result.get('quarantine')
+            if quarantine and quarantine['total']:
+                reasons = ", ".join(f"{reason}: {count:,}" for reason, count in quarantine['by_reason'].items())
+                add_log(f"⚠️ Quarantined {quarantine['total']:,} malformed records ({reasons})", "WARNING")
+            for rule in result.get('rules', []):
+                if rule['evaluated'] and rule['passed'] < rule['evaluated']:
+                    add_log(f"Rule '{rule['name']}': {rule['evaluated'] - rule['passed']:,} failing rows ({rule['pass_rate']}% pass)", "WARNING")
+            lookup = result.get('lookup')
+            if lookup:
+                how = LOOKUP_INDEX_SOURCES[lookup['index_source']]
+                add_log(
+                    f"🔗 Lookup join on {lookup['source_column']}: {lookup['match_rate']}% of rows matched "
+                    f"({lookup['index_keys']:,} keys, index {how} in {lookup['index_seconds']:.2f}s)", "INFO"
+                )
+                if lookup['missing_column']:
+                    add_log(f"Lookup key column '{lookup['source_column']}' is missing from the data", "WARNING")
+            windows = result.get('windows')
+            if windows and windows['late_rows']:
+                add_log(f"Windowing dropped {windows['late_rows']:,} late rows behind the watermark", "WARNING")
             add_log(f"✓ Detected {result['columns']} columns", "SUCCESS")
             add_log(f"Dataset Type: {result['dataset_type']}", "SUCCESS")
             
@@ -802,27 +2314,32 @@ elif st.session_state.pipeline_running and st.session_state.current_step == 2:
             add_log("📨 Producing message to Kafka topic...", "INFO")
             add_log("Topic: data-simulator", "INFO")
             add_log("Partition: 0", "INFO")
+            discard_run_files(st.session_state.stats)
             st.session_state.stats = result
             st.rerun()
         else:
+            if staged_path:
+                shutil.rmtree(staged_path + ".preview", ignore_errors=True)
             add_log(f"ERROR: {result['message']}", "ERROR")
+            record_run(result)
             st.session_state.pipeline_running = False
             st.rerun()
 
 elif st.session_state.pipeline_running and st.session_state.current_step == 3:
     import time
-    time.sleep(0.6)
+    time.sleep(0.6 * SIMULATED_LATENCY)
     
     add_log("Message format: JSON (schema validated)", "INFO")
     add_log("✓ Message produced successfully", "SUCCESS")
     add_log("⚙️ Consumer processing data stream...", "INFO")
     
     update_step(4)
-    time.sleep(0.5)
+    time.sleep(0.5 * SIMULATED_LATENCY)
     add_log("📊 Computing data statistics...", "SUCCESS")
     add_log("✓ Results computed and available", "SUCCESS")
     add_log("━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━", "SUCCESS")
     add_log("🎉 Pipeline execution completed!", "SUCCESS")
+    record_run(st.session_state.stats)
     
     st.session_state.pipeline_running = False
     st.rerun()
@@ -867,18 +2384,67 @@ if st.session_state.stats and st.session_state.stats.get('status') == 'success':
             <div class="stat-label">Completeness</div>
         </div>
         """, unsafe_allow_html=True)
+    
+    quarantine = stats.get('quarantine')
+    if quarantine is not None:
+        with st.expander(f"🧪 Quarantined Records ({quarantine['total']:,})", expanded=quarantine['total'] > 0):
+            if quarantine['total']:
+                st.markdown(" · ".join(f"**{reason}**: {count:,}" for reason, count in quarantine['by_reason'].items()))
+                st.dataframe(pd.DataFrame(quarantine['sample']), use_container_width=True, hide_index=True)
+                if quarantine['path'] and os.path.exists(quarantine['path']):
+                    with open(quarantine['path'], 'rb') as f:
+                        st.download_button(
+                            "📥 Download quarantine.jsonl", f, file_name="quarantine.jsonl",
+                            mime="application/json", key="download_quarantine"
+                        )
+            else:
+                st.success("No malformed records found")
 
 # ARCHITECTURE & ANALYSIS TABS
 if st.session_state.stats and st.session_state.stats.get('status') == 'success':
     st.markdown("<hr>", unsafe_allow_html=True)
     st.markdown('<div class="card-title">🏗️ Data Pipeline Architecture</div>', unsafe_allow_html=True)
     
-    tab1, tab2, tab3, tab4 = st.tabs(["📊 Data Flow", "🔍 Pipeline Details", "➕ Extend Pipeline", "📈 Data Analysis"])
+    tab1, tab2, tab3, tab4, tab5 = st.tabs(["📊 Data Flow", "🔍 Pipeline Details", "➕ Extend Pipeline", "📈 Data Analysis", "🗂️ Data Preview"])
     
     # TAB 1: Data Flow
     with tab1:
         st.markdown('<div class="flow-diagram"><span class="flow-item">📁 Data Source</span><span class="arrow">→</span><span class="flow-item">🌐 Streamlit</span><span class="arrow">→</span><span class="flow-item">📨 Kafka</span><span class="arrow">→</span><span class="flow-item">⚙️ Process</span><span class="arrow">→</span><span class="flow-item">📊 Results</span></div>', unsafe_allow_html=True)
         
+        schedule = stats.get('schedule')
+        if schedule:
+            st.markdown("### ⏱️ Stage Schedule")
+            critical = [entry for entry in schedule if entry['critical']]
+            st.markdown(
+                '<div class="flow-diagram">' + '<span class="arrow">→</span>'.join(
+                    f'<span class="flow-item">{html.escape(entry["stage"])} · {format_seconds(entry["seconds"])}</span>'
+                    for entry in critical
+                ) + '</div>',
+                unsafe_allow_html=True
+            )
+            timeline = pd.DataFrame(schedule)
+            timeline['end'] = timeline['start'] + timeline['seconds']
+            timeline['after'] = timeline['after'].str.join(", ")
+            timeline['path'] = timeline['critical'].map({True: "Critical path", False: "Off the critical path"})
+            st.altair_chart(
+                alt.Chart(timeline).mark_bar(minBandSize=2).encode(
+                    x=alt.X('start:Q', title="Seconds since the parse started"), x2='end:Q',
+                    y=alt.Y('stage:N', sort=None, title=None),
+                    color=alt.Color('path:N', title=None, scale=alt.Scale(
+                        domain=["Critical path", "Off the critical path"], range=["#f59e0b", "#32b8c6"]
+                    )),
+                    tooltip=['stage', 'after', 'simulated', alt.Tooltip('start:Q', format='.3f'), alt.Tooltip('seconds:Q', format='.3f')]
+                ).properties(height=max(160, 26 * len(timeline))),
+                use_container_width=True
+            )
+            elapsed = timeline['end'].max()
+            st.caption(
+                f"Finished {format_seconds(elapsed)} after the parse started, running {format_seconds(timeline['seconds'].sum())} "
+                f"of stage work · independent stages run concurrently once their inputs are ready"
+                + (" · simulated stages are laid out for their declared time without delaying the run"
+                   if timeline['simulated'].any() else "")
+            )
+        
         st.markdown("### Data Flow Path")
         col_a, col_b = st.columns(2)
         
@@ -1000,6 +2566,21 @@ if st.session_state.stats and st.session_state.stats.get('status') == 'success':
                 help="Explain what this transformation stage does"
             )
 
+            stage_options = list(STAGE_BUILTIN) + [stage['name'] for stage in st.session_state.custom_stages]
+            col_after, col_before, col_seconds = st.columns([2, 2, 1])
+            with col_after:
+                stage_after = st.multiselect(
+                    "Runs after", stage_options,
+                    help="Stages whose results this stage waits for. Leave empty to follow the pipeline position."
+                )
+            with col_before:
+                stage_before = st.multiselect(
+                    "Must finish before", [name for name in stage_options if name != "parse"],
+                    help="Stages that wait for this one. Custom stages start after the parse, so it is not offered."
+                )
+            with col_seconds:
+                stage_seconds = st.number_input("Simulated work (s)", min_value=0.0, max_value=30.0, value=0.5, step=0.1)
+
             # Position mapping
             position_mapping = {
                 "After Ingestion": "🌐 Ingestion Layer",
@@ -1011,15 +2592,25 @@ if st.session_state.stats and st.session_state.stats.get('status') == 'success':
             submit = st.form_submit_button("➕ Add Stage to Pipeline", use_container_width=True)
 
             if submit and stage_name:
-                st.session_state.custom_stages.append({
-                    "name": stage_name,
+                after, before = STAGE_POSITION_DEPENDENCIES[stage_position]
+                stage = {
+                    "name": stage_name.strip(),
                     "description": stage_desc,
                     "position": stage_position,
                     "position_label": position_mapping[stage_position],
-                    "id": len(st.session_state.custom_stages) + 1
-                })
-                st.success(f"✅ Stage '{stage_name}' added to {position_mapping[stage_position]}!", icon="✨")
-                st.rerun()
+                    "after": stage_after or after,
+                    "before": stage_before or ([] if stage_after else before),
+                    "seconds": float(stage_seconds),
+                    "id": max([other['id'] for other in st.session_state.custom_stages], default=0) + 1
+                }
+                try:
+                    validate_stages(st.session_state.custom_stages + [stage])
+                except ValueError as e:
+                    st.error(f"❌ {e}")
+                else:
+                    st.session_state.custom_stages.append(stage)
+                    st.success(f"✅ Stage '{stage_name}' added to {position_mapping[stage_position]}!", icon="✨")
+                    st.rerun()
 
         # Display added stages
         if st.session_state.custom_stages:
@@ -1056,6 +2647,10 @@ if st.session_state.stats and st.session_state.stats.get('status') == 'success':
                                 st.markdown(f"**{i + 1}. {stage['name']}**")
                                 st.markdown(f"__{stage['position_label']}__")
                                 st.markdown(f"📝 {stage['description']}")
+                                order = f"after {', '.join(stage.get('after') or ['parse'])}"
+                                if stage.get('before'):
+                                    order += f" · before {', '.join(stage['before'])}"
+                                st.caption(f"⏱️ {order} · {stage.get('seconds', 0):.1f}s simulated work")
 
                             with col_remove:
                                 if st.button("🗑️", key=f"remove_{stage['id']}", help="Remove this stage"):
@@ -1147,20 +2742,312 @@ if st.session_state.stats and st.session_state.stats.get('status') == 'success':
             </div>
             """, unsafe_allow_html=True)
         
+        charts = stats.get('charts')
+        preview = stats.get('preview')
+        store = get_preview_store(preview) if preview else None
+        if store is not None and store.text is not None:
+            st.markdown("#### 🔎 Description Search")
+            query = st.text_input(
+                "Search descriptions", key="analysis_search",
+                placeholder='pipeline   pipe*   "data pipeline"',
+                help="Words must all appear; end a word with * to match a prefix; quote words to match a phrase."
+            ).strip()
+            if query and not parse_search(query):
+                st.warning("The query has no searchable words.", icon="⚠️")
+            elif query:
+                ids, elapsed, matched_charts = search_charts(store, preview['segments'], query)
+                caption = f"{len(ids):,} of {store.rows:,} rows match in {elapsed:.1f} ms"
+                if len(ids):
+                    charts = matched_charts
+                    caption += " · the charts below cover the matching rows"
+                if len(ids) > SEARCH_CHART_ROWS:
+                    caption += f", up to the first {SEARCH_CHART_ROWS:,}"
+                st.caption(caption)
+                if len(ids):
+                    sample, _ = store.page(0, SEARCH_SAMPLE_ROWS, search=query)
+                    st.dataframe(sample, use_container_width=True)
+        
+        if charts and charts['columns']:
+            st.markdown("#### 📊 Charts")
+            timeline = charts['timeline']
+            if timeline:
+                points = pd.DataFrame(timeline['points'])
+                points['time'] = pd.to_datetime(points['time'])
+                st.altair_chart(
+                    alt.Chart(points).mark_line(point=len(points) < 60).encode(
+                        x=alt.X('time:T', title=timeline['column']),
+                        y=alt.Y('count:Q', title=f"Rows per {timeline['resolution']}"),
+                        tooltip=[alt.Tooltip('time:T'), alt.Tooltip('count:Q', format=',')]
+                    ).properties(height=220),
+                    use_container_width=True
+                )
+                caption = f"{timeline['buckets']:,} {'hourly' if timeline['resolution'] == 'hour' else 'daily'} buckets"
+                if timeline['downsampled']:
+                    caption += f", downsampled to {len(points)} points with LTTB"
+                if timeline['unparsed']:
+                    caption += f" · {timeline['unparsed']:,} values did not parse as dates"
+                st.caption(caption)
+            
+            chart_column = st.selectbox("Column", list(charts['columns']), key="chart_column")
+            column_charts = charts['columns'][chart_column]
+            hist_col, top_col = st.columns(2)
+            with hist_col:
+                if column_charts['numeric']:
+                    bins = pd.DataFrame(column_charts['numeric'])
+                    histogram = alt.Chart(bins).mark_bar().encode(
+                        x=alt.X('start:Q', bin='binned', title=chart_column), x2='end:Q',
+                        y=alt.Y('count:Q', title="Rows"), tooltip=['start', 'end', 'count']
+                    )
+                else:
+                    bins = pd.DataFrame(column_charts['lengths'])
+                    bins['length'] = bins['start'].astype(str) + "–" + (bins['end'] - 1).astype(str)
+                    histogram = alt.Chart(bins).mark_bar().encode(
+                        x=alt.X('length:O', sort=None, title="Value length (characters)"),
+                        y=alt.Y('count:Q', title="Rows"), tooltip=['length', 'count']
+                    )
+                st.altair_chart(histogram.properties(height=260), use_container_width=True)
+            with top_col:
+                top = pd.DataFrame(column_charts['top'])
+                top['label'] = top['value'].astype(str).str.replace("\n", " ").str.slice(0, 40)
+                bars = alt.Chart(top).mark_bar().encode(
+                    x=alt.X('count:Q', title="Rows"), y=alt.Y('label:N', sort='-x', title=None),
+                    tooltip=['value', alt.Tooltip('low:Q', title="at least", format=','), alt.Tooltip('count:Q', title="at most", format=',')]
+                )
+                if column_charts['approximate']:
+                    bars += alt.Chart(top).mark_rule(color="#f59e0b", strokeWidth=2).encode(
+                        x='low:Q', x2='count:Q', y=alt.Y('label:N', sort=alt.EncodingSortField('count', order='descending'))
+                    )
+                st.altair_chart(bars.properties(height=260), use_container_width=True)
+                distinct = f"≈ {column_charts['distinct']:,} distinct values (±{column_charts['distinct_error']:.1%})"
+                if column_charts['approximate']:
+                    st.caption(f"{distinct} · counts are sketch estimates that may overstate the true count by up to "
+                               f"{column_charts['top_error']:,} rows (orange), with {1 - math.exp(-SKETCH_DEPTH):.1%} confidence")
+                else:
+                    st.caption(distinct)
+        
+        windows = stats.get('windows')
+        if windows and windows['starts']:
+            st.markdown("#### 🪟 Event-Time Windows")
+            late_col, total_col, open_col, order_col = st.columns(4)
+            late_col.metric("Late rows", f"{windows['late_rows']:,}")
+            total_col.metric("Windows", f"{windows['windows']:,}")
+            open_col.metric("Peak open windows", f"{windows['peak_open']:,}")
+            order_col.metric("Time order", windows['order'] or "—")
+            shown = windows['starts'][-WINDOW_CHART_LIMIT:]
+            counts = windows['counts'][-WINDOW_CHART_LIMIT:]
+            window_df = pd.DataFrame(counts, columns=windows['keys'])
+            window_df['window'] = pd.to_datetime(shown)
+            window_df = window_df.melt(id_vars='window', var_name='key', value_name='rows')
+            st.altair_chart(
+                alt.Chart(window_df[window_df['rows'] > 0]).mark_bar().encode(
+                    x=alt.X('window:T', title="Window start"),
+                    y=alt.Y('rows:Q', title="Rows", stack=True),
+                    color=alt.Color('key:N', title="Activity"),
+                    tooltip=['window:T', 'key', 'rows']
+                ).properties(height=240),
+                use_container_width=True
+            )
+            slide = "" if windows['kind'] == "tumbling" else f" sliding every {windows['slide']} min"
+            caption = f"{windows['kind'].title()} {windows['size']}-minute windows{slide}, {windows['lateness']} min allowed lateness"
+            if len(shown) < windows['windows']:
+                caption += f" · showing the latest {len(shown):,} of {windows['windows']:,}"
+            if windows['unparsed']:
+                caption += f" · {windows['unparsed']:,} rows without a parseable Date"
+            st.caption(caption)
+        
+        lookup = stats.get('lookup')
+        if lookup:
+            st.markdown("#### 🔗 Lookup Enrichment")
+            if lookup['missing_column']:
+                st.warning(f"The data has no '{lookup['source_column']}' column to take join keys from.")
+            rate_col, matched_col, keyed_col, index_col = st.columns(4)
+            rate_col.metric("Match rate", f"{lookup['match_rate']}%" if lookup['match_rate'] is not None else "—")
+            matched_col.metric("Matched rows", f"{lookup['matched']:,}")
+            keyed_col.metric("Rows with a key", f"{lookup['with_key']:,}")
+            index_col.metric("Index keys", f"{lookup['index_keys']:,}")
+            how = LOOKUP_INDEX_SOURCES[lookup['index_source']]
+            key_rate = f" ({lookup['key_match_rate']}% of extracted keys)" if lookup['key_match_rate'] is not None else ""
+            st.caption(
+                f"{lookup['source_column']} → {lookup['reference']}.{lookup['key']}{key_rate}, "
+                f"added {', '.join(lookup['columns']) or 'no columns'} · index {how} in {lookup['index_seconds']:.2f}s"
+            )
+            if lookup['unmatched_sample']:
+                with st.expander(f"🔍 Unmatched Keys Sample ({len(lookup['unmatched_sample'])})"):
+                    st.dataframe(pd.DataFrame({"key": lookup['unmatched_sample']}), use_container_width=True, hide_index=True)
+        
+        rules = stats.get('rules')
+        if rules:
+            st.markdown("#### 📏 Data Quality Rules")
+            rules_df = pd.DataFrame(rules)
+            rules_df['failed'] = rules_df['evaluated'] - rules_df['passed']
+            st.dataframe(
+                rules_df[['name', 'type', 'column', 'weight', 'evaluated', 'failed', 'pass_rate']],
+                use_container_width=True, hide_index=True,
+                column_config={"pass_rate": st.column_config.ProgressColumn("Pass rate", format="%.1f%%", min_value=0, max_value=100)}
+            )
+            for rule in rules:
+                if rule.get('approximate'):
+                    st.caption(
+                        f"≈ '{rule['name']}' passed rows are a HyperLogLog estimate of the distinct values "
+                        f"(±{rule['error']:.1%}); the column had too many to track exactly."
+                    )
+            failures = stats.get('rule_failures') or []
+            with st.expander(f"🚩 Failing Rows Sample ({len(failures)})"):
+                if failures:
+                    st.dataframe(
+                        pd.DataFrame([{"row": f['row'], "rule": f['rule'], **f['values']} for f in failures]),
+                        use_container_width=True, hide_index=True
+                    )
+                    st.caption("Row numbers count data rows from 1, excluding the header.")
+                else:
+                    st.success("Every row passed every rule")
+        
         with st.expander("📊 Quality Score Breakdown"):
-            st.markdown("""
-            - **Completeness (35%)** - Based on null values
-            - **Size (25%)** - Row count adequacy
-            - **Diversity (20%)** - Content variety
-            - **Freshness (20%)** - Data recency
-            """)
+            rate = weighted_pass_rate(rules) if rules else None
+            if rate is None:
+                st.markdown("""
+                - **Completeness (35%)** - Based on null values
+                - **Size (25%)** - Row count adequacy
+                - **Diversity (20%)** - Content variety
+                - **Freshness (20%)** - Data recency
+                """)
+            else:
+                st.markdown(f"""
+                - **Completeness (35%)** - Based on null values
+                - **Size (25%)** - Row count adequacy
+                - **Rules (40%)** - Weighted rule pass rate: {rate * 100:.1f}%
+                """)
+
+    # TAB 5: Data Preview
+    with tab5:
+        preview = stats.get('preview')
+        if not preview:
+            st.info("Install pyarrow to browse the parsed rows." if pa is None else "No preview was written for this run.", icon="ℹ️")
+        else:
+            store = get_preview_store(preview)
+            columns = preview['columns']
+            sort_col, dir_col, filter_col, text_col = st.columns([3, 2, 3, 4])
+            with sort_col:
+                sort_by = st.selectbox("Sort by", ["(file order)"] + columns, key="preview_sort")
+            with dir_col:
+                descending = st.radio("Order", ["Asc", "Desc"], horizontal=True, key="preview_order") == "Desc"
+            with filter_col:
+                filter_by = st.selectbox("Filter column", columns, key="preview_filter_column")
+            with text_col:
+                filter_text = st.text_input("Contains", key="preview_filter_text")
+            
+            order = {
+                "sort_column": columns.index(sort_by) if sort_by in columns else None,
+                "descending": descending,
+                "filter_column": columns.index(filter_by),
+                "filter_text": filter_text,
+            }
+            size_col, search_col, page_col = st.columns([1, 2, 1])
+            with size_col:
+                page_size = st.selectbox("Rows per page", [25, 50, 100, 250], index=1, key="preview_page_size")
+            with search_col:
+                order['search'] = st.text_input(
+                    "Search descriptions", key="preview_search", disabled=store.text is None,
+                    placeholder='pipeline   pipe*   "data pipeline"' if store.text is not None else "No Description column indexed"
+                ).strip()
+            signature = (sort_by, descending, filter_by, filter_text, order['search'], page_size)
+            if st.session_state.get('preview_signature') != signature:
+                st.session_state.preview_signature = signature
+                st.session_state.preview_page = 1
+            started = time.perf_counter()
+            ids = store.order(**order)
+            matching = store.rows if ids is None else len(ids)
+            pages = max(1, -(-matching // page_size))
+            with page_col:
+                page_number = st.number_input(f"Page (of {pages:,})", min_value=1, max_value=pages, key="preview_page")
+            page, matching = store.page(int(page_number) - 1, page_size, **order)
+            elapsed = (time.perf_counter() - started) * 1000
+            
+            st.dataframe(page, use_container_width=True)
+            first = (int(page_number) - 1) * page_size + 1
+            caption = f"Rows {first:,}–{first + len(page) - 1:,} of {matching:,}" if matching else "No matching rows"
+            if matching != store.rows:
+                caption += f" (filtered from {store.rows:,})"
+            st.caption(f"{caption} · fetched in {elapsed:.1f} ms · the row column is the position in the file")
+
+# RUN HISTORY
+history = get_run_history()
+if history.count():
+    st.markdown("<hr>", unsafe_allow_html=True)
+    with st.expander("🕓 Run History", expanded=False):
+        overview = history.sources()
+        if overview.empty:
+            st.info("No successful runs recorded yet.", icon="ℹ️")
+        else:
+            overview['last_run'] = pd.to_datetime(overview['last_run'], unit='s')
+            st.markdown("**Sources** — latest run and change against the run before")
+            st.dataframe(
+                overview, use_container_width=True, hide_index=True,
+                column_config={
+                    "last_run": st.column_config.DatetimeColumn("Last run", format="YYYY-MM-DD HH:mm"),
+                    "row_change": st.column_config.NumberColumn("Δ rows", format="%+d"),
+                    "quality_drift": st.column_config.NumberColumn("Quality drift", format="%+.0f"),
+                }
+            )
+            
+            history_source = st.selectbox("Source", overview['source'].tolist(), key="history_source")
+            trend = history.trend(history_source)
+            trend['started_at'] = pd.to_datetime(trend['started_at'], unit='s')
+            rows_col, quality_col = st.columns(2)
+            with rows_col:
+                st.altair_chart(
+                    alt.Chart(trend).mark_line(point=True).encode(
+                        x=alt.X('started_at:T', title="Run"), y=alt.Y('rows:Q', title="Rows"),
+                        tooltip=['id', 'started_at:T', 'rows', 'row_change']
+                    ).properties(height=220, title="Row growth"),
+                    use_container_width=True
+                )
+            with quality_col:
+                st.altair_chart(
+                    alt.Chart(trend).mark_line(point=True, color="#32b8c6").encode(
+                        x=alt.X('started_at:T', title="Run"),
+                        y=alt.Y('quality_score:Q', title="Quality score", scale=alt.Scale(domain=[0, 100])),
+                        tooltip=['id', 'started_at:T', 'quality_score', 'quality_drift']
+                    ).properties(height=220, title="Quality drift"),
+                    use_container_width=True
+                )
+            
+            stages = history.stage_summary(history_source)
+            if not stages.empty:
+                stages['order'] = stages['stage'].map({label: step for step, label in STAGE_LABELS.items()})
+                st.markdown("**Stage timings**")
+                st.dataframe(
+                    stages.sort_values('order').drop(columns='order'), use_container_width=True, hide_index=True,
+                    column_config={
+                        "avg_seconds": st.column_config.NumberColumn("Avg (s)", format="%.2f"),
+                        "max_seconds": st.column_config.NumberColumn("Max (s)", format="%.2f"),
+                    }
+                )
+        
+        recent = history.recent()
+        recent['started_at'] = pd.to_datetime(recent['started_at'], unit='s')
+        st.markdown(f"**Recent runs** (last {HISTORY_RECENT_LIMIT} of {history.count():,})")
+        st.dataframe(
+            recent, use_container_width=True, hide_index=True,
+            column_config={
+                "started_at": st.column_config.DatetimeColumn("Started", format="YYYY-MM-DD HH:mm:ss"),
+                "seconds": st.column_config.NumberColumn("Seconds", format="%.1f"),
+            }
+        )
 
 # RESET BUTTON
 st.markdown("<hr>", unsafe_allow_html=True)
 if st.button("🔁 New Pipeline", use_container_width=True, type="secondary"):
-    st.session_state.logs = []
+    if st.session_state.get('pipeline_job'):
+        get_job_scheduler().cancel(st.session_state.pipeline_job)
+        st.session_state.pipeline_job = None
+    discard_run_files(st.session_state.stats)
+    st.session_state.logs.clear()
     st.session_state.stats = None
     st.session_state.pipeline_running = False
     st.session_state.current_step = 0
     st.session_state.custom_stages = []
+    st.session_state.approx_estimate = None
+    st.session_state.approx_continue_pending = None
+    get_fetch_manager().clear()
     st.rerun()
@@ -0,0 +1,137 @@
+"""AzureBlobClient against a small Azurite-style stand-in that checks every signature"""
+import base64
+import hashlib
+import hmac
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+import pytest
+
+# Importing the app runs its script once in bare mode
+os.environ.setdefault("PIPELINE_SIMULATED_LATENCY", "0")
+os.environ.setdefault("PIPELINE_HISTORY_DB", os.path.join(tempfile.mkdtemp(), "history.sqlite3"))
+import streamlit_app
+from streamlit_app import (
+    AZURITE_ACCOUNT, AZURITE_KEY, AzureBlobClient, AzureBlobError, parse_azure_connection_string,
+)
+
+SAS = "sv=2021-08-06&sp=rl&sig=stand-in"
+BLOB = os.urandom(300 * 1024 + 123)
+PAGES = {None: (["logs/a.csv", "logs/b.csv"], "page-2"), "page-2": (["logs/c.csv"], None)}
+
+
+def shared_key(method, path, query, headers):
+    """The SharedKey signature, computed the way the Azure SDKs do"""
+    x_ms = sorted((name.lower(), value.strip()) for name, value in headers.items() if name.lower().startswith("x-ms-"))
+    resource = f"/{AZURITE_ACCOUNT}{path}"
+    for name, value in sorted(query, key=lambda item: item[0].lower()):
+        resource += f"\n{name.lower()}:{value}"
+    fields = ["Content-Encoding", "Content-Language", "Content-Length", "Content-MD5", "Content-Type", "Date",
+              "If-Modified-Since", "If-Match", "If-None-Match", "If-Unmodified-Since", "Range"]
+    string_to_sign = "\n".join([method] + [headers.get(name, "") for name in fields]
+                               + ["".join(f"{name}:{value}\n" for name, value in x_ms) + resource])
+    digest = hmac.new(base64.b64decode(AZURITE_KEY), string_to_sign.encode(), hashlib.sha256).digest()
+    return f"SharedKey {AZURITE_ACCOUNT}:{base64.b64encode(digest).decode()}"
+
+
+class StandIn(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def authorized(self, path, query):
+        params = dict(query)
+        if "sig" in params:
+            return self.headers.get("Authorization") is None and "&".join(f"{k}={v}" for k, v in query
+                                                                         if k in ("sv", "sp", "sig")) == SAS
+        expected = shared_key(self.command, path, query, self.headers)
+        return hmac.compare_digest(self.headers.get("Authorization", ""), expected)
+
+    def reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def handle_request(self):
+        parsed = urlparse(self.path)
+        query = parse_qsl(parsed.query, keep_blank_values=True)
+        if not self.authorized(parsed.path, query):
+            self.server.rejected += 1
+            return self.reply(403, headers={"x-ms-error-code": "AuthenticationFailed"})
+        params = dict(query)
+        if parsed.path == f"/{AZURITE_ACCOUNT}/data" and params.get("comp") == "list":
+            names, marker = PAGES[params.get("marker")]
+            blobs = "".join(f"<Blob><Name>{name}</Name><Properties><Content-Length>{len(BLOB)}</Content-Length>"
+                            f"</Properties></Blob>" for name in names)
+            body = (f"<EnumerationResults><Blobs>{blobs}</Blobs>"
+                    f"<NextMarker>{marker or ''}</NextMarker></EnumerationResults>").encode()
+            return self.reply(200, body, {"Content-Type": "application/xml"})
+        if parsed.path != f"/{AZURITE_ACCOUNT}/data/logs/a.csv":
+            return self.reply(404, headers={"x-ms-error-code": "BlobNotFound"})
+        requested = self.headers.get("x-ms-range") or self.headers.get("Range")
+        if requested is None:
+            return self.reply(200, BLOB)
+        start, end = (int(x) for x in requested.split("=")[1].split("-"))
+        self.server.ranges.append((start, end))
+        return self.reply(206, BLOB[start:end + 1], {"Content-Range": f"bytes {start}-{end}/{len(BLOB)}"})
+
+    do_GET = do_HEAD = handle_request
+
+
+@pytest.fixture
+def endpoint():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    server.rejected = 0
+    server.ranges = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server, f"http://127.0.0.1:{server.server_port}/{AZURITE_ACCOUNT}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_path_style_endpoint_names_the_account_in_its_path():
+    credentials = parse_azure_connection_string(
+        f"BlobEndpoint=http://127.0.0.1:10000/{AZURITE_ACCOUNT};AccountKey={AZURITE_KEY}")
+    assert credentials['account'] == AZURITE_ACCOUNT
+    hosted = parse_azure_connection_string("BlobEndpoint=https://videos.blob.core.windows.net/;SharedAccessSignature=sv=1")
+    assert hosted['account'] == "videos"
+
+
+def test_listing_follows_next_marker(endpoint):
+    server, url = endpoint
+    client = AzureBlobClient(AZURITE_ACCOUNT, url, key=AZURITE_KEY)
+    assert [blob['name'] for blob in client.list_blobs("data", prefix="logs/")] == [
+        "logs/a.csv", "logs/b.csv", "logs/c.csv"]
+    assert server.rejected == 0
+
+
+def test_ranged_download_is_byte_identical(endpoint, monkeypatch):
+    server, url = endpoint
+    monkeypatch.setattr(streamlit_app, "AZURE_PARALLEL_THRESHOLD", 64 * 1024)
+    monkeypatch.setattr(streamlit_app, "AZURE_BLOCK_SIZE", 32 * 1024)
+    client = AzureBlobClient(AZURITE_ACCOUNT, url, key=AZURITE_KEY)
+    size = client.blob_size("data", "logs/a.csv")
+    assert size == len(BLOB)
+    assert b"".join(client.iter_blob("data", "logs/a.csv", size)) == BLOB
+    assert len(server.ranges) == -(-len(BLOB) // (32 * 1024)) and server.rejected == 0
+
+
+def test_sas_is_appended_instead_of_signing(endpoint):
+    server, url = endpoint
+    client = AzureBlobClient(AZURITE_ACCOUNT, url, sas="?" + SAS)
+    assert b"".join(client.iter_blob("data", "logs/a.csv", len(BLOB))) == BLOB
+    assert server.rejected == 0
+
+
+def test_wrong_key_is_rejected(endpoint):
+    server, url = endpoint
+    client = AzureBlobClient(AZURITE_ACCOUNT, url, key=base64.b64encode(b"not the key").decode())
+    with pytest.raises(AzureBlobError) as error:
+        client.list_blobs("data")
+    assert error.value.status == 403 and server.rejected == 1
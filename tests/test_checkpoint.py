@@ -0,0 +1,46 @@
+import os
+
+import pipeline_engine
+from pipeline_engine import Checkpoint, StagedText, process_csv_stream
+
+CSV = "Activity,URL\n" + "".join(f"YouTube,https://www.youtube.com/watch?v={i}\n" for i in range(2000))
+
+
+def test_only_one_run_holds_a_checkpoint(tmp_path):
+    path = str(tmp_path / "run.ckpt")
+    first = Checkpoint(path)
+    second = Checkpoint(path)
+    assert first.locked and not second.locked
+    first.close()
+    third = Checkpoint(path)
+    assert third.locked
+    third.close()
+
+
+def test_checkpoint_with_missing_outputs_is_not_restored(tmp_path):
+    path = str(tmp_path / "run.ckpt")
+    checkpoint = Checkpoint(path)
+    checkpoint.save("stream", [str(tmp_path / "gone.parquet")], source={"offset": 0})
+    checkpoint.close()
+    reopened = Checkpoint(path)
+    assert reopened.state is not None and reopened.restored("stream") is None
+    reopened.close()
+
+
+def test_runs_write_their_own_quarantine_and_preview(tmp_path, monkeypatch):
+    source = tmp_path / "source.csv"
+    source.write_text(CSV + "broken,\"\n")
+    monkeypatch.setattr(pipeline_engine, "STREAM_CHUNK_SIZE", 4096)
+    results = []
+    for run in ("a", "b"):
+        checkpoint = Checkpoint(str(tmp_path / "shared.ckpt"), interval=0)
+        tolerance = {"quarantine_path": str(tmp_path / f"{run}.quarantine.jsonl")}
+        results.append(process_csv_stream(StagedText(str(source)), "source.csv", tolerance,
+                                          preview_dir=str(tmp_path / f"{run}.preview"), checkpoint=checkpoint))
+        checkpoint.discard()
+        checkpoint.close()
+    first, second = results
+    assert first['quarantine']['total'] == second['quarantine']['total'] == 1
+    assert os.path.exists(first['quarantine']['path']) and os.path.exists(second['quarantine']['path'])
+    if pipeline_engine.pa is not None:
+        assert all(os.path.exists(path) for result in results for path in result['preview']['segments'])
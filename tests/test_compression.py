@@ -0,0 +1,35 @@
+import gzip
+import io
+import zipfile
+
+from pipeline_engine import STREAM_CHUNK_SIZE, decompress_chunks
+
+
+def csv_bytes(rows: int) -> bytes:
+    lines = ["Activity,Description,Date,URL"]
+    lines += [f"YouTube,Video {i} {i * 7919 % 100003:x},Nov 18 2025 3:23 PM,https://www.youtube.com/watch?v=v{i}" for i in range(rows)]
+    return ("\n".join(lines) + "\n").encode()
+
+
+def chunked(blob: bytes, size: int = STREAM_CHUNK_SIZE):
+    return iter([blob[i:i + size] for i in range(0, len(blob), size)])
+
+
+def test_multi_member_gzip_larger_than_a_chunk():
+    data = csv_bytes(150_000)
+    blob = gzip.compress(data[:len(data) // 2]) + gzip.compress(data[len(data) // 2:])
+    assert len(blob) > STREAM_CHUNK_SIZE
+    kind, stream = decompress_chunks(chunked(blob))
+    assert kind == "gzip"
+    assert b"".join(stream) == data
+
+
+def test_zip_member_after_skipped_entry():
+    data = csv_bytes(100_000)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("__MACOSX/._history.csv", data[:2_000_000])
+        archive.writestr("history.csv", data)
+    kind, stream = decompress_chunks(chunked(buffer.getvalue()))
+    assert kind == "zip"
+    assert b"".join(stream) == data
@@ -0,0 +1,20 @@
+import json
+import logging
+import os
+import tempfile
+
+os.environ.setdefault("PIPELINE_SIMULATED_LATENCY", "0")
+os.environ.setdefault("PIPELINE_HISTORY_DB", os.path.join(tempfile.mkdtemp(), "history.sqlite3"))
+from streamlit_app import LogStore
+
+
+def test_console_html_escapes_messages_but_the_log_file_keeps_them(caplog):
+    logger = logging.getLogger("test-console")
+    store = LogStore(file_logger=logger)
+    message = "Rule '<img src=x onerror=alert(1)>': 3 failing rows"
+    with caplog.at_level(logging.INFO, logger="test-console"):
+        entry = store.append(message, "WARNING")
+    assert "<img" not in entry['html'] and "&lt;img src=x onerror=alert(1)&gt;" in entry['html']
+    assert entry['message'] == message
+    assert json.loads(caplog.records[0].getMessage())['message'] == message
+    assert json.loads(store.to_jsonl())['message'] == message
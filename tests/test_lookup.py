@@ -0,0 +1,40 @@
+import os
+import pickle
+
+import pipeline_engine
+from pipeline_engine import LookupJoin, load_lookup_index
+
+
+def write_reference(path, rows):
+    path.write_text("video_id,channel\n" + "".join(f"{key},{channel}\n" for key, channel in rows))
+
+
+def count_digests(monkeypatch):
+    calls = []
+    digest = pipeline_engine.file_digest
+    monkeypatch.setattr(pipeline_engine, "file_digest", lambda path: calls.append(path) or digest(path))
+    return calls
+
+
+def test_memory_hits_do_not_hash_the_reference(tmp_path, monkeypatch):
+    reference = tmp_path / "reference.csv"
+    write_reference(reference, [("a", "one"), ("b", "two")])
+    calls = count_digests(monkeypatch)
+    _, first, _ = load_lookup_index(str(reference), "video_id", str(tmp_path / "cache"))
+    _, second, _ = load_lookup_index(str(reference), "video_id", str(tmp_path / "cache"))
+    assert (first, second) == ("built", "memory") and len(calls) == 1
+
+    write_reference(reference, [("a", "one"), ("b", "two"), ("c", "three")])
+    os.utime(reference, ns=(0, os.stat(reference).st_mtime_ns + 1))
+    index, how, _ = load_lookup_index(str(reference), "video_id", str(tmp_path / "cache"))
+    assert how == "built" and len(index) == 3
+
+
+def test_unpickled_joins_merge_without_the_index(tmp_path, monkeypatch):
+    reference = tmp_path / "reference.csv"
+    write_reference(reference, [("a", "one"), ("b", "two")])
+    join = LookupJoin({"path": str(reference), "key": "video_id", "source_column": "id"})
+    monkeypatch.setattr(pipeline_engine, "load_lookup_index", None)
+    copy = pickle.loads(pickle.dumps(join))
+    join.merge(copy)
+    assert copy.index is None and join.result(["id"])['index_keys'] == 2
@@ -0,0 +1,165 @@
+"""Kill a run right after a checkpoint, resume it and compare with a clean run"""
+import gzip
+import json
+import os
+import pickle
+import signal
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import pipeline_engine
+from pipeline_engine import Checkpoint, parse_file_parallel, run_pipeline_job
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHUNK_SIZE = 16 * 1024
+BATCH_ROWS = 500
+
+# Stops the run at its nth checkpoint save, or the first one after that lands
+# inside a UTF-8 character, where the parent kills it
+CHILD = """
+import json, sys, time
+import pipeline_engine
+from pipeline_engine import Checkpoint, parse_file_parallel, run_pipeline_job
+
+pipeline_engine.STREAM_CHUNK_SIZE = {chunk_size}
+pipeline_engine.FRAME_BATCH_ROWS = {batch_rows}
+save = pipeline_engine.Checkpoint.save
+
+pool = None
+
+def save_and_stop(self, *args, **kwargs):
+    save(self, *args, **kwargs)
+    if self.saves >= {stop_after} and ('source' not in kwargs or kwargs['source']['decoder'][0]):
+        print(*(pool._processes if pool is not None else ()), flush=True)
+        time.sleep(600)
+
+pipeline_engine.Checkpoint.save = save_and_stop
+path, options = sys.argv[1], json.loads(sys.argv[2])
+if options.get('parse_workers'):
+    checkpoint = Checkpoint(pipeline_engine.checkpoint_path(options['checkpoint']['dir'], "source", options), 0)
+    pool = pipeline_engine._make_pool(options['parse_workers'])
+    parse_file_parallel(path, "source.csv", options['parse_workers'], pool=pool, preview_dir=options['preview_dir'],
+                        checkpoint=checkpoint)
+else:
+    run_pipeline_job(path, "source.csv", options)
+"""
+
+
+def write_source(path, compress=False):
+    lines = ["Activity,Title,URL,Date"]
+    for i in range(6000):
+        title = f"Vidéo n°{i} — “ünïcödé” 🎬"
+        lines.append(f"YouTube,{title},https://www.youtube.com/watch?v={i:06d},2024-01-{i % 28 + 1:02d}")
+        if i % 997 == 0:
+            lines.append('broken,"never closed,x')
+            lines.append('"')
+    body = ("\n".join(lines) + "\n").encode()
+    with (gzip.open(path, 'wb') if compress else open(path, 'wb')) as f:
+        f.write(body)
+
+
+def options_for(tmp_path, run, **extra):
+    return {
+        "tolerance": {"quarantine_path": str(tmp_path / f"{run}.quarantine.jsonl")},
+        "preview_dir": str(tmp_path / f"{run}.preview"),
+        "checkpoint": {"dir": str(tmp_path / "checkpoints"), "key": "source", "interval": 0},
+        **extra,
+    }
+
+
+def kill_after_checkpoint(source, options, stop_after):
+    env = {**os.environ, "PYTHONPATH": ROOT}
+    script = CHILD.format(chunk_size=CHUNK_SIZE, batch_rows=BATCH_ROWS, stop_after=stop_after)
+    child = subprocess.Popen([sys.executable, "-c", script, str(source), json.dumps(options)],
+                             stdout=subprocess.PIPE, text=True, env=env, cwd=ROOT)
+    try:
+        line = child.stdout.readline()
+        assert line.endswith("\n"), "the run ended before the checkpoint to stop at"
+    finally:
+        child.send_signal(signal.SIGKILL)
+        child.wait()
+        child.stdout.close()
+    # Parse workers outlive the run and can leave a half-written range behind
+    for pid in map(int, line.split()):
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def comparable(result):
+    skip = ("schedule", "preview", "checkpoint", "compression")
+    comparable = {key: value for key, value in result.items() if key not in skip}
+    if 'quarantine' in comparable:
+        comparable['quarantine'] = {k: v for k, v in result['quarantine'].items() if k != "path"}
+    return comparable
+
+
+def preview_rows(result):
+    if pipeline_engine.pa is None:
+        return None
+    rows = []
+    for path in result['preview']['segments']:
+        table = pipeline_engine.pa.ipc.open_file(pipeline_engine.pa.memory_map(path)).read_all()
+        rows += table.to_pylist()
+    return rows
+
+
+def preview_files(result):
+    chunks = (result['preview'].get('text') or {}).get('chunks', [])
+    return result['preview']['segments'] + [f"{chunk['path']}.{part}.npy" for chunk in chunks
+                                            for part in ("terms", "offsets", "rows", "pos")]
+
+
+def read(path):
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("compress", [False, True], ids=["csv", "gzip"])
+def test_serial_resume_matches_a_clean_run(tmp_path, monkeypatch, compress):
+    source = tmp_path / "source.csv"
+    write_source(source, compress)
+    monkeypatch.setattr(pipeline_engine, "STREAM_CHUNK_SIZE", CHUNK_SIZE)
+    monkeypatch.setattr(pipeline_engine, "FRAME_BATCH_ROWS", BATCH_ROWS)
+
+    kill_after_checkpoint(source, options_for(tmp_path, "killed"), stop_after=3)
+    [name] = [name for name in os.listdir(tmp_path / "checkpoints") if name.endswith(".ckpt")]
+    with open(tmp_path / "checkpoints" / name, 'rb') as f:
+        assert pickle.load(f)['source']['decoder'][0], "the run should stop mid-character"
+    resumed = run_pipeline_job(str(source), "source.csv", options_for(tmp_path, "resumed"))
+    clean = run_pipeline_job(str(source), "source.csv", {**options_for(tmp_path, "clean"), "checkpoint": None})
+
+    assert resumed['status'] == "success" and resumed['checkpoint']['resumed']['offset'] > 0
+    assert comparable(resumed) == comparable(clean)
+    # The resumed run finished the killed run's files rather than starting its own
+    assert resumed['quarantine']['path'] == str(tmp_path / "killed.quarantine.jsonl")
+    assert not os.path.exists(tmp_path / "resumed.quarantine.jsonl")
+    assert read(resumed['quarantine']['path']) == read(clean['quarantine']['path'])
+    assert preview_rows(resumed) == preview_rows(clean)
+    assert not [name for name in os.listdir(tmp_path / "checkpoints") if name.endswith(".ckpt")]
+
+
+def test_parallel_resume_matches_a_clean_run(tmp_path):
+    source = tmp_path / "source.csv"
+    write_source(source)
+    options = options_for(tmp_path, "killed", parse_workers=3, tolerance=None)
+    kill_after_checkpoint(source, options, stop_after=1)
+    checkpoint = Checkpoint(pipeline_engine.checkpoint_path(str(tmp_path / "checkpoints"), "source", options), 0)
+    with ThreadPoolExecutor(3) as pool:
+        resumed = parse_file_parallel(str(source), "source.csv", 3, pool=pool,
+                                      preview_dir=str(tmp_path / "resumed.preview"), checkpoint=checkpoint)
+        clean = parse_file_parallel(str(source), "source.csv", 3, pool=pool,
+                                    preview_dir=str(tmp_path / "clean.preview"))
+    checkpoint.close()
+
+    assert resumed['checkpoint']['resumed'] == {"ranges": 1}
+    assert comparable(resumed) == comparable(clean)
+    assert preview_rows(resumed) == preview_rows(clean)
+    if pipeline_engine.pa is not None:
+        assert resumed['preview']['dir'] == str(tmp_path / "killed.preview")
+        assert sorted(os.listdir(resumed['preview']['dir'])) == sorted(
+            os.path.basename(path) for path in preview_files(resumed))
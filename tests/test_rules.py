@@ -0,0 +1,50 @@
+import pickle
+
+import pandas as pd
+
+from pipeline_engine import RuleEngine, validate_rules
+
+HEADERS = ["Activity", "URL"]
+
+
+def unique_engine(**kwargs) -> RuleEngine:
+    return RuleEngine(validate_rules([{"type": "unique", "column": "URL", "name": "Unique URL"}]), **kwargs)
+
+
+def feed(engine: RuleEngine, urls: list, batch: int = 1000):
+    for start in range(0, len(urls), batch):
+        rows = [["YouTube", url] for url in urls[start:start + batch]]
+        engine.update(rows, pd.DataFrame(rows), HEADERS)
+
+
+def urls(distinct: int, repeats: int = 2) -> list:
+    return [f"https://www.youtube.com/watch?v=v{i}" for i in range(distinct)] * repeats
+
+
+def test_unique_rule_is_exact_under_the_limit():
+    engine = unique_engine()
+    feed(engine, urls(5000))
+    [result] = engine.results()
+    assert (result['evaluated'], result['passed'], result['approximate']) == (10000, 5000, False)
+    assert len(engine.failure_sample()) == engine.sample_size
+
+
+def test_unique_rule_memory_is_bounded_past_the_limit():
+    engine = unique_engine(exact_limit=1000)
+    feed(engine, urls(20000))
+    [result] = engine.results()
+    assert engine.seen[0] is None
+    assert result['approximate'] and result['error'] > 0
+    assert abs(result['passed'] - 20000) <= 20000 * 4 * result['error']
+    assert len(pickle.dumps(engine)) < 100_000
+
+
+def test_merged_ranges_match_a_serial_run():
+    data = urls(3000, repeats=3)
+    serial = unique_engine()
+    feed(serial, data)
+    head, tail = unique_engine(), unique_engine()
+    feed(head, data[:4000])
+    feed(tail, data[4000:])
+    head.merge(tail)
+    assert head.results() == serial.results()
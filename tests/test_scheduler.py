@@ -0,0 +1,66 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pipeline_engine
+from pipeline_engine import JobScheduler
+
+
+def make_scheduler():
+    return JobScheduler(max_workers=2, memory_budget=1024, pool_factory=lambda n: ThreadPoolExecutor(n))
+
+
+def wait_finished(scheduler, job_id):
+    deadline = time.monotonic() + 10
+    while scheduler.status(job_id)['finished'] is None:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_same_key_joins_only_unfinished_jobs():
+    scheduler = make_scheduler()
+    release = threading.Event()
+    first = scheduler.submit("a", release.wait, (), 1, key="k")
+    assert scheduler.submit("b", release.wait, (), 1, key="k") == first
+    release.set()
+    wait_finished(scheduler, first)
+    second = scheduler.submit("c", release.wait, (), 1, key="k")
+    assert second != first
+    wait_finished(scheduler, second)
+    assert scheduler.pop(first)['watchers'] == 1
+    assert scheduler.pop(first)['watchers'] == 0
+    assert scheduler.status(first) is None
+
+
+def test_cancel_waits_for_the_last_watcher():
+    scheduler = make_scheduler()
+    release = threading.Event()
+    job_id = scheduler.submit("a", release.wait, (), 1, key="k")
+    scheduler.submit("b", release.wait, (), 1, key="k")
+    scheduler.cancel(job_id)
+    assert scheduler.status(job_id)['state'] in ("queued", "running")
+    release.set()
+    wait_finished(scheduler, job_id)
+    assert scheduler.status(job_id)['state'] == "done"
+    assert scheduler.pop(job_id)['result'] is True
+    assert scheduler.status(job_id) is None
+
+
+def test_cancel_by_the_only_watcher_drops_a_queued_job():
+    scheduler = JobScheduler(max_workers=1, memory_budget=1024, pool_factory=lambda n: ThreadPoolExecutor(n))
+    release = threading.Event()
+    scheduler.submit("a", release.wait, (), 1)
+    queued = scheduler.submit("a", release.wait, (), 1, key="k")
+    scheduler.cancel(queued)
+    assert scheduler.status(queued)['state'] == "cancelled"
+    assert scheduler.submit("b", release.wait, (), 1, key="k") != queued
+    release.set()
+
+
+def test_uncollected_jobs_expire(monkeypatch):
+    scheduler = make_scheduler()
+    job_id = scheduler.submit("a", time.time, (), 1)
+    wait_finished(scheduler, job_id)
+    monkeypatch.setattr(pipeline_engine, "JOB_RESULT_TTL", 0)
+    time.sleep(0.01)
+    assert scheduler.status(job_id) is None
@@ -0,0 +1,42 @@
+import time
+
+import pytest
+
+from pipeline_engine import StageGraph, StatsAccumulator, validate_stages
+
+
+def test_simulated_stages_are_scheduled_without_sleeping():
+    graph = StageGraph()
+    graph.add("parse", None, outputs=("rows",))
+    graph.add("slow", None, after=("parse",), seconds=30)
+    graph.add("report", lambda rows: {"report": rows * 2}, inputs=("rows",), outputs=("report",), after=("slow",))
+    values = {"rows": 21}
+    now = time.time()
+    started = time.monotonic()
+    schedule = {entry['stage']: entry for entry in graph.run(values, completed={"parse": (now - 1, now)})}
+    assert time.monotonic() - started < 5
+    assert values['report'] == 42
+    assert schedule['slow']['simulated'] and schedule['slow']['seconds'] == 30
+    assert schedule['report']['start'] == pytest.approx(schedule['slow']['start'] + 30)
+    assert all(entry['critical'] for entry in schedule.values())
+
+
+def test_accumulator_result_does_not_wait_for_custom_stages():
+    stats = StatsAccumulator()
+    stats.update([["Activity", "URL"], ["YouTube", "https://www.youtube.com/watch?v=a"]])
+    stages = validate_stages([{"name": "enrich", "after": ["quality"], "seconds": 30}])
+    started = time.monotonic()
+    result = stats.result("history.csv", stages)
+    assert time.monotonic() - started < 5
+    [enrich] = [entry for entry in result['schedule'] if entry['stage'] == "enrich"]
+    assert enrich['seconds'] == 30
+
+
+def test_stages_cannot_run_before_parse():
+    with pytest.raises(ValueError, match="before parse"):
+        validate_stages([{"name": "early", "before": ["parse"]}])
+    graph = StageGraph()
+    graph.add("parse", None)
+    graph.add("early", None, before=("parse",), seconds=1)
+    with pytest.raises(ValueError, match="already run"):
+        graph.run({}, completed={"parse": (0, 1)})
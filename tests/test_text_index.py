@@ -0,0 +1,24 @@
+import numpy as np
+import pandas as pd
+
+from pipeline_engine import TextIndex, TextIndexWriter
+
+
+def build_index(tmp_path, descriptions: list) -> TextIndex:
+    writer = TextIndexWriter(str(tmp_path), "segment")
+    writer.add(pd.Series(descriptions))
+    return TextIndex({"column": "Description", "chunks": writer.close()}, {"segment": 0})
+
+
+def test_phrases_match_only_adjacent_tokens(tmp_path):
+    index = build_index(tmp_path, ["data pipeline tutorial", "pipeline for data", "big data pipeline"])
+    assert index.search('"data pipeline"').tolist() == [0, 2]
+    assert index.search("pipeline data").tolist() == [0, 1, 2]
+
+
+def test_phrase_positions_past_65535_are_not_clamped(tmp_path):
+    # Far apart, but a 16-bit position would clamp omega's to 65535, right after alpha
+    words = ["filler"] * 70_000
+    words[65_534], words[69_000] = "alpha", "omega"
+    index = build_index(tmp_path, [" ".join(words), "alpha omega"])
+    assert index.search('"alpha omega"').tolist() == [1]